@@ -6,10 +6,12 @@ This is the same as a `make` file, but in python.
 from __future__ import annotations
 import argparse
 import inspect
+import os
 import sys
 import json
 import logging
 import platform
+import shutil
 import subprocess
 from pathlib import Path
 
@@ -18,6 +20,7 @@ log = logging.getLogger(__name__)
 IMAGE = "boox"
 VENV = "/venv"
 APPDIR = "/app"
+SRCDIR = Path(__file__).parent / "src"
 
 
 def run(cmd, parse=False):
@@ -35,6 +38,16 @@ def error(msg, code=1):
         sys.exit(code)
 
 
+def addon():
+    "imports the add-on package outside anki (using the vendored pygments)"
+    os.environ["STANDALONE_ADDON"] = "1"
+    if str(SRCDIR) not in sys.path:
+        sys.path.insert(0, str(SRCDIR))
+    import syntax_highlighting_ng
+
+    return syntax_highlighting_ng
+
+
 def task_info():
     print(f"sys.executable: {sys.executable}")
     print(f"sys.platform: {sys.platform}")
@@ -100,6 +113,185 @@ def task_cross_build(args):
     )
 
 
+def task_languages(args):
+    "generate the precomputed pygments language index"
+    addon()
+    from syntax_highlighting_ng import languages
+
+    p = argparse.ArgumentParser()
+    p.add_argument("-o", "--output", default=languages.INDEX_PATH, type=Path)
+    p.add_argument("--no-plugins", action="store_true", help="skip plugin lexers")
+    options = p.parse_args(args)
+
+    index = languages.build_index(plugins=not options.no_plugins)
+    languages.write_index(index, str(options.output))
+    log.info(
+        "written %i lexers (pygments %s) to '%s'",
+        len(index.lexers),
+        index.version,
+        options.output,
+    )
+
+
+def task_styles(args):
+    "precompute the pygments style tables (inline css and stylesheets)"
+    addon()
+    from syntax_highlighting_ng import styles
+
+    p = argparse.ArgumentParser()
+    p.add_argument("-o", "--output", default=styles.TABLES_PATH, type=Path)
+    options = p.parse_args(args)
+
+    tables = styles.build_tables()
+    styles.write_tables(tables, str(options.output))
+    log.info(
+        "written %i styles (pygments %s) to '%s'",
+        len(tables["styles"]),
+        tables["version"],
+        options.output,
+    )
+
+
+def task_vendor(args):
+    "unpack and precompile the vendored pygments wheel"
+    addon()
+    from syntax_highlighting_ng import vendor
+
+    p = argparse.ArgumentParser()
+    p.add_argument("--measure", action="store_true", help="compare the import times")
+    options = p.parse_args(args)
+
+    path = vendor.unpack()
+    vendor.precompile(path)
+    for stale in vendor.cleanup():
+        log.info("removed stale '%s'", stale)
+    log.info("vendored pygments unpacked and compiled in '%s'", path)
+
+    if options.measure:
+        import tempfile
+
+        def import_time(entry, *flags):
+            code = (
+                "import sys, time; sys.path.insert(0, sys.argv[1]); "
+                "start = time.perf_counter(); "
+                "import pygments.lexers.python, pygments.formatters.html; "
+                "print(time.perf_counter() - start)"
+            )
+            cmd = [sys.executable, "-I", *flags, "-c", code, entry]
+            return min(float(run(cmd)) for _ in range(5))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # a copy without bytecode, -B keeps it that way
+            cold = shutil.copytree(
+                path, Path(tmp) / "cold", ignore=shutil.ignore_patterns("*.pyc")
+            )
+            timings = {
+                "wheel (zipimport)": import_time(vendor.WHEEL),
+                "unpacked, cold (no bytecode)": import_time(cold, "-B"),
+                "unpacked, warm (bytecode)": import_time(path),
+            }
+        for name, value in timings.items():
+            print(f"  {name}: {value * 1000:.1f}ms")  # noqa: T201
+
+
+def compare_benchmarks(results, baseline, time_tolerance, bytes_tolerance):
+    """returns the (name, baseline, found) results over the baseline tolerances
+
+    and the ones missing from the baseline (baseline None): it's out of date.
+    """
+    # times below this (in seconds) are mostly timer noise
+    noise = 0.001
+    regressions = [
+        (name, None, found["value"])
+        for name, found in sorted(results["results"].items())
+        if name not in baseline["results"]
+    ]
+    for name, ref in sorted(baseline["results"].items()):
+        found = results["results"].get(name)
+        if found is None:
+            log.warning("benchmark '%s' not found in the results", name)
+            continue
+        if ref["kind"] == "time":
+            limit = ref["value"] * (1 + time_tolerance) + noise
+        else:
+            limit = ref["value"] * (1 + bytes_tolerance)
+        if found["value"] > limit:
+            regressions.append((name, ref["value"], found["value"]))
+    return regressions
+
+
+def task_benchmark(args):
+    "run the render benchmarks and check them against the baseline"
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "-o", "--output", default=Path("build") / "benchmark.json", type=Path
+    )
+    p.add_argument(
+        "--baseline",
+        default=Path(__file__).parent / "tests" / "benchmarks" / "baseline.json",
+        type=Path,
+    )
+    p.add_argument(
+        "--update-baseline", action="store_true", help="store results as baseline"
+    )
+    p.add_argument("--max-lines", type=int, help="skip the larger snippets")
+    p.add_argument(
+        "--time-tolerance", type=float, default=0.5, help="eg. 0.5 is 50%% slower"
+    )
+    p.add_argument("--bytes-tolerance", type=float, default=0.01)
+    options = p.parse_args(args)
+
+    env = dict(
+        os.environ,
+        STANDALONE_ADDON="1",
+        PYTHONPATH=str(SRCDIR),
+        BENCHMARK_OUTPUT=str(options.output.absolute()),
+    )
+    if options.max_lines:
+        env["BENCHMARK_MAX_LINES"] = str(options.max_lines)
+    subprocess.check_call(
+        [
+            sys.executable,
+            "-m",
+            "pytest",
+            "-q",
+            "-o",
+            "python_files=bench_*.py",
+            str(Path(__file__).parent / "tests" / "benchmarks"),
+        ],
+        env=env,
+    )
+    results = json.loads(options.output.read_text())
+    log.info("benchmark results written to '%s'", options.output)
+
+    if options.update_baseline:
+        options.baseline.write_text(options.output.read_text())
+        log.info("baseline updated '%s'", options.baseline)
+        return
+
+    baseline = json.loads(options.baseline.read_text())
+    if baseline["meta"] != results["meta"]:
+        log.warning(
+            "baseline from a different environment (%s), timings may not compare",
+            baseline["meta"],
+        )
+    regressions = compare_benchmarks(
+        results, baseline, options.time_tolerance, options.bytes_tolerance
+    )
+    for name, ref, found in regressions:
+        if ref is None:
+            print(f"  {name}: {found} (not in the baseline)")  # noqa: T201
+            continue
+        change = f" ({found / ref - 1:+.0%})" if ref else ""
+        print(f"  {name}: {ref} -> {found}{change}")  # noqa: T201
+    if regressions:
+        error(
+            f"{len(regressions)} benchmarks over the baseline tolerances "
+            "(or not in the baseline, see --update-baseline)"
+        )
+    log.info("no regressions over %i benchmarks", len(baseline["results"]))
+
+
 COMMANDS = {
     name[len("task_") :].replace("_", "-"): fn
     for name, fn in locals().items()
@@ -10,11 +10,12 @@ Please do not edit this file if you are not sure what you are doing.
 Copyright: (c) 2018 Glutanimate <https://glutanimate.com/>
 License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
 """
+import multiprocessing
 import os
 import sys
 
 from ._version import __version__  # noqa: F401
-from .consts import addon_path
+from . import vendor
 
 # we need to import syntax_highlighting_ng without an installed anki,
 # hence this workaround
@@ -24,17 +25,24 @@ from .consts import addon_path
 # always use shipped pygments library
 # TODO: properly vendorize pygments, lest we interfere with
 #        other add-ons that might be shipping their own pygments
-sys.path.insert(
-    0, os.path.join(addon_path, "libs", "pygments-2.18.0-py3-none-any.whl")
-)
+# (unpacked from the wheel, see vendor.py)
+sys.path.insert(0, vendor.pygments_path())
 
 STANDALONE = False
-try:
-    from . import main  # noqa: F401
-except ModuleNotFoundError as e:
-    if not os.environ.get("STANDALONE_ADDON") == "1":
-        raise RuntimeError(
-            "set env STANDALONE_ADDON=1 if you don't need anki modules"
-        ) from e
+if multiprocessing.parent_process() is not None:
+    # worker processes (eg. restyle.py) only need the rendering modules
     STANDALONE = True
+elif sys.argv[:1] == ["-m"]:
+    # python -m syntax_highlighting_ng (the command line renderer, see cli.py)
+    # sys.argv[0] is "-m" while the __main__ module is located
+    STANDALONE = True
+else:
+    try:
+        from . import main  # noqa: F401
+    except ModuleNotFoundError as e:
+        if not os.environ.get("STANDALONE_ADDON") == "1":
+            raise RuntimeError(
+                "set env STANDALONE_ADDON=1 if you don't need anki modules"
+            ) from e
+        STANDALONE = True
 
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+Command line renderer entry point: python -m syntax_highlighting_ng --help
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+import sys
+
+from .cli import main
+
+sys.exit(main())
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+Background rendering, off the Qt GUI thread
+
+Jobs run on a small thread pool, at most one per key (eg. the editor), so
+repeated hotkey presses don't queue duplicate work. Each job gets a cancel
+event to pass down to html_render (see html_render.render_fragment).
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+from __future__ import annotations
+
+import concurrent.futures
+import dataclasses as dc
+import logging
+import threading
+import time
+from typing import Any, Callable
+
+log = logging.getLogger(__name__)
+
+
+@dc.dataclass
+class RenderJob:
+    key: Any
+    cancel: threading.Event = dc.field(default_factory=threading.Event)
+    started: float = dc.field(default_factory=time.monotonic)
+    future: concurrent.futures.Future | None = None
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def done(self) -> bool:
+        return self.future is not None and self.future.done()
+
+    def result(self) -> Any:
+        assert self.future is not None
+        return self.future.result()
+
+
+class BackgroundRenderer:
+    def __init__(self, max_workers: int = 2):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="syntax_highlighting_ng"
+        )
+        self.jobs: dict[Any, RenderJob] = {}
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        key: Any,
+        fn: Callable[[threading.Event], Any],
+        callback: Callable[[RenderJob], None],
+    ) -> RenderJob | None:
+        """Runs fn(cancel) in a worker thread
+
+        callback(job) is called when done (from the worker thread). Returns
+        None, without submitting anything, if a job for key is still running.
+        """
+        with self._lock:
+            job = self.jobs.get(key)
+            if job is not None and not job.done():
+                log.debug("render already in progress for %s", key)
+                return None
+            job = self.jobs[key] = RenderJob(key)
+            job.future = self.executor.submit(fn, job.cancel)
+        job.future.add_done_callback(lambda _: self._done(job, callback))
+        return job
+
+    def _done(self, job: RenderJob, callback: Callable[[RenderJob], None]) -> None:
+        with self._lock:
+            if self.jobs.get(job.key) is job:
+                del self.jobs[job.key]
+        log.debug("render for %s done in %.3fs", job.key, job.elapsed)
+        try:
+            callback(job)
+        except Exception:
+            log.exception("render callback failed")
+
+    def cancel_all(self) -> None:
+        with self._lock:
+            for job in self.jobs.values():
+                job.cancel.set()
+
+    def shutdown(self) -> None:
+        self.cancel_all()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+Bulk highlighting of CSV/TSV question banks
+
+Reads a table row by row, replaces the code in the given columns with the
+highlighted fragments (html_render, same escaping as the editor button) and
+writes an Anki importable TSV file:
+
+    python -m syntax_highlighting_ng.bulk bank.csv -c code -L lang -o bank.tsv
+
+The cells are rendered on a process pool with a bounded number of rows in
+flight, so the memory use doesn't depend on the table size and the rows are
+written in the input order. A cell that cannot be rendered (eg. an unknown
+language) is reported and kept as (html and Anki escaped) text, the run goes
+on.
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+from __future__ import annotations
+
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import dataclasses as dc
+import html
+import os
+import sys
+from typing import IO, Any, Callable, Iterable, Iterator, Sequence
+
+from . import cli, html_render, languages, render_types
+
+# rows rendered (or waiting) at any time
+WINDOW = 256
+# bytes looked at to guess the csv dialect
+SNIFF_SIZE = 64 * 1024
+
+
+@dc.dataclass
+class RowError:
+    row: int  # data row number, 1 based
+    column: str
+    message: str
+
+
+@dc.dataclass
+class BulkResult:
+    rows: int = 0
+    cells: int = 0
+    errors: list[RowError] = dc.field(default_factory=list)
+
+
+def _render(args: tuple[str, html_render.Style, bool]) -> str | html_render.RenderError:
+    # runs in the worker processes, the errors are returned
+    source, style, centerfragments = args
+    try:
+        return html_render.render_fragment(source, style, centerfragments)
+    except html_render.RenderError as exc:
+        return exc
+
+
+def _completed(fn: Callable[..., Any], *args: Any) -> concurrent.futures.Future:
+    future: concurrent.futures.Future = concurrent.futures.Future()
+    future.set_result(fn(*args))
+    return future
+
+
+def highlight_rows(
+    rows: Iterable[dict[str, str]],
+    columns: Sequence[str],
+    style: html_render.Style,
+    centerfragments: bool = False,
+    *,
+    language_column: str | None = None,
+    executor: concurrent.futures.Executor | None = None,
+    window: int = WINDOW,
+    result: BulkResult | None = None,
+) -> Iterator[dict[str, str]]:
+    """yields rows with the code in columns highlighted, in order
+
+    Args:
+        rows: the table rows (eg. a csv.DictReader)
+        columns: the code columns
+        style: the style, style.language is used if the row has no language
+        language_column: the column with the language of the row
+        executor: where to render, defaults to this process
+        window: the rows in flight
+        result: collects the counts and the errors
+    """
+    result = BulkResult() if result is None else result
+    submit = executor.submit if executor is not None else _completed
+    pending: collections.deque[
+        tuple[int, dict[str, str], list[tuple[str, concurrent.futures.Future]]]
+    ] = collections.deque()
+
+    def done() -> dict[str, str]:
+        number, row, futures = pending.popleft()
+        for column, future in futures:
+            rendered = future.result()
+            if isinstance(rendered, html_render.RenderError):
+                message = render_types.error_message(rendered)
+                result.errors.append(RowError(number, column, message))
+                # the card templates would still see "{{" and "::"
+                row[column] = html_render.anki_escape(html.escape(row[column]))
+            else:
+                row[column] = rendered
+                result.cells += 1
+        result.rows += 1
+        return row
+
+    for number, row in enumerate(rows, 1):
+        language = style.language
+        if language_column:
+            language = languages.resolve_language(
+                row.get(language_column) or "", language
+            )
+        rstyle = dc.replace(style, language=language)
+        futures = [
+            (column, submit(_render, (row[column], rstyle, centerfragments)))
+            for column in columns
+            if row.get(column)
+        ]
+        pending.append((number, row, futures))
+        if len(pending) >= window:
+            yield done()
+    while pending:
+        yield done()
+
+
+def sniff_dialect(stream: IO[str], path: str = "") -> Any:
+    """tab separated for .tsv/.tab files, else guessed (default: excel)"""
+    if os.path.splitext(path)[1].lower() in {".tsv", ".tab"}:
+        return csv.excel_tab
+    if not stream.seekable():
+        return csv.excel
+    start = stream.tell()
+    sample = stream.read(SNIFF_SIZE)
+    stream.seek(start)
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=",;\t|")
+    except csv.Error:
+        return csv.excel
+
+
+def write_header(out: IO[str], fieldnames: Sequence[str]) -> None:
+    """the file headers for the Anki importer (2.1.55+)"""
+    out.write("#separator:tab\n#html:true\n")
+    out.write("#columns:" + "\t".join(fieldnames) + "\n")
+
+
+def bulk(
+    src: IO[str],
+    out: IO[str],
+    columns: Sequence[str],
+    style: html_render.Style,
+    centerfragments: bool = False,
+    *,
+    language_column: str | None = None,
+    dialect: Any = None,
+    jobs: int | None = 1,
+    window: int = WINDOW,
+) -> BulkResult:
+    """highlights the src table into out (tab separated, see highlight_rows)
+
+    jobs is the number of worker processes, 0 or None one per cpu and 1
+    renders in this process.
+    """
+    reader = csv.DictReader(src, dialect=dialect or csv.excel)
+    fieldnames = reader.fieldnames or []
+    missing = [c for c in [*columns, language_column] if c and c not in fieldnames]
+    if missing:
+        raise ValueError(f"columns not found: {', '.join(missing)}")
+
+    write_header(out, fieldnames)
+    writer = csv.DictWriter(out, fieldnames, dialect=csv.excel_tab, lineterminator="\n")
+    result = BulkResult()
+    with contextlib.ExitStack() as stack:
+        executor = None
+        if jobs != 1:
+            executor = stack.enter_context(
+                concurrent.futures.ProcessPoolExecutor(max_workers=jobs or None)
+            )
+        for row in highlight_rows(
+            reader,
+            columns,
+            style,
+            centerfragments,
+            language_column=language_column,
+            executor=executor,
+            window=window,
+            result=result,
+        ):
+            writer.writerow(row)
+    return result
+
+
+def parse_args(argv: Sequence[str] | None = None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(
+        prog="python -m syntax_highlighting_ng.bulk",
+        description="highlights the code columns of a CSV/TSV file into an "
+        "Anki importable TSV file",
+    )
+    p.add_argument("input", help="the CSV/TSV file (-: stdin)")
+    p.add_argument(
+        "-c",
+        "--column",
+        action="append",
+        required=True,
+        dest="columns",
+        help="a code column (repeatable)",
+    )
+    p.add_argument("-l", "--language", help="default language (default: text)")
+    p.add_argument("-L", "--language-column", help="the column with the language")
+    p.add_argument(
+        "-d", "--delimiter", help="input delimiter (default: guessed, tab for .tsv)"
+    )
+    cli.add_style_arguments(p)
+    p.add_argument("-o", "--output", help="output file (default: stdout)")
+    return p.parse_args(argv)
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    args = parse_args(argv)
+    style = cli.style_from_args(args)
+    # code cells can be larger than the csv default limit (128KB)
+    csv.field_size_limit(max(csv.field_size_limit(), 64 * 1024 * 1024))
+
+    with contextlib.ExitStack() as stack:
+        src = sys.stdin
+        if args.input != "-":
+            src = stack.enter_context(open(args.input, encoding="utf-8", newline=""))
+        out = sys.stdout
+        if args.output:
+            out = stack.enter_context(
+                open(args.output, "w", encoding="utf-8", newline="")
+            )
+        if args.delimiter:
+            dialect = type("dialect", (csv.excel,), {"delimiter": args.delimiter})
+        else:
+            dialect = sniff_dialect(src, args.input)
+        try:
+            result = bulk(
+                src,
+                out,
+                args.columns,
+                style,
+                args.center,
+                language_column=args.language_column,
+                dialect=dialect,
+                jobs=args.jobs,
+            )
+        except ValueError as exc:
+            print(exc, file=sys.stderr)
+            return 2
+
+    for error in result.errors:
+        print(f"row {error.row}, {error.column}: {error.message}", file=sys.stderr)
+    print(
+        f"{result.rows} rows, {result.cells} cells highlighted, "
+        f"{len(result.errors)} errors",
+        file=sys.stderr,
+    )
+    return 1 if result.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
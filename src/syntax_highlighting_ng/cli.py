@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+Command line renderer
+
+Renders files, directories or stdin with html_render (same Style options and
+Anki escaping as the editor button), outside of Anki:
+
+    python -m syntax_highlighting_ng -j 0 -f jsonl src/ > fragments.jsonl
+    cat snippet.sql | python -m syntax_highlighting_ng -l sql
+
+The files are rendered on a process pool (--jobs) and written in input order;
+stdin is rendered (and written) in chunks as it's read.
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import contextlib
+import dataclasses as dc
+import fnmatch
+import json
+import os
+import sys
+from typing import IO, Any, Iterable, Iterator, Sequence
+
+from . import detect, html_render, languages, render_types
+
+FORMATS = ("html", "jsonl")
+# files per worker round trip
+CHUNKSIZE = 16
+
+
+@dc.dataclass
+class Result:
+    path: str
+    language: str
+    html: str | None = None
+    error: str | None = None
+
+    def record(self) -> dict[str, Any]:
+        if self.error is not None:
+            return {"path": self.path, "error": self.error}
+        return {"path": self.path, "language": self.language, "html": self.html}
+
+
+def guess_language(path: str, txt: str) -> str:
+    """the language for the file name, using txt among several (or text)"""
+    candidates = languages.get_index().for_filename(os.path.basename(path))
+    if len(candidates) > 1:
+        found = detect.detect(txt, candidates)
+        return found.alias if found else candidates[0]
+    return candidates[0] if candidates else "text"
+
+
+def collect(paths: Sequence[str], include: Sequence[str] = ()) -> Iterator[str]:
+    """the files in paths, walking (sorted, skipping hidden) the directories
+
+    Within directories only the files matching one of the include patterns
+    are taken, or (no include) the ones with a known language.
+    """
+    index = languages.get_index()
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for name in sorted(files):
+                if name.startswith("."):
+                    continue
+                if include:
+                    if not any(fnmatch.fnmatch(name, pat) for pat in include):
+                        continue
+                elif not index.for_filename(name):
+                    continue
+                yield os.path.join(root, name)
+
+
+def render_file(args: tuple[str, str | None, html_render.Style, bool]) -> Result:
+    # runs in the worker processes
+    path, language, style, centerfragments = args
+    try:
+        with open(path, encoding="utf-8") as fp:
+            txt = fp.read()
+        style = dc.replace(style, language=language or guess_language(path, txt))
+        html = html_render.render_fragment(txt, style, centerfragments)
+    except (OSError, UnicodeDecodeError) as exc:
+        return Result(path, style.language, error=str(exc))
+    except html_render.RenderError as exc:
+        return Result(path, style.language, error=render_types.error_message(exc))
+    return Result(path, style.language, html)
+
+
+def render_files(
+    paths: Iterable[str],
+    style: html_render.Style,
+    centerfragments: bool = False,
+    language: str | None = None,
+    jobs: int | None = 1,
+) -> Iterator[Result]:
+    """renders paths (language guessed if not set), in order
+
+    jobs is the number of worker processes, 0 or None one per cpu and 1
+    renders in this process.
+    """
+    work = ((path, language, style, centerfragments) for path in paths)
+    if jobs == 1:
+        yield from map(render_file, work)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs or None) as pool:
+        yield from pool.map(render_file, work, chunksize=CHUNKSIZE)
+
+
+def write_result(out: IO[str], result: Result, fmt: str, header: bool) -> None:
+    if fmt == "jsonl":
+        out.write(json.dumps(result.record()) + "\n")
+    elif result.html is not None:
+        if header:
+            out.write(f"<!-- {result.path} -->\n")
+        out.write(result.html + "\n")
+
+
+def render_stream(
+    out: IO[str],
+    stream: IO[str],
+    style: html_render.Style,
+    centerfragments: bool,
+    fmt: str,
+) -> Result:
+    """renders stream (eg. stdin), html is written as it's produced"""
+    if fmt == "jsonl":
+        result = Result("-", style.language)
+        try:
+            result.html = html_render.render_fragment(
+                stream.read(), style, centerfragments
+            )
+        except html_render.RenderError as exc:
+            result.error = render_types.error_message(exc)
+        write_result(out, result, fmt, False)
+        return result
+
+    try:
+        for chunk in html_render.render_fragment_iter(stream, style, centerfragments):
+            out.write(chunk)
+            out.flush()
+    except html_render.RenderError as exc:
+        return Result("-", style.language, error=render_types.error_message(exc))
+    out.write("\n")
+    return Result("-", style.language)
+
+
+def add_style_arguments(p: argparse.ArgumentParser) -> None:
+    """the rendering options (see style_from_args), and --jobs"""
+    p.add_argument("--style", default="default", help="pygments style")
+    p.add_argument("--no-linenos", action="store_true", help="no line numbers")
+    p.add_argument(
+        "--css-classes", action="store_true", help="css classes, not inline styles"
+    )
+    p.add_argument("--compact", action="store_true", help="smaller html output")
+    p.add_argument("--center", action="store_true", help="center the fragments")
+    p.add_argument(
+        "-j", "--jobs", type=int, default=1, help="worker processes (0: one per cpu)"
+    )
+
+
+def style_from_args(args: argparse.Namespace) -> html_render.Style:
+    return html_render.Style(
+        linenos="" if args.no_linenos else "inline",
+        noclasses=not args.css_classes,
+        style=args.style,
+        language=args.language or "text",
+        compact=args.compact,
+    )
+
+
+def parse_args(argv: Sequence[str] | None = None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(
+        prog="python -m syntax_highlighting_ng",
+        description="renders source code as Anki ready html fragments",
+    )
+    p.add_argument(
+        "paths", nargs="*", help="files and directories (default or -: stdin)"
+    )
+    p.add_argument(
+        "-l",
+        "--language",
+        help="lexer alias (default: guessed from the file name, else text)",
+    )
+    add_style_arguments(p)
+    p.add_argument("-f", "--format", choices=FORMATS, default="html")
+    p.add_argument("-o", "--output", help="output file (default: stdout)")
+    p.add_argument(
+        "--include",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="file name pattern within directories (default: known languages)",
+    )
+    return p.parse_args(argv)
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    args = parse_args(argv)
+    style = style_from_args(args)
+
+    errors = 0
+    with contextlib.ExitStack() as stack:
+        out = sys.stdout
+        if args.output:
+            out = stack.enter_context(open(args.output, "w", encoding="utf-8"))
+        if not args.paths or args.paths == ["-"]:
+            errors += _report(
+                render_stream(out, sys.stdin, style, args.center, args.format)
+            )
+        else:
+            paths = list(collect(args.paths, args.include))
+            for result in render_files(
+                paths, style, args.center, args.language, args.jobs
+            ):
+                write_result(out, result, args.format, len(paths) > 1)
+                errors += _report(result)
+    return 1 if errors else 0
+
+
+def _report(result: Result) -> int:
+    if result.error is None:
+        return 0
+    print(f"{result.path}: {result.error}", file=sys.stderr)
+    return 1
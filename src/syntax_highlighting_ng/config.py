@@ -8,7 +8,10 @@ Configuration shim between Anki 2.0 and Anki 2.1
 Copyright: (c) 2018 Glutanimate <https://glutanimate.com/>
 License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
 """
+from __future__ import annotations
+
 import os
+from typing import Any, Callable
 
 from aqt import mw
 from anki.hooks import addHook
@@ -32,6 +35,7 @@ default_conf = {
     "linenos": True,  # show numbers by default
     "centerfragments": False,  # Use <center> when generating code fragments
     "cssclasses": False,  # Use css classes instead of colors directly in html
+    "compact": False,  # Merge the spans and shorten the inline styles
     "defaultlangperdeck": True,  # Default to last used language per deck
     "deckdefaultlang": {},  # Map to store the default language per deck
     "lang": "Python",
@@ -61,9 +65,15 @@ def sync_config_with_default(col):
     # col.flush()
 
 
+# called with the synced conf once the profile is loaded (eg. main.warm_up)
+profile_loaded_callbacks: list[Callable[[dict[str, Any]], None]] = []
+
+
 def setupSyncedConf():
     # If config options have changed, sync with default config first
     sync_config_with_default(mw.col)
+    for callback in profile_loaded_callbacks:
+        callback(mw.col.conf[KEY])
 
 
 addHook("profileLoaded", setupSyncedConf)
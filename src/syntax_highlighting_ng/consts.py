@@ -14,3 +14,4 @@ import os
 
 sys_encoding = sys.getfilesystemencoding()
 addon_path = os.path.dirname(__file__)
+user_files_path = os.path.join(addon_path, "user_files")
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+Bounded language auto-detection
+
+Unlike pygments.lexers.guess_lexer (running analyse_text for every known
+lexer) the detection picks among a few candidate languages (eg. the
+configured ones): cheap signals first (markdown fences, shebangs, keywords)
+then analyse_text on the candidates only, within a time budget. The results
+are cached by content hash.
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+
+from __future__ import annotations
+
+import collections
+import dataclasses as dc
+import hashlib
+import logging
+import re
+import threading
+import time
+from typing import Any, Sequence
+
+from . import languages
+
+log = logging.getLogger(__name__)
+
+# (seconds) for the analyse_text fallback
+BUDGET = 0.05
+# the signals look only at the beginning of the text
+SAMPLE_SIZE = 4096
+# .. and analyse_text at a shorter part (a call can't be interrupted)
+ANALYSE_SIZE = 1024
+
+FENCE_RE = re.compile(r"\A\s*(?:```|~~~)\s*([\w+#.-]+)")
+SHEBANG_RE = re.compile(r"\A#!\s*(?:\S*/)?(?:env\s+(?:-\S+\s+)*)?([\w.+-]+)")
+
+# interpreter (without version digits) -> alias, when they differ
+INTERPRETERS = {
+    "node": "javascript",
+    "nodejs": "javascript",
+    "sh": "bash",
+    "dash": "bash",
+    "ksh": "bash",
+    "pwsh": "powershell",
+    "Rscript": "r",
+}
+
+# distinctive line starts, by alias
+KEYWORDS = {
+    "python": r"(def|class) \w+.*:$|(from [\w.]+ )?import \w|if __name__ ==|@\w+",
+    "c": r"#include\s*<\w+\.h>|(int|void) main\s*\(|typedef struct",
+    "cpp": r"#include\s*<\w+>|(template|namespace) |std::|class \w+\s*(:|\{)",
+    "java": r"(public|private|protected) (static )?(final )?(class|void|\w+)"
+    r"|package [\w.]+;",
+    "csharp": r"using System|namespace [\w.]+|public (partial )?class",
+    "javascript": r"(const|let|var) \w+ = |function\s*\w*\(|import .* from ['\"]"
+    r"|export |console\.log",
+    "typescript": r"(interface|type) \w+ |(const|let) \w+: \w+|import .* from ['\"]",
+    "go": r"package \w+$|func (\(\w+ \*?\w+\) )?\w+\(|import \(",
+    "rust": r"fn \w+|let mut |use \w+::|impl\b|pub (fn|struct|enum)",
+    "ruby": r"def \w+[?!]?$|require ['\"]|end$|module \w+$",
+    "php": r"<\?php|\$\w+ = |function \w+\(",
+    "bash": r"(if|while) \[|fi$|done$|echo |export \w+=|\w+=\$\(",
+    "sql": r"(select|insert into|update|delete from|create table|with|from|join"
+    r"|where|group by|order by|values) \b",
+    "html": r"<(!doctype|html|head|body|div|p|span|a)\b",
+    "css": r"[.#]?[\w-]+\s*\{$|[\w-]+:\s*[^;]+;$",
+    "haskell": r"\w+ :: |import qualified|module \w+ where|where$",
+    "kotlin": r"fun \w+|val \w+ = |data class",
+    "swift": r"func \w+|let \w+ = |import (UIKit|Foundation)",
+    "lua": r"local \w+ = |function \w+[.:]?\w*\(|end$",
+    "perl": r"use strict;|my \$\w+|sub \w+ \{",
+    "r": r"\w+ <- |library\(",
+    "yaml": r"[\w-]+:( |$)|- \w",
+    "json": r"[\[{]$|\"[\w-]+\": ",
+    "latex": r"\\(documentclass|begin|usepackage|section)\b",
+}
+KEYWORDS_RE = {
+    alias: re.compile(rf"^\s*(?:{pattern})", re.M | re.I if alias == "sql" else re.M)
+    for alias, pattern in KEYWORDS.items()
+}
+
+
+@dc.dataclass(frozen=True)
+class Detection:
+    alias: str
+    method: str  # fence, shebang, keywords or analyse_text
+
+
+def _canonical(candidates: Sequence[str]) -> dict[str, str]:
+    """maps every alias of the candidates to the candidate"""
+    index = languages.get_index()
+    result: dict[str, str] = {}
+    for candidate in candidates:
+        info = index.aliases.get(candidate.lower())
+        for alias in info.aliases if info else (candidate.lower(),):
+            result.setdefault(alias, candidate)
+    return result
+
+
+def by_fence(sample: str, aliases: dict[str, str]) -> str | None:
+    match = FENCE_RE.match(sample)
+    return aliases.get(match.group(1).lower()) if match else None
+
+
+def by_shebang(sample: str, aliases: dict[str, str]) -> str | None:
+    match = SHEBANG_RE.match(sample)
+    if not match:
+        return None
+    interpreter = match.group(1).rstrip("0123456789.")
+    return aliases.get(INTERPRETERS.get(interpreter, interpreter).lower())
+
+
+def keyword_scores(sample: str, aliases: dict[str, str]) -> dict[str, int]:
+    scores: dict[str, int] = collections.Counter()
+    for alias, candidate in aliases.items():
+        pattern = KEYWORDS_RE.get(alias)
+        if pattern is not None and candidate not in scores:
+            scores[candidate] = len(pattern.findall(sample))
+    return scores
+
+
+def by_analyse_text(
+    sample: str, candidates: Sequence[str], budget: float
+) -> str | None:
+    """the candidate with the best analyse_text score (or None)
+
+    The budget is soft: it's checked between the candidates, a slow
+    analyse_text overruns it (bounded by the ANALYSE_SIZE sample).
+    """
+    sample = sample[:ANALYSE_SIZE]
+    deadline = time.monotonic() + budget
+    best, best_score = None, 0.0
+    for candidate in candidates:
+        if time.monotonic() > deadline:
+            log.debug("detection budget exhausted before %s", candidate)
+            break
+        cls: Any = languages.lexer_class(candidate)
+        if cls is None:
+            continue
+        score = cls.analyse_text(sample)
+        if score > best_score:
+            best, best_score = candidate, score
+        if best_score >= 1.0:
+            break
+    return best
+
+
+def detect(
+    text: str, candidates: Sequence[str], budget: float = BUDGET
+) -> Detection | None:
+    """picks the language of text among the candidate aliases (or None)"""
+    if not candidates:
+        return None
+    sample = text[:SAMPLE_SIZE]
+    aliases = _canonical(candidates)
+
+    for method, fn in [("fence", by_fence), ("shebang", by_shebang)]:
+        found = fn(sample, aliases)
+        if found:
+            return Detection(found, method)
+
+    # a clear keywords winner, or the order to try analyse_text
+    scores = keyword_scores(sample, aliases)
+    ranked = sorted(candidates, key=lambda c: -scores.get(c, 0))
+    if len(ranked) == 1 and scores.get(ranked[0]):
+        return Detection(ranked[0], "keywords")
+    if len(ranked) > 1:
+        first, second = (scores.get(c, 0) for c in ranked[:2])
+        if first >= 2 and first >= 2 * second:
+            return Detection(ranked[0], "keywords")
+
+    found = by_analyse_text(sample, ranked, budget)
+    return Detection(found, "analyse_text") if found else None
+
+
+class Detector:
+    """detect() with a LRU cache keyed by the content hash"""
+
+    def __init__(self, maxsize: int = 256, budget: float = BUDGET):
+        self.maxsize = maxsize
+        self.budget = budget
+        self.cache: collections.OrderedDict[
+            tuple[str, tuple[str, ...]], Detection | None
+        ] = collections.OrderedDict()
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+
+    def detect(self, text: str, candidates: Sequence[str]) -> Detection | None:
+        digest = hashlib.sha256(text.encode("utf-8", "surrogatepass")).hexdigest()
+        key = (digest, tuple(candidates))
+        with self._lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key]
+            self.misses += 1
+
+        start = time.perf_counter()
+        found = detect(text, candidates, self.budget)
+        log.debug("detected %s in %.1fms", found, (time.perf_counter() - start) * 1000)
+        with self._lock:
+            self.cache[key] = found
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return found
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+Highlighting of all the code fields of a note
+
+The "codeFields" option maps the names of the note fields holding code to
+their language (empty: the language selected in the editor). The editor
+action (main.highlight_fields) takes a copy of the note fields, then here:
+
+    code_fields    recovers the plain text of each code field (the source
+                   of a field already highlighted, so it can be re-rendered
+                   with the current options)
+    render_fields  renders them concurrently on a process pool (or in the
+                   render server), skipping the fragments already in the
+                   fragment cache
+
+and the note is updated once, with all the rendered fields.
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+from __future__ import annotations
+
+import concurrent.futures
+import dataclasses as dc
+import html.parser
+import logging
+import threading
+from typing import Any, Callable, Mapping, Sequence
+
+from . import fragment_cache, languages, limits, render_types, restyle, server
+
+log = logging.getLogger(__name__)
+
+# the tags ending a line of text
+BLOCK_TAGS = {"div", "p", "pre", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6"}
+# how often the cancel event is checked while waiting for the pool
+POLL_INTERVAL = 0.05
+
+
+@dc.dataclass
+class CodeField:
+    index: int  # in the note fields
+    name: str
+    language: str  # as configured: a name, an alias or empty
+    source: str
+    field: str  # the field html the source is from
+
+
+@dc.dataclass
+class FieldResult:
+    field: CodeField
+    html: str | None = None
+    error: str = ""
+    notice: str = ""  # not highlighted (or truncated), see limits.notice
+
+
+class _TextParser(html.parser.HTMLParser):
+    """the text of a field, the line breaks from <br> and the blocks"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks: list[str] = []
+
+    def newline(self):
+        if self.chunks and not self.chunks[-1].endswith("\n"):
+            self.chunks.append("\n")
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "br":
+            self.chunks.append("\n")
+        elif tag in BLOCK_TAGS:
+            self.newline()
+
+    def handle_endtag(self, tag):
+        if tag in BLOCK_TAGS:
+            self.newline()
+
+    def handle_data(self, data):
+        self.chunks.append(data)
+
+
+def field_text(field: str) -> str:
+    """the plain text (code) of a note field"""
+    fragments = restyle.find_fragments(field)
+    if fragments:
+        return "\n".join(fragment.source for fragment in fragments)
+    parser = _TextParser()
+    parser.feed(field)
+    parser.close()
+    return "".join(parser.chunks).replace("\u00a0", " ").strip("\n")
+
+
+def code_fields(
+    names: Sequence[str], fields: Sequence[str], conf: Mapping[str, str]
+) -> list[CodeField]:
+    """the non empty fields among the conf ones (name -> language), in order"""
+    found = []
+    for index, (name, field) in enumerate(zip(names, fields)):
+        if name not in conf:
+            continue
+        source = field_text(field)
+        if source.strip():
+            found.append(CodeField(index, name, conf[name] or "", source, field))
+    return found
+
+
+def _render(
+    args: tuple[str, render_types.Style, bool],
+    cancel: threading.Event | None = None,
+) -> str | render_types.RenderError:
+    # runs in the worker processes (or here, cancellable), the errors are returned
+    from . import html_render
+
+    source, style, centerfragments = args
+    try:
+        return html_render.render_fragment(source, style, centerfragments, cancel)
+    except render_types.RenderCancelled:
+        raise
+    except render_types.RenderError as exc:
+        return exc
+
+
+def render_fields(
+    found: Sequence[CodeField],
+    get_style: Callable[[str], render_types.Style],
+    centerfragments: bool = False,
+    *,
+    default_language: str = "",
+    executor: concurrent.futures.Executor | None = None,
+    render_many: Callable[
+        [list[tuple[str, render_types.Style, bool]]],
+        Sequence[concurrent.futures.Future],
+    ]
+    | None = None,
+    cache: fragment_cache.FragmentCache | None = None,
+    size_limits: limits.Limits = limits.Limits(),
+    cancel: threading.Event | None = None,
+    poll_interval: float = POLL_INTERVAL,
+) -> list[FieldResult]:
+    """renders the fields, in parallel on executor (if given)
+
+    Args:
+        found: the fields (see code_fields)
+        get_style: the style for a language alias
+        default_language: the alias for the fields with no language
+        executor: where to render, defaults to this thread
+        render_many: renders all the fields at once instead (see
+            server.RenderServer.render_many), the executor is the fallback
+        cache: the rendered fragments cache
+        size_limits: the fields too large are inserted as plain text
+        cancel: raises RenderCancelled once set (checked every poll_interval
+            seconds while waiting for the pool)
+    """
+    results = []
+    work: list[tuple[FieldResult, tuple[str, render_types.Style, bool]]] = []
+    for field in found:
+        result = FieldResult(field)
+        results.append(result)
+        assessment = limits.assess(field.source, size_limits)
+        if assessment.tier == limits.TIER_REFUSED:
+            result.error = limits.notice(assessment, size_limits)
+            continue
+        result.notice = limits.notice(assessment, size_limits)
+        source = field.source
+        if assessment.tier == limits.TIER_FULL:
+            language = languages.resolve_language(field.language, default_language)
+        else:
+            language = "text"
+        if assessment.tier == limits.TIER_TRUNCATED:
+            source = limits.truncate(source, size_limits, render_types.TRUNCATED)
+        style = get_style(language)
+        if cache is not None:
+            result.html = cache.get(
+                fragment_cache.make_key(source, style, centerfragments)
+            )
+            if result.html is not None:
+                continue
+        work.append((result, (source, style, centerfragments)))
+
+    futures: list[Any] = []
+    if render_many is not None and work:
+        try:
+            futures = list(render_many([args for _, args in work]))
+        except server.ServerUnavailable as exc:
+            log.warning("render server not available, using the pool: %s", exc)
+            render_many = None
+    for _, args in work[len(futures) :]:
+        future = None
+        if executor is not None:
+            try:
+                future = executor.submit(_render, args)
+            except (concurrent.futures.BrokenExecutor, RuntimeError) as exc:
+                # eg. a broken or shut down pool
+                log.warning("fields pool not available, rendering here: %s", exc)
+                executor = None
+        futures.append(future)
+
+    def check_cancel():
+        if cancel is not None and cancel.is_set():
+            for pending in futures:
+                if pending is not None:
+                    pending.cancel()
+            raise render_types.RenderCancelled()
+
+    for (result, args), future in zip(work, futures):
+        check_cancel()
+        try:
+            if future is None:
+                rendered = _render(args, cancel)
+            else:
+                while not concurrent.futures.wait([future], poll_interval).done:
+                    check_cancel()
+                rendered = future.result()
+                if render_many is not None:
+                    # (html, alias) from the server
+                    rendered = rendered[0]
+        except render_types.RenderCancelled:
+            raise
+        except render_types.RenderError as exc:
+            # the server raises the errors
+            rendered = exc
+        except (concurrent.futures.BrokenExecutor, server.ServerUnavailable):
+            rendered = _render(args, cancel)
+        if isinstance(rendered, render_types.RenderError):
+            result.error = render_types.error_message(rendered)
+            continue
+        result.html = rendered
+        if cache is not None:
+            cache.put(fragment_cache.make_key(*args), rendered)
+    return results
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+Content-addressed cache of the rendered fragments
+
+Fragments are keyed by a hash of the source text, the (frozen) Style, the
+wrapper options and the pygments version: they're kept in a size bounded
+in-memory LRU and, optionally, in a sqlite file surviving restarts.
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+from __future__ import annotations
+
+import collections
+import dataclasses as dc
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable
+
+from . import languages, render_types
+
+log = logging.getLogger(__name__)
+
+# the version of the fragments markup, changed when html_render output changes
+# (so the fragments on disk from a previous version are not reused)
+FORMAT = 2
+
+
+@dc.dataclass
+class CacheStats:
+    hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    bytes_saved: int = 0
+    memory_bytes: int = 0
+    disk_bytes: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def make_key(txt: str, style: render_types.Style, centerfragments: bool) -> str:
+    header = json.dumps(
+        [
+            FORMAT,
+            languages.pygments_version(),
+            dc.astuple(style),
+            bool(centerfragments),
+        ]
+    )
+    digest = hashlib.sha256(header.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(txt.encode("utf-8", "surrogatepass"))
+    return digest.hexdigest()
+
+
+class DiskStore:
+    """sqlite backed store, evicting the least recently used fragments"""
+
+    def __init__(self, path: str, maxbytes: int):
+        self.path = path
+        self.maxbytes = maxbytes
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS fragments ("
+            " key TEXT PRIMARY KEY, html TEXT, size INTEGER, atime REAL)"
+        )
+        self.db.commit()
+
+    def get(self, key: str) -> str | None:
+        row = self.db.execute(
+            "SELECT html FROM fragments WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        self.db.execute(
+            "UPDATE fragments SET atime = ? WHERE key = ?", (time.time(), key)
+        )
+        self.db.commit()
+        return row[0]
+
+    def put(self, key: str, html: str, size: int) -> None:
+        self.db.execute(
+            "INSERT OR REPLACE INTO fragments VALUES (?, ?, ?, ?)",
+            (key, html, size, time.time()),
+        )
+        total = self.size()
+        if total > self.maxbytes:
+            cursor = self.db.execute("SELECT key, size FROM fragments ORDER BY atime")
+            evicted = []
+            for old, old_size in cursor:
+                if total <= self.maxbytes:
+                    break
+                evicted.append((old,))
+                total -= old_size
+            self.db.executemany("DELETE FROM fragments WHERE key = ?", evicted)
+        self.db.commit()
+
+    def size(self) -> int:
+        query = "SELECT COALESCE(SUM(size), 0) FROM fragments"
+        return self.db.execute(query).fetchone()[0]
+
+    def clear(self) -> None:
+        self.db.execute("DELETE FROM fragments")
+        self.db.commit()
+
+    def close(self) -> None:
+        self.db.close()
+
+
+class FragmentCache:
+    """Cache in front of html_render.render_fragment
+
+    Args:
+        maxbytes: in-memory budget (utf-8 size of the fragments)
+        path: sqlite file for the persistent store (None to disable it)
+        maxdiskbytes: persistent store budget (0 disables it)
+    """
+
+    def __init__(
+        self,
+        maxbytes: int = 4 * 2**20,
+        path: str | None = None,
+        maxdiskbytes: int = 32 * 2**20,
+    ):
+        self.maxbytes = maxbytes
+        self.memory: collections.OrderedDict[
+            str, tuple[str, int]
+        ] = collections.OrderedDict()
+        self.stats_ = CacheStats()
+        self.disk: DiskStore | None = None
+        self._lock = threading.Lock()
+        if path and maxdiskbytes > 0:
+            try:
+                self.disk = DiskStore(path, maxdiskbytes)
+            except (OSError, sqlite3.Error) as exc:
+                log.warning("fragment cache disabled on disk (%s): %s", path, exc)
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            found = self.memory.get(key)
+            if found is not None:
+                self.memory.move_to_end(key)
+                self.stats_.hits += 1
+                self.stats_.bytes_saved += found[1]
+                return found[0]
+            if self.disk is not None:
+                try:
+                    html = self.disk.get(key)
+                except sqlite3.Error as exc:
+                    log.warning("fragment cache read failed: %s", exc)
+                    html = None
+                if html is not None:
+                    size = len(html.encode("utf-8"))
+                    self._remember(key, html, size)
+                    self.stats_.hits += 1
+                    self.stats_.disk_hits += 1
+                    self.stats_.bytes_saved += size
+                    return html
+            self.stats_.misses += 1
+            return None
+
+    def put(self, key: str, html: str) -> None:
+        size = len(html.encode("utf-8"))
+        with self._lock:
+            self._remember(key, html, size)
+            if self.disk is not None:
+                try:
+                    self.disk.put(key, html, size)
+                except sqlite3.Error as exc:
+                    log.warning("fragment cache write failed: %s", exc)
+
+    def _remember(self, key: str, html: str, size: int) -> None:
+        if key in self.memory:
+            self.stats_.memory_bytes -= self.memory.pop(key)[1]
+        if size > self.maxbytes:
+            return
+        self.memory[key] = (html, size)
+        self.stats_.memory_bytes += size
+        while self.stats_.memory_bytes > self.maxbytes:
+            _, (_, old_size) = self.memory.popitem(last=False)
+            self.stats_.memory_bytes -= old_size
+
+    def render(
+        self,
+        txt: str,
+        style: render_types.Style = render_types.Style(),
+        centerfragments: bool = False,
+        cancel: threading.Event | None = None,
+        render: Callable[..., str] | None = None,
+    ) -> str:
+        """the cached fragment, or the one from render (render_fragment)"""
+        key = make_key(txt, style, centerfragments)
+        html = self.get(key)
+        if html is None:
+            if render is None:
+                from . import html_render
+
+                render = html_render.render_fragment
+            html = render(txt, style, centerfragments, cancel)
+            self.put(key, html)
+        return html
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            stats = dc.replace(self.stats_)
+            if self.disk is not None:
+                stats.disk_bytes = self.disk.size()
+            return stats
+
+    def clear(self) -> None:
+        with self._lock:
+            self.memory.clear()
+            self.stats_ = CacheStats()
+            if self.disk is not None:
+                self.disk.clear()
@@ -3,56 +3,843 @@
 # from pygments.lexers import get_lexer_by_name, get_all_lexers
 #
 from __future__ import annotations
+import array
+import collections
+import contextlib
 import dataclasses as dc
+import functools
+import hashlib
+import html
+import io
+import itertools
+import re
+import sys
+import threading
+from typing import IO, Any, Callable, Iterable, Iterator
+
 import pygments
-import pygments.lexers
+from pygments.formatters.html import HtmlFormatter
+from pygments.lexer import RegexLexer
+from pygments.token import Error, Generic, Token, Whitespace, _TokenType
 
+from . import languages, metrics, styles
 
-@dc.dataclass
-class Style:
-    linenos: str = "inline"
-    noclasses: bool = True
-    style: str = "default"
-    language: str = "Python"
+# the types shared with the processes not loading pygments, see render_types.py
+from .render_types import (  # noqa: F401
+    TRUNCATED,
+    InvalidStyle,
+    LanguageNotFound,
+    RenderCancelled,
+    RenderError,
+    Style,
+)
 
 
-class RenderError(Exception):
-    def render(self) -> str:
-        raise NotImplementedError("adds .render method")
+class LexerRegistry:
+    """Lexer lookup and pooling
 
+    Aliases are resolved once to their lexer class (a dict lookup instead
+    of the pygments scan over all the lexers), and the lexer instances are
+    kept in a bounded LRU pool keyed by (alias, options).
 
-class LanguageNotFound(RenderError):
-    def render(self) -> str:
-        return f"""
-<b>Error</b>: Selected language '{self.args[0]}' not found.<br>
-If you set a custom lang selection please make sure<br>
-you typed all list entries correctly.
-"""
+    An instance is handed out to one caller at a time (see .lexer), so
+    concurrent renders never share the same lexer.
+    """
 
+    def __init__(self, maxsize: int = 16):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._classes: dict[str, type] = {}
+        self._idle: collections.OrderedDict[
+            tuple[str, tuple[tuple[str, Any], ...]], list[Any]
+        ] = collections.OrderedDict()
+        self._lock = threading.Lock()
 
-class InvalidStyle(LanguageNotFound):
-    def render(self) -> str:
-        return f"""
-<b>Error</b>: Selected style '{self.args[0]}' not found.<br>
-If you set a custom style please make sure<br>
-you typed it correctly.
-"""
+    def lexer_class(self, alias: str) -> type:
+        cls = self._classes.get(alias.lower())
+        if cls is None:
+            cls = languages.lexer_class(alias)
+            if cls is None:
+                raise LanguageNotFound(alias)
+            self._classes[alias.lower()] = cls
+        return cls
 
+    @contextlib.contextmanager
+    def lexer(self, alias: str, **options: Any) -> Iterator[Any]:
+        key = (alias.lower(), tuple(sorted(options.items())))
+        with self._lock:
+            idle = self._idle.get(key)
+            instance = idle.pop() if idle else None
+            if instance is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if instance is None:
+            instance = self.lexer_class(alias)(**options)
+        try:
+            yield instance
+        finally:
+            self._release(key, instance)
 
-def render_string(txt: str, style: Style = Style()) -> str:
-    from pygments.formatters import HtmlFormatter
-    from pygments import util
+    def _release(self, key, instance) -> None:
+        with self._lock:
+            self._idle.setdefault(key, []).append(instance)
+            self._idle.move_to_end(key)
+            size = sum(len(idle) for idle in self._idle.values())
+            while size > self.maxsize:
+                oldest = next(iter(self._idle))
+                self._idle[oldest].pop(0)
+                if not self._idle[oldest]:
+                    del self._idle[oldest]
+                size -= 1
 
-    try:
-        lexer = pygments.lexers.get_lexer_by_name(style.language, stripall=True)
-    except util.ClassNotFound as exc:
-        raise LanguageNotFound(style.language) from exc
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": sum(len(idle) for idle in self._idle.values()),
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._idle.clear()
+            self._classes.clear()
+            self.hits = self.misses = 0
+
+
+LEXERS = LexerRegistry()
+
+
+# Token streams cache: the options changing the most (style, line numbers,
+# css classes, centering) only change the formatting, so an option toggle
+# (or a re-style) re-formats the cached tokens instead of lexing again
+
+# the interned token types (a TokenStream stores their indexes)
+_token_types: list[_TokenType] = []
+_token_indexes: dict[_TokenType, int] = {}
+_token_lock = threading.Lock()
+
+
+def _intern(ttype: _TokenType) -> int:
+    index = _token_indexes.get(ttype)
+    if index is None:
+        with _token_lock:
+            index = _token_indexes.setdefault(ttype, len(_token_types))
+            if index == len(_token_types):
+                _token_types.append(ttype)
+    return index
+
+
+@dc.dataclass(frozen=True)
+class TokenStream:
+    """the lexed tokens, as offsets into their text (no substrings kept)"""
+
+    text: str  # the token values joined
+    types: array.array  # the interned token types
+    ends: array.array  # the token end offsets in text
+
+    def __iter__(self) -> Iterator[tuple[_TokenType, str]]:
+        text, types = self.text, _token_types
+        start = 0
+        for index, end in zip(self.types, self.ends):
+            yield types[index], text[start:end]
+            start = end
+
+    def __len__(self) -> int:
+        return len(self.types)
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            sys.getsizeof(self.text)
+            + self.types.itemsize * len(self.types)
+            + self.ends.itemsize * len(self.ends)
+        )
+
+    @classmethod
+    def from_tokens(cls, tokens: Iterable[tuple[_TokenType, str]]) -> TokenStream:
+        ttypes, values = tuple(zip(*tokens)) or ((), ())
+        for ttype in set(ttypes).difference(_token_indexes):
+            _intern(ttype)
+        # no per token python code
+        types = array.array("H", map(_token_indexes.__getitem__, ttypes))
+        ends = array.array("I", itertools.accumulate(map(len, values)))
+        return cls("".join(values), types, ends)
+
+
+def _record(tokens, found: list[TokenStream]):
+    """yields tokens, then appends them (as a TokenStream) to found"""
+    collected: list[tuple[_TokenType, str]] = []
+    append = collected.append
+    for token in tokens:
+        append(token)
+        yield token
+    found.append(TokenStream.from_tokens(collected))
+
+
+class TokenCache:
+    """LRU cache of the TokenStreams by (source hash, language)
+
+    Bounded by maxbytes (TokenStream.nbytes), sources longer than maxchars
+    are not cached. The tokens are the ones of the html_render lexers (with
+    stripall=True).
+    """
+
+    def __init__(self, maxbytes: int = 16 * 2**20, maxchars: int = 2**20):
+        self.maxbytes = maxbytes
+        self.maxchars = maxchars
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._streams: collections.OrderedDict[
+            tuple[bytes, str], TokenStream
+        ] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(txt: str, language: str) -> tuple[bytes, str]:
+        digest = hashlib.blake2b(txt.encode("utf-8", "surrogatepass"), digest_size=16)
+        return digest.digest(), language.lower()
+
+    def get(self, txt: str, language: str) -> TokenStream | None:
+        key = self.key(txt, language)
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is None:
+                self.misses += 1
+                return None
+            self._streams.move_to_end(key)
+            self.hits += 1
+            return stream
+
+    def put(self, txt: str, language: str, stream: TokenStream) -> None:
+        if len(txt) > self.maxchars or stream.nbytes > self.maxbytes:
+            return
+        key = self.key(txt, language)
+        with self._lock:
+            old = self._streams.pop(key, None)
+            if old is not None:
+                self.size -= old.nbytes
+            self._streams[key] = stream
+            self.size += stream.nbytes
+            while self.size > self.maxbytes:
+                _, oldest = self._streams.popitem(last=False)
+                self.size -= oldest.nbytes
+
+    def tokens(
+        self, txt: str, language: str, lex: Callable[[str], Iterable[tuple]]
+    ) -> Iterator[tuple[_TokenType, str]]:
+        """the cached tokens of txt, or lex(txt) (cached once all consumed)"""
+        if len(txt) > self.maxchars:
+            yield from lex(txt)
+            return
+        stream = self.get(txt, language)
+        if stream is not None:
+            yield from stream
+            return
+        found: list[TokenStream] = []
+        yield from _record(lex(txt), found)
+        self.put(txt, language, found[0])
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": self.size,
+                "streams": len(self._streams),
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._streams.clear()
+            self.size = self.hits = self.misses = 0
+
+
+TOKENS = TokenCache()
+
+
+CSS_HEX_RE = re.compile(r"#([0-9a-fA-F])\1([0-9a-fA-F])\2([0-9a-fA-F])\3\b")
+
+
+def compact_css(css: str) -> str:
+    """shortens the inline css, eg. "color: #008800; font-weight: bold;" """
+    items = (item.partition(":") for item in css.split(";"))
+    css = ";".join(f"{k.strip()}:{v.strip()}" for k, _, v in items if k.strip())
+    return CSS_HEX_RE.sub(r"#\1\2\3", css)
+
+
+ANKI_ESCAPES = (("{{", "{<!---->{"), ("}}", "}<!---->}"), ("::", ":<!---->:"))
+
+
+def anki_escape(text: str) -> str:
+    """breaks every "{{", "}}" and "::" with an invisible html comment"""
+    for pattern, replacement in ANKI_ESCAPES:
+        if pattern in text:
+            # twice, for the runs like "}}}"
+            text = text.replace(pattern, replacement).replace(pattern, replacement)
+    return text
+
+
+class _HtmlFormatter(HtmlFormatter):
+    """HtmlFormatter yielding its output piece by piece (see iter_unencoded)
+
+    The inline line numbers are normally padded buffering all the lines to
+    count them, so the width can be given upfront with linenos_width.
+
+    With anki=True the output is a note fragment: the "{{", "}}" and "::"
+    sequences are escaped on the token text while formatting (so never in
+    tags or attributes) and the table (or centered table) wrapper is added.
+    The language given to iter_unencoded (or iter_wrapped) is recorded in
+    the data-language attribute of the highlight div (see restyle.py).
+
+    With compact=True the output is smaller but renders the same: the
+    whitespace tokens join the span before them (or get none), the adjacent
+    tokens with the same style share a span and the inline css is shortened.
+    """
+
+    # set by _create_stylesheet: class name -> (css, token type, level)
+    class2style: dict[str, tuple[str, Any, int]]
+
+    def __init__(
+        self,
+        linenos_width: int | None = None,
+        anki: bool = False,
+        centerfragments: bool = False,
+        compact: bool = False,
+        **options,
+    ):
+        # the precomputed tables, see _create_stylesheet
+        self.table = None
+        if isinstance(options.get("style"), str) and not options.get("classprefix"):
+            self.table = styles.table(options["style"])
+        super().__init__(**options)
+        self.linenos_width = linenos_width
+        self.anki = anki
+        self.centerfragments = centerfragments
+        self.compact = compact
+        # token type -> _invisible_on_blanks
+        self._invisible: dict[Any, bool] = {}
+        if compact:
+            self.class2style = {
+                name: (compact_css(css), *rest)
+                for name, (css, *rest) in self.class2style.items()
+            }
+
+    def _create_stylesheet(self):
+        if self.table is None:
+            return super()._create_stylesheet()
+        self.ttype2class = self.table.ttype2class
+        self.class2style = self.table.class2style
+
+    @property
+    def _pre_style(self):
+        style = super()._pre_style
+        return compact_css(style) if self.compact else style
+
+    def _compact_linenos_style(self, style: str) -> str:
+        # drop the no-op defaults (see Style.line_number_color)
+        for noop in ("color: inherit;", "background-color: transparent;"):
+            style = style.replace(noop, "")
+        return compact_css(style)
+
+    @property
+    def _linenos_style(self):
+        style = super()._linenos_style
+        return self._compact_linenos_style(style) if self.compact else style
+
+    @property
+    def _linenos_special_style(self):
+        style = super()._linenos_special_style
+        return self._compact_linenos_style(style) if self.compact else style
+
+    def _invisible_on_blanks(self, ttype) -> bool:
+        # a style without visible effects on whitespace
+        invisible = self._invisible.get(ttype)
+        if invisible is None:
+            styled = ttype
+            while styled not in self.style._styles:
+                styled = styled.parent
+            ndef = self.style.style_for_token(styled)
+            invisible = not (ndef["bgcolor"] or ndef["underline"] or ndef["border"])
+            self._invisible[ttype] = invisible
+        return invisible
+
+    def _compact_tokens(self, tokensource):
+        last = None  # the type of the last visible token on the line
+        for ttype, value in tokensource:
+            if value.isspace() and self._invisible_on_blanks(ttype):
+                if last is not None and self._invisible_on_blanks(last):
+                    ttype = last
+                else:
+                    ttype = Token
+            else:
+                last = ttype
+            if "\n" in value:
+                last = None
+            yield ttype, value
+
+    def _span_opener(self, ttype) -> str:
+        # the same span HtmlFormatter._format_lines opens for ttype
+        cspan = self.span_element_openers.get(ttype)
+        if cspan is None:
+            title = f' title="{".".join(ttype)}"' if self.debug_token_types else ""
+            if self.noclasses:
+                css_style = self._get_css_inline_styles(ttype)
+                if css_style:
+                    css_style = self.class2style[css_style][0]
+                    cspan = f'<span style="{css_style}"{title}>'
+                else:
+                    cspan = ""
+            else:
+                css_class = self._get_css_classes(ttype)
+                cspan = f'<span class="{css_class}"{title}>' if css_class else ""
+            self.span_element_openers[ttype] = cspan
+        return cspan
 
+    def _merge_spans(self, tokensource):
+        # joins the consecutive tokens ending up in the same span, so no
+        # "{{" can be split across them without any markup inbetween
+        run_type, run = None, []
+        for ttype, value in tokensource:
+            if run and self._span_opener(ttype) != self._span_opener(run_type):
+                yield run_type, "".join(run)
+                run = []
+            if not run:
+                run_type = ttype
+            run.append(value)
+        if run:
+            yield run_type, "".join(run)
+
+    def _format_lines(self, tokensource):
+        if self.compact:
+            tokensource = self._compact_tokens(tokensource)
+        if self.anki:
+            tokensource = self._merge_spans(tokensource)
+        return super()._format_lines(tokensource)
+
+    @functools.lru_cache(maxsize=100)
+    def _translate_parts(self, value):
+        parts = super()._translate_parts(value)
+        if self.anki:
+            parts = [anki_escape(part) for part in parts]
+        return parts
+
+    def _wrap_fragment(self, inner):
+        prefix, suffix = "<table><tbody><tr><td>", "</td></tr></tbody></table>"
+        if self.centerfragments:
+            prefix, suffix = f"<center>{prefix}", f"{suffix}</center>"
+        yield 0, prefix
+        yield from inner
+        yield 0, suffix
+
+    def _wrap_language(self, inner, language):
+        # the div start tag is the first piece
+        inner = iter(inner)
+        for t, piece in inner:
+            yield t, f'{piece[:-1]} data-language="{html.escape(language)}">'
+            break
+        yield from inner
+
+    def _wrap_inlinelinenos(self, inner):
+        if self.linenos_width is None:
+            yield from super()._wrap_inlinelinenos(inner)
+            return
+
+        num = self.linenostart
+        for _, inner_line in inner:
+            line = "%*d" % (self.linenos_width, num)
+            if num % self.linenostep:
+                line = " " * self.linenos_width
+            special = self.linenospecial and num % self.linenospecial == 0
+            if self.noclasses:
+                linenos_style = (
+                    self._linenos_special_style if special else self._linenos_style
+                )
+                line = f'<span style="{linenos_style}">{line}</span>'
+            else:
+                cls = "linenos special" if special else "linenos"
+                line = f'<span class="{cls}">{line}</span>'
+            yield 1, line + inner_line
+            num += 1
+
+    def iter_unencoded(self, tokensource, language: str = "") -> Iterator[str]:
+        # same as HtmlFormatter.format_unencoded (without the full document)
+        return self.iter_wrapped(self._format_lines(tokensource), language)
+
+    def iter_wrapped(self, source, language: str = "") -> Iterator[str]:
+        """wraps the formatted lines, (1, line html) from _format_lines"""
+        if not self.nowrap and self.linenos == 2:
+            source = self._wrap_inlinelinenos(source)
+        if self.hl_lines:
+            source = self._highlight_lines(source)
+        if not self.nowrap:
+            if self.lineanchors:
+                source = self._wrap_lineanchors(source)
+            if self.linespans:
+                source = self._wrap_linespans(source)
+            source = self.wrap(source)
+            if self.linenos == 1:
+                source = self._wrap_tablelinenos(source)
+            source = self._wrap_div(source)
+            if self.anki and language:
+                source = self._wrap_language(source, language)
+        if self.anki:
+            source = self._wrap_fragment(source)
+        for _, piece in source:
+            yield piece
+
+    def format_unencoded(self, tokensource, outfile):
+        if self.full:
+            return super().format_unencoded(tokensource, outfile)
+        for piece in self.iter_unencoded(tokensource):
+            outfile.write(piece)
+
+
+def get_formatter(style: Style, **options) -> _HtmlFormatter:
+    """a (cached, shared) formatter for style, the language is not relevant"""
+    style = dc.replace(style, language="")
+    return _get_formatter(style, tuple(sorted(options.items())))
+
+
+@functools.lru_cache(maxsize=64)
+def _get_formatter(style: Style, options: tuple) -> _HtmlFormatter:
+    from pygments import util
+
+    kwargs = dict(options)
     try:
-        formatter = HtmlFormatter(
-            linenos=style.linenos, noclasses=style.noclasses, style=style.style
+        return _HtmlFormatter(
+            linenos=style.linenos,
+            noclasses=style.noclasses,
+            style=style.style,
+            compact=style.compact,
+            **kwargs,
         )
     except util.ClassNotFound as exc:
         raise InvalidStyle(style.style) from exc
 
-    return pygments.highlight(txt, lexer, formatter)
+
+def render_string(txt: str, style: Style = Style()) -> str:
+    with LEXERS.lexer(style.language, stripall=True) as lexer:
+        formatter = get_formatter(style)
+        tokens = TOKENS.tokens(txt, style.language, lexer.get_tokens)
+        return pygments.format(tokens, formatter)
+
+
+def render_fragment(
+    txt: str,
+    style: Style = Style(),
+    centerfragments: bool = False,
+    cancel: threading.Event | None = None,
+) -> str:
+    """renders txt wrapped in the table (or centered table) ready for a note
+
+    With a cancel event the rendering is done in chunks, raising
+    RenderCancelled as soon as the event is set (eg. from another thread).
+    """
+    if cancel is not None:
+        chunks = []
+        for chunk in render_fragment_iter(txt, style, centerfragments):
+            if cancel.is_set():
+                raise RenderCancelled()
+            chunks.append(chunk)
+        return "".join(chunks)
+
+    with LEXERS.lexer(style.language, stripall=True) as lexer:
+        formatter = get_formatter(style, anki=True, centerfragments=centerfragments)
+        tokens = TOKENS.tokens(txt, style.language, lexer.get_tokens)
+        return "".join(formatter.iter_unencoded(tokens, style.language))
+
+
+@dc.dataclass
+class SizeReport:
+    original: int
+    compact: int
+
+    @property
+    def saved(self) -> int:
+        return self.original - self.compact
+
+    @property
+    def ratio(self) -> float:
+        return self.saved / self.original if self.original else 0.0
+
+
+def size_report(
+    txt: str, style: Style = Style(), centerfragments: bool = False
+) -> SizeReport:
+    """utf-8 size of the fragment for txt, without and with compact output"""
+    sizes = []
+    for compact in (False, True):
+        html = render_fragment(txt, dc.replace(style, compact=compact), centerfragments)
+        sizes.append(len(html.encode("utf-8")))
+    return SizeReport(*sizes)
+
+
+def process_html(html):
+    """Modify highlighter output to address some Anki idiosyncracies
+
+    NOTE: render_fragment does this while formatting, this is for html
+          coming from elsewhere.
+    """
+    # 1.) "Escape" curly bracket sequences reserved to Anki's card template
+    # system by placing an invisible html tag inbetween
+    return anki_escape(html)
+
+
+# Streaming rendering (for very large inputs)
+
+CHUNK_SIZE = 64 * 1024
+LOOKAHEAD = 4096
+
+
+def _read_chunks(
+    stream: IO[str],
+    chunk_size: int,
+    max_bytes: int | None,
+    max_lines: int | None,
+    truncated: list[bool],
+) -> Iterator[str]:
+    """reads stream in chunks of whole lines, up to the byte/line caps"""
+    chunk: list[str] = []
+    size = nbytes = nlines = 0
+    newline = True
+    while True:
+        line = stream.readline(chunk_size)
+        if not line:
+            break
+        nlines += newline
+        newline = line.endswith("\n")
+        nbytes += len(line.encode("utf-8"))
+        if (max_lines is not None and nlines > max_lines) or (
+            max_bytes is not None and nbytes > max_bytes
+        ):
+            truncated.append(True)
+            break
+        chunk.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield "".join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield "".join(chunk)
+
+
+def _preprocess_chunks(lexer, chunks: Iterable[str]) -> Iterator[str]:
+    """same as Lexer._preprocess_lexer_input, but chunk by chunk"""
+    first = True
+    started = False
+    trailing = ""  # whitespace held back until we know it's not at the end
+    pending_cr = False
+    last = ""
+    for chunk in chunks:
+        if first and chunk.startswith("\ufeff"):
+            chunk = chunk[1:]
+        first = False
+        if pending_cr:
+            chunk = "\r" + chunk
+        pending_cr = chunk.endswith("\r")
+        if pending_cr:
+            chunk = chunk[:-1]
+        chunk = chunk.replace("\r\n", "\n").replace("\r", "\n")
+        if lexer.tabsize > 0:
+            chunk = chunk.expandtabs(lexer.tabsize)
+        if not started:
+            if lexer.stripall:
+                chunk = chunk.lstrip()
+            elif lexer.stripnl:
+                chunk = chunk.lstrip("\n")
+            started = bool(chunk)
+        chunk = trailing + chunk
+        if lexer.stripall:
+            body = chunk.rstrip()
+        elif lexer.stripnl:
+            body = chunk.rstrip("\n")
+        else:
+            body = chunk
+        trailing = chunk[len(body) :]
+        if body:
+            last = body[-1]
+            yield body
+    if pending_cr:
+        trailing += "\n"
+    if trailing and not (lexer.stripall or lexer.stripnl):
+        last = trailing[-1]
+        yield trailing
+    if lexer.ensurenl and last != "\n":
+        yield "\n"
+
+
+def change_state(statestack: list[str], new_state) -> None:
+    """applies a RegexLexer rule new_state to statestack (in place)"""
+    if isinstance(new_state, tuple):
+        for state in new_state:
+            if state == "#pop":
+                if len(statestack) > 1:
+                    statestack.pop()
+            elif state == "#push":
+                statestack.append(statestack[-1])
+            else:
+                statestack.append(state)
+    elif isinstance(new_state, int):
+        if abs(new_state) >= len(statestack):
+            del statestack[1:]
+        else:
+            del statestack[new_state:]
+    elif new_state == "#push":
+        statestack.append(statestack[-1])
+
+
+def _lex_chunks(lexer, chunks: Iterable[str], lookahead: int) -> Iterator[tuple]:
+    """RegexLexer.get_tokens_unprocessed carrying its state across chunks
+
+    The text is kept in a sliding window: a new chunk is appended as soon as
+    less than lookahead characters are left, so tokens can span the chunks.
+    """
+    tokendefs = lexer._tokens
+    statestack = ["root"]
+    statetokens = tokendefs["root"]
+    chunks = iter(chunks)
+    text = ""
+    pos = 0
+    final = False
+    while True:
+        while not final and len(text) - pos < lookahead:
+            chunk = next(chunks, None)
+            if chunk is None:
+                final = True
+            else:
+                text, pos = text[pos:] + chunk, 0
+        for rexmatch, action, new_state in statetokens:
+            m = rexmatch(text, pos)
+            if m:
+                if action is not None:
+                    if type(action) is _TokenType:
+                        yield action, m.group()
+                    else:
+                        for _, ttype, value in action(lexer, m):
+                            yield ttype, value
+                pos = m.end()
+                if new_state is not None:
+                    change_state(statestack, new_state)
+                    statetokens = tokendefs[statestack[-1]]
+                break
+        else:
+            if pos >= len(text):
+                break
+            if text[pos] == "\n":
+                # at EOL, reset state to "root"
+                statestack = ["root"]
+                statetokens = tokendefs["root"]
+                yield Whitespace, "\n"
+            else:
+                yield Error, text[pos]
+            pos += 1
+
+
+def _stream_tokens(
+    lexer,
+    stream: IO[str],
+    chunk_size: int,
+    caps: tuple[int | None, int | None],
+    truncated: list[bool],
+):
+    from pygments.filter import apply_filters
+
+    max_bytes, max_lines = caps
+    chunks = _read_chunks(stream, chunk_size, max_bytes, max_lines, truncated)
+    if type(lexer).get_tokens_unprocessed is not RegexLexer.get_tokens_unprocessed:
+        # this lexer can't be resumed: lex it in one go
+        yield from lexer.get_tokens("".join(chunks))
+        return
+    lookahead = max(chunk_size, LOOKAHEAD)
+    tokens = _lex_chunks(lexer, _preprocess_chunks(lexer, chunks), lookahead)
+    yield from apply_filters(tokens, lexer.filters, lexer)
+
+
+def _count_lines(stream: IO[str], max_lines: int | None) -> int | None:
+    if not stream.seekable():
+        return max_lines
+    start = stream.tell()
+    count = 0
+    for count, _ in enumerate(stream, 1):
+        if max_lines is not None and count > max_lines:
+            break
+    stream.seek(start)
+    return count
+
+
+def render_iter(
+    source: str | IO[str],
+    style: Style = Style(),
+    *,
+    chunk_size: int = CHUNK_SIZE,
+    max_bytes: int | None = None,
+    max_lines: int | None = None,
+    formatter_options: dict[str, Any] | None = None,
+) -> Iterator[str]:
+    """Same as render_string, yielding the html in chunks
+
+    source can be a string or a text stream (read line by line): the lexer
+    state is carried across the chunks, so the memory peak is bounded by
+    chunk_size and not by the input size (except for the lexers that cannot
+    be resumed, and for the table line numbers). The inline line numbers
+    are not padded if the stream is not seekable.
+
+    Once max_bytes (utf-8) or max_lines of source are reached, the rendering
+    stops at the previous line, followed by a TRUNCATED marker line.
+    """
+    if isinstance(source, str):
+        if max_bytes is None and max_lines is None:
+            nlines = source.strip().count("\n") + 1
+        else:
+            nlines = None
+            source = io.StringIO(source)
+    else:
+        nlines = None
+
+    truncated: list[bool] = []
+    with LEXERS.lexer(style.language, stripall=True) as lexer:
+        if isinstance(source, str):
+            tokens = TOKENS.tokens(source, style.language, lexer.get_tokens)
+        else:
+            nlines = _count_lines(source, max_lines)
+            caps = (max_bytes, max_lines)
+            tokens = _stream_tokens(lexer, source, chunk_size, caps, truncated)
+
+        def marked(tokens):
+            yield from tokens
+            if truncated:
+                yield Generic.Error, TRUNCATED + "\n"
+
+        # unknown number of lines (unseekable stream): no padding
+        width = len(str(nlines)) if nlines is not None else 0
+        formatter = get_formatter(
+            style, linenos_width=width, **(formatter_options or {})
+        )
+
+        buffer: list[str] = []
+        size = 0
+        # the lexing time, when measured (see metrics.lexing)
+        tokens = metrics.timed_tokens(tokens)
+        for piece in formatter.iter_unencoded(marked(tokens), style.language):
+            buffer.append(piece)
+            size += len(piece)
+            if size >= chunk_size:
+                yield "".join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield "".join(buffer)
+
+
+def render_fragment_iter(
+    source: str | IO[str],
+    style: Style = Style(),
+    centerfragments: bool = False,
+    **kwargs,
+) -> Iterator[str]:
+    """Same as render_fragment, yielding the html in chunks (see render_iter)"""
+    options = {"anki": True, "centerfragments": centerfragments}
+    return render_iter(source, style, formatter_options=options, **kwargs)
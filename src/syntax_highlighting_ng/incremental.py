@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+Incremental re-highlighting of edited code blocks
+
+A rendered block keeps its source lines, the html of each line and the lexer
+state (the RegexLexer state stack) at the start of each line. Rendering an
+edited copy of it re-lexes from the closest line before the first change and
+stops as soon as, past the last change, a line starts in the same state as
+in the previous run: from there on the tokens can't differ. The html of all
+the other lines is reused, only the wrapping (line numbers, table) is redone.
+
+Incremental keeps the last rendered blocks and renders a new text from the
+most similar one (eg. a large snippet pasted again with a typo fixed).
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+from __future__ import annotations
+
+import collections
+import dataclasses as dc
+import logging
+import threading
+from typing import Any, Iterator, Optional, Tuple
+
+from pygments.lexer import RegexLexer
+from pygments.token import Error, Whitespace, _TokenType
+
+from . import html_render, metrics
+
+log = logging.getLogger(__name__)
+
+# smaller blocks are rendered in one go
+MIN_LINES = 200
+# lines lexed between the checks of the cancel event
+CANCEL_CHECK_LINES = 500
+
+# the state stack at the start of a line, None if it starts inside a token
+State = Optional[Tuple[str, ...]]
+
+
+@dc.dataclass
+class Block:
+    style: html_render.Style
+    centerfragments: bool
+    lines: list[str]  # the preprocessed source lines (with the newline)
+    states: list[State]
+    html_lines: list[str]  # from _format_lines (no line numbers)
+    html: str
+    relexed: int = 0  # lines lexed to render this block
+
+    @property
+    def incremental(self) -> bool:
+        # False for the lexers that cannot be resumed
+        return bool(self.states)
+
+
+def _resumable(lexer) -> bool:
+    return (
+        type(lexer).get_tokens_unprocessed is RegexLexer.get_tokens_unprocessed
+        and not lexer.filters
+    )
+
+
+def _preprocess(lexer, txt: str) -> str:
+    # the same text lexer.get_tokens lexes
+    return "".join(html_render._preprocess_chunks(lexer, [txt]))
+
+
+def _shared(old: list[str], new: list[str]) -> tuple[int, int]:
+    """the number of equal leading and trailing lines"""
+    limit = min(len(old), len(new))
+    prefix = 0
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    return prefix, suffix
+
+
+def _lex(
+    lexer,
+    text: str,
+    starts: list[int],
+    first: int,
+    stack: State,
+    cancel: threading.Event | None,
+) -> Iterator[tuple[Any, Any]]:
+    """RegexLexer.get_tokens_unprocessed from the line first (in stack state)
+
+    Yields the tokens and, at every line start reached, (None, (line, state)).
+    """
+    tokendefs = lexer._tokens
+    statestack = list(stack or ("root",))
+    statetokens = tokendefs[statestack[-1]]
+    line = first + 1
+    pos = starts[first]
+    end = len(text)
+    while pos < end:
+        for rexmatch, action, new_state in statetokens:
+            m = rexmatch(text, pos)
+            if m:
+                if action is not None:
+                    if type(action) is _TokenType:
+                        yield action, m.group()
+                    else:
+                        for _, ttype, value in action(lexer, m):
+                            yield ttype, value
+                pos = m.end()
+                if new_state is not None:
+                    html_render.change_state(statestack, new_state)
+                    statetokens = tokendefs[statestack[-1]]
+                break
+        else:
+            if text[pos] == "\n":
+                # at EOL, reset state to "root"
+                statestack = ["root"]
+                statetokens = tokendefs["root"]
+                yield Whitespace, "\n"
+            else:
+                yield Error, text[pos]
+            pos += 1
+
+        while line < len(starts) and starts[line] <= pos:
+            yield None, (line, tuple(statestack) if starts[line] == pos else None)
+            if (
+                line % CANCEL_CHECK_LINES == 0
+                and cancel is not None
+                and cancel.is_set()
+            ):
+                raise html_render.RenderCancelled()
+            line += 1
+
+
+def render_block(
+    txt: str,
+    style: html_render.Style = html_render.Style(),
+    centerfragments: bool = False,
+    previous: Block | None = None,
+    cancel: threading.Event | None = None,
+) -> Block:
+    """renders txt, reusing what's unchanged from previous (if given)
+
+    The html is the same as html_render.render_fragment.
+    """
+    if previous is not None and (
+        previous.style != style
+        or previous.centerfragments != centerfragments
+        or not previous.incremental
+    ):
+        previous = None
+
+    with html_render.LEXERS.lexer(style.language, stripall=True) as lexer:
+        if not _resumable(lexer):
+            html = html_render.render_fragment(txt, style, centerfragments, cancel)
+            return Block(style, centerfragments, [], [], [], html)
+
+        text = _preprocess(lexer, txt)
+        lines = text.splitlines(keepends=True)
+        if previous is not None and previous.lines == lines:
+            return dc.replace(previous, relexed=0)
+
+        starts = [0]
+        for line in lines[:-1]:
+            starts.append(starts[-1] + len(line))
+        first, delta, converge = 0, 0, len(lines)
+        if previous is not None:
+            prefix, suffix = _shared(previous.lines, lines)
+            # from the last line starting in a known state before the change,
+            # one line back: a rule lookahead can read past the end of a line
+            first = max(i for i in range(max(prefix - 1, 0) + 1) if previous.states[i])
+            delta = len(lines) - len(previous.lines)
+            converge = len(lines) - suffix
+
+        # the lexer states of the lines first..last (excluded)
+        states: list[State] = [previous.states[first] if previous else ("root",)]
+        tokens = []
+        last = len(lines)
+        lexed = _lex(lexer, text, starts, first, states[0], cancel)
+        for ttype, value in metrics.timed_tokens(lexed):
+            if ttype is not None:
+                tokens.append((ttype, value))
+                continue
+            line, state = value
+            if (
+                previous is not None
+                and state is not None
+                and line >= converge
+                and previous.states[line - delta] == state
+            ):
+                # the same state on the same text: the same tokens from here
+                last = line
+                break
+            states.append(state)
+
+        formatter = html_render.get_formatter(
+            style, anki=True, centerfragments=centerfragments
+        )
+        formatted = [html for _, html in formatter._format_lines(iter(tokens))]
+        if previous is not None:
+            formatted = [
+                *previous.html_lines[:first],
+                *formatted,
+                *previous.html_lines[last - delta :],
+            ]
+            states = [
+                *previous.states[:first],
+                *states,
+                *previous.states[last - delta :],
+            ]
+        html = "".join(
+            formatter.iter_wrapped(((1, h) for h in formatted), style.language)
+        )
+        if previous is None:
+            # all the tokens: a style change can re-format them
+            stream = html_render.TokenStream.from_tokens(tokens)
+            html_render.TOKENS.put(txt, style.language, stream)
+    return Block(style, centerfragments, lines, states, formatted, html, last - first)
+
+
+class Incremental:
+    """renders the texts from the most similar of the last rendered blocks
+
+    Args:
+        maxsize: the blocks kept
+        min_lines: smaller texts are rendered (and kept) as usual
+    """
+
+    def __init__(self, maxsize: int = 8, min_lines: int = MIN_LINES):
+        self.maxsize = maxsize
+        self.min_lines = min_lines
+        self.blocks: collections.deque[Block] = collections.deque(maxlen=maxsize)
+        self.lines = self.relexed = 0
+        self._lock = threading.Lock()
+
+    def _closest(
+        self, txt: str, style: html_render.Style, centerfragments: bool
+    ) -> Block | None:
+        lines = txt.splitlines(keepends=True)
+        best, best_shared = None, len(lines) // 2
+        with self._lock:
+            blocks = list(self.blocks)
+        for block in blocks:
+            if block.style != style or block.centerfragments != centerfragments:
+                continue
+            shared = sum(_shared(block.lines, lines))
+            if shared > best_shared:
+                best, best_shared = block, shared
+        return best
+
+    def render(
+        self,
+        txt: str,
+        style: html_render.Style = html_render.Style(),
+        centerfragments: bool = False,
+        cancel: threading.Event | None = None,
+    ) -> str:
+        """same as html_render.render_fragment"""
+        if txt.count("\n") < self.min_lines:
+            return html_render.render_fragment(txt, style, centerfragments, cancel)
+        previous = self._closest(txt, style, centerfragments)
+        if previous is None and html_render.TOKENS.get(txt, style.language):
+            # eg. the same text with other options: no need to lex it again
+            return html_render.render_fragment(txt, style, centerfragments, cancel)
+        block = render_block(txt, style, centerfragments, previous, cancel)
+        log.debug(
+            "rendered %d lines, %d lexed (from a previous block: %s)",
+            len(block.lines),
+            block.relexed,
+            previous is not None,
+        )
+        with self._lock:
+            self.lines += len(block.lines)
+            self.relexed += block.relexed
+            if block.incremental:
+                # replaces the block it was rendered from
+                for index, old in enumerate(self.blocks):
+                    if old is previous:
+                        del self.blocks[index]
+                        break
+                self.blocks.append(block)
+        return block.html
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+Precomputed index of the pygments lexers
+
+The index is generated once (make.py languages, or on first run) and stored
+as a compact json file next to the add-on, so at startup we don't need to
+walk all the registered lexers and the plugin entry points.
+
+On top of it there's the (cached) markup for the editor language combobox
+and a search index for the type-ahead language picker.
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+from __future__ import annotations
+
+import bisect
+import dataclasses as dc
+import fnmatch
+import functools
+import html
+import importlib
+import importlib.metadata
+import json
+import logging
+import os
+import sys
+from typing import Callable, Sequence
+
+from . import consts
+
+log = logging.getLogger(__name__)
+
+INDEX_PATH = os.path.join(consts.addon_path, "languages.json")
+
+
+@dc.dataclass(frozen=True)
+class LexerInfo:
+    classname: str
+    module: str
+    name: str
+    aliases: tuple[str, ...]
+    filenames: tuple[str, ...]
+    mimetypes: tuple[str, ...]
+
+
+@dc.dataclass
+class LanguageIndex:
+    version: str
+    lexers: list[LexerInfo]
+
+    @functools.cached_property
+    def names(self) -> dict[str, str]:
+        """maps the language names to their first alias"""
+        return {lex.name: lex.aliases[0] for lex in self.lexers if lex.aliases}
+
+    @functools.cached_property
+    def aliases(self) -> dict[str, LexerInfo]:
+        """maps every alias to its lexer (first registered wins)"""
+        result: dict[str, LexerInfo] = {}
+        for lex in self.lexers:
+            for alias in lex.aliases:
+                result.setdefault(alias, lex)
+        return result
+
+    @functools.cached_property
+    def _filenames(self) -> tuple[dict[str, list[str]], list[tuple[str, str]]]:
+        # ({"py": ["python", ..], ..}, [("Makefile", "make"), ..])
+        extensions: dict[str, list[str]] = {}
+        patterns: list[tuple[str, str]] = []
+        for lex in self.lexers:
+            if not lex.aliases:
+                continue
+            for pattern in lex.filenames:
+                ext = pattern[2:]
+                if pattern.startswith("*.") and not any(c in ext for c in "*?["):
+                    extensions.setdefault(ext, []).append(lex.aliases[0])
+                else:
+                    patterns.append((pattern, lex.aliases[0]))
+        return extensions, patterns
+
+    def for_filename(self, filename: str) -> list[str]:
+        """aliases of the lexers for filename (a basename), best first
+
+        The longest extension wins (eg. "html.j2" over "j2"), then the plain
+        lexers come before the combined ones (eg. "sql" before "sql+jinja").
+        """
+        extensions, patterns = self._filenames
+        found: list[str] = []
+        for index, char in enumerate(filename):
+            if char == "." and filename[index + 1 :] in extensions:
+                found = extensions[filename[index + 1 :]]
+                break
+        else:
+            found = [a for p, a in patterns if fnmatch.fnmatchcase(filename, p)]
+        return sorted(dict.fromkeys(found), key=lambda alias: "+" in alias)
+
+    def dumps(self) -> str:
+        return json.dumps(
+            {
+                "version": self.version,
+                "lexers": [dc.astuple(lex) for lex in self.lexers],
+            },
+            separators=(",", ":"),
+        )
+
+    @classmethod
+    def loads(cls, txt: str) -> LanguageIndex:
+        data = json.loads(txt)
+        lexers = [
+            LexerInfo(
+                classname,
+                module,
+                name,
+                tuple(aliases),
+                tuple(filenames),
+                tuple(mimetypes),
+            )
+            for classname, module, name, aliases, filenames, mimetypes in data["lexers"]
+        ]
+        return cls(version=data["version"], lexers=lexers)
+
+
+@functools.lru_cache(maxsize=None)
+def pygments_version() -> str:
+    """the version of the pygments imported (or to be), without importing it"""
+    if "pygments" not in sys.modules:
+        try:
+            # the first distribution on sys.path, as the import would find
+            return importlib.metadata.version("pygments")
+        except importlib.metadata.PackageNotFoundError:
+            pass
+    import pygments
+
+    return getattr(pygments, "__version__", "N/A")
+
+
+def build_index(plugins: bool = True) -> LanguageIndex:
+    """walks the pygments lexers (the slow path we want to run only once)"""
+    from pygments.lexers import LEXERS
+    from pygments.plugin import find_plugin_lexers
+
+    lexers = [
+        LexerInfo(classname, *info[:2], *(tuple(v) for v in info[2:]))
+        for classname, info in LEXERS.items()
+    ]
+    if plugins:
+        for cls in find_plugin_lexers():
+            lexers.append(
+                LexerInfo(
+                    cls.__name__,
+                    cls.__module__,
+                    cls.name,
+                    tuple(cls.aliases),
+                    tuple(cls.filenames),
+                    tuple(cls.mimetypes),
+                )
+            )
+    return LanguageIndex(version=pygments_version(), lexers=lexers)
+
+
+def write_index(index: LanguageIndex, path: str = INDEX_PATH) -> None:
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as fp:
+        fp.write(index.dumps())
+    os.replace(tmp, path)
+
+
+def read_index(path: str = INDEX_PATH) -> LanguageIndex | None:
+    """returns the stored index, or None if missing, broken or stale"""
+    try:
+        with open(path, encoding="utf-8") as fp:
+            index = LanguageIndex.loads(fp.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, TypeError, KeyError) as exc:
+        log.warning("cannot read language index %s: %s", path, exc)
+        return None
+    if index.version != pygments_version():
+        log.info(
+            "language index %s is stale (%s != %s)",
+            path,
+            index.version,
+            pygments_version(),
+        )
+        return None
+    return index
+
+
+# (re)builds a missing or stale index: in server mode main asks the render
+# server instead, so pygments isn't loaded in the Anki process
+index_builder: Callable[[], LanguageIndex] = build_index
+
+
+def load_index(path: str = INDEX_PATH) -> LanguageIndex:
+    """returns the stored index, (re)building it if needed"""
+    index = read_index(path)
+    if index is None:
+        index = index_builder()
+        try:
+            write_index(index, path)
+        except OSError as exc:
+            log.warning("cannot write language index %s: %s", path, exc)
+    return index
+
+
+@functools.lru_cache(maxsize=None)
+def get_index() -> LanguageIndex:
+    return load_index()
+
+
+def names() -> dict[str, str]:
+    """the language name -> alias map (eg. the old main.LANGUAGES_MAP)"""
+    return get_index().names
+
+
+def lexer_class(alias: str) -> type | None:
+    """returns the lexer class for alias (case insensitive), or None"""
+    info = get_index().aliases.get(alias.lower())
+    if info is None:
+        return None
+    return getattr(importlib.import_module(info.module), info.classname)
+
+
+def option_markup(limit: Sequence[str] = ()) -> str:
+    """the sorted <option> list for limit (or all the languages if empty)"""
+    # the index version invalidates the cached markup after a pygments update
+    return _option_markup(tuple(limit), "" if limit else get_index().version)
+
+
+@functools.lru_cache(maxsize=8)
+def _option_markup(limit: tuple[str, ...], version: str) -> str:
+    selection = limit or sorted(names(), key=str.lower)
+    return "".join(f"<option>{html.escape(name)}</option>" for name in selection)
+
+
+class SearchIndex:
+    """prefix/fuzzy search of the language names
+
+    Keys are the lowercase names, the aliases and the filename extensions
+    (eg. "python", "py3" and "pyw" for Python).
+    """
+
+    def __init__(self, index: LanguageIndex):
+        keys = set()
+        for lex in index.lexers:
+            if lex.name not in index.names:
+                continue
+            for key in (lex.name, *lex.aliases, *lex.filenames):
+                key = key.lower()
+                keys.add((key[2:] if key.startswith("*.") else key, lex.name))
+        self.keys = sorted(keys)
+
+    def resolve(self, text: str) -> str | None:
+        """the name for an exact (case insensitive) name, alias or extension"""
+        text = text.strip().lower()
+        start = bisect.bisect_left(self.keys, (text, ""))
+        for key, name in self.keys[start : start + 1]:
+            if key == text:
+                return name
+        return None
+
+    def search(self, query: str, limit: int = 20) -> list[str]:
+        """the language names matching query, best first"""
+        query = query.strip().lower()
+        if not query:
+            return []
+        # (rank, name): exact, name prefix, key prefix, substring, fuzzy
+        found: dict[str, int] = {}
+
+        def add(name: str, rank: int) -> None:
+            found[name] = min(rank, found.get(name, rank))
+
+        start = bisect.bisect_left(self.keys, (query, ""))
+        for key, name in self.keys[start:]:
+            if not key.startswith(query):
+                break
+            if key == query:
+                add(name, 0)
+            else:
+                add(name, 1 if key == name.lower() else 2)
+        if len(found) < limit:
+            for key, name in self.keys:
+                if name in found:
+                    continue
+                if query in key:
+                    add(name, 3)
+                elif _subsequence(query, key):
+                    add(name, 4)
+        ranked = sorted(found, key=lambda name: (found[name], len(name), name))
+        return ranked[:limit]
+
+
+def _subsequence(query: str, key: str) -> bool:
+    chars = iter(key)
+    return all(char in chars for char in query)
+
+
+def search_index() -> SearchIndex:
+    return _search_index(get_index().version)
+
+
+@functools.lru_cache(maxsize=1)
+def _search_index(version: str) -> SearchIndex:
+    return SearchIndex(get_index())
+
+
+def resolve_language(value: str, default: str) -> str:
+    """the alias for value (an alias, a name or a file extension)"""
+    value = value.strip()
+    if not value:
+        return default
+    if value.lower() in get_index().aliases:
+        return value
+    name = search_index().resolve(value)
+    # unknown: LanguageNotFound is reported for the row
+    return names()[name] if name else value
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+Input size guards
+
+A paste can be anything (a log file, a minified bundle ..): before rendering
+the input is measured (C speed string methods only) and assigned a tier:
+
+    full       highlighted as requested
+    plain      too large (or minified) to highlight: the text lexer is used
+    truncated  too large for a note field: the beginning only, as plain text
+    refused    not inserted at all
+
+Minified code (very long lines) is plain as the regex lexers can take very
+long on it.
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+from __future__ import annotations
+
+import dataclasses as dc
+from typing import Any
+
+TIER_FULL = "full"
+TIER_PLAIN = "plain"
+TIER_TRUNCATED = "truncated"
+TIER_REFUSED = "refused"
+
+
+@dc.dataclass(frozen=True)
+class Limits:
+    # highlighted up to (included)
+    highlight_bytes: int = 100 * 1024
+    highlight_lines: int = 2000
+    # plain text up to, then truncated to these
+    plain_bytes: int = 512 * 1024
+    plain_lines: int = 10000
+    # refused above
+    refuse_bytes: int = 8 * 1024 * 1024
+    # lines longer than this are minified code
+    minified_line: int = 1000
+
+    @classmethod
+    def from_conf(cls, conf: dict[str, Any]) -> Limits:
+        """from the config.json "sizeLimits" (KB and lines)"""
+        kb = {"highlightKB", "plainKB", "refuseKB"}
+        keys = {
+            "highlightKB": "highlight_bytes",
+            "highlightLines": "highlight_lines",
+            "plainKB": "plain_bytes",
+            "plainLines": "plain_lines",
+            "refuseKB": "refuse_bytes",
+            "minifiedLineLength": "minified_line",
+        }
+        values = {
+            field: int(conf[key]) * (1024 if key in kb else 1)
+            for key, field in keys.items()
+            if key in conf
+        }
+        return cls(**values)
+
+
+@dc.dataclass(frozen=True)
+class Assessment:
+    tier: str
+    nbytes: int  # utf-8
+    nlines: int
+    longest: int  # the longest line (0 if not measured)
+    reason: str = ""
+
+    @property
+    def minified(self) -> bool:
+        return self.reason == "minified"
+
+
+def assess(code: str, limits: Limits = Limits()) -> Assessment:
+    """the tier for code"""
+    # a char is at least a byte, skip the encoding of the huge inputs
+    if len(code) > limits.refuse_bytes:
+        return Assessment(TIER_REFUSED, len(code), _count_lines(code), 0, "bytes")
+    nbytes = len(code.encode("utf-8", "surrogatepass"))
+    nlines = _count_lines(code)
+    if nbytes > limits.refuse_bytes:
+        return Assessment(TIER_REFUSED, nbytes, nlines, 0, "bytes")
+    if nbytes > limits.plain_bytes:
+        return Assessment(TIER_TRUNCATED, nbytes, nlines, 0, "bytes")
+    if nlines > limits.plain_lines:
+        return Assessment(TIER_TRUNCATED, nbytes, nlines, 0, "lines")
+
+    longest = _longest_line(code, limits.minified_line)
+    if longest > limits.minified_line:
+        return Assessment(TIER_PLAIN, nbytes, nlines, longest, "minified")
+    if nbytes > limits.highlight_bytes:
+        return Assessment(TIER_PLAIN, nbytes, nlines, longest, "bytes")
+    if nlines > limits.highlight_lines:
+        return Assessment(TIER_PLAIN, nbytes, nlines, longest, "lines")
+    return Assessment(TIER_FULL, nbytes, nlines, longest)
+
+
+def _count_lines(code: str) -> int:
+    return code.count("\n") + (not code.endswith("\n"))
+
+
+def _longest_line(code: str, threshold: int) -> int:
+    # a short input cannot have a long line, no need to split it
+    if len(code) <= threshold:
+        return len(code)
+    return max(map(len, code.split("\n")))
+
+
+def truncate(code: str, limits: Limits = Limits(), marker: str = "") -> str:
+    """the first whole lines of code within the plain limits, then marker"""
+    data = code.encode("utf-8", "surrogatepass")[: limits.plain_bytes]
+    text = data.decode("utf-8", "ignore")
+    if len(text) < len(code) and "\n" in text:
+        # drop the partial last line (unless it's the only one)
+        text = text[: text.rfind("\n") + 1]
+    lines = text.split("\n", limits.plain_lines)
+    if len(lines) > limits.plain_lines:
+        text = "\n".join(lines[: limits.plain_lines]) + "\n"
+    if marker and not text.endswith("\n"):
+        text += "\n"
+    return text + marker
+
+
+def notice(assessment: Assessment, limits: Limits = Limits()) -> str:
+    """the message for the user (empty for the full tier)"""
+    size = f"{assessment.nbytes / 1024:.0f}KB, {assessment.nlines} lines"
+    if assessment.tier == TIER_REFUSED:
+        return (
+            f"The code is too large to insert ({size}), "
+            f"the limit is {limits.refuse_bytes // 1024}KB."
+        )
+    if assessment.tier == TIER_TRUNCATED:
+        return (
+            f"The code is too large ({size}): only the first "
+            f"{limits.plain_bytes // 1024}KB / {limits.plain_lines} lines "
+            "were inserted, without highlighting."
+        )
+    if assessment.minified:
+        return (
+            f"The code looks minified (a line of {assessment.longest} "
+            "characters): inserted without highlighting."
+        )
+    if assessment.tier == TIER_PLAIN:
+        return f"The code is too large to highlight ({size}): inserted as plain text."
+    return ""
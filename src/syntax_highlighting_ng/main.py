@@ -18,43 +18,76 @@ from __future__ import unicode_literals, annotations
 import contextlib
 import logging
 import functools
+import html
 import os
 import sys
-import re
 import json
+import threading
+import time
 import traceback
 
-from . import config, consts
+from . import (
+    config,
+    consts,
+    languages,
+    limits,
+    metrics,
+    render_types,
+    startup,
+    webview,
+)
 
 log = logging.getLogger(__name__)
 
-import pygments
-from pygments.lexers import get_all_lexers
+STARTED = time.perf_counter()
 
 from aqt.qt import *
 from aqt import mw
 from aqt.main import AnkiQt
 from aqt.editor import Editor
-from aqt.utils import showWarning
+from aqt.utils import askUser, showWarning, tooltip
 from anki.hooks import addHook, wrap
 
 log = getattr(mw.addonManager, "get_logger", logging.getLogger)(__name__)
 
-log.info(
-    "addon syntax_highlighting_ng loaded pygments %s",
-    getattr(pygments, "__version__", "N/A"),
-)
-
 HOTKEY = config.local_conf["hotkey"]
+HOTKEY_FIELDS = config.local_conf.get("hotkeyAllFields", "Alt+Shift+s")
+# note field name -> language (empty for the selected one), see fields.py
+CODE_FIELDS = config.local_conf.get("codeFields", {})
+# processes rendering the code fields of a note
+FIELD_WORKERS = min(4, os.cpu_count() or 1)
+# renders taking longer than this get a progress/cancel dialog
+RENDER_DELAY_MS = 500
 STYLE = config.local_conf["style"]
 LIMITED_LANGS = config.local_conf["limitToLangs"]
-
-# This code sets a correspondence between:
+# when to load pygments and html_render, see startup.py
+PRELOAD = config.local_conf.get("preload", startup.PRELOAD_LAZY)
+# "idle" preload (and warm-up) delay after the profile is loaded
+PRELOAD_DELAY_MS = 3000
+# CPU seconds for the lexers warm-up after the profile is loaded, see startup.py
+WARM_UP_SECONDS = config.local_conf.get("warmUpSeconds", startup.WARM_UP_BUDGET)
+# "typeahead" (search as you type) or "select" (combobox with all languages)
+LANGUAGE_PICKER = config.local_conf.get("languagePicker", "typeahead")
+# type-ahead suggestions
+SEARCH_LIMIT = 20
+# pick the language among the configured ones, see detect.py
+AUTODETECT = config.local_conf.get("autoDetect", False)
+# input size tiers (full, plain, truncated, refused), see limits.py
+LIMITS = limits.Limits.from_conf(config.local_conf.get("sizeLimits", {}))
+# seconds a render can take, in a worker process (0: in process), see worker.py
+RENDER_TIMEOUT = config.local_conf.get("renderTimeoutSeconds", 0)
+# render in a separate, long lived process (pygments is not loaded in Anki's
+# process), see server.py
+RENDER_SERVER = config.local_conf.get("renderServer", False)
+# renders profiled by default from the metrics dialog
+PROFILE_RENDERS = 10
+
+# languages.names() sets a correspondence between:
 #  The "language names": long, descriptive names we want
 #                        to show the user AND
 #  The "language aliases": short, cryptic names for internal
 #                          use by HtmlFormatter
-LANGUAGES_MAP = {lex[0]: lex[1][0] for lex in get_all_lexers() if lex[1]}
+# it is loaded lazily from a precomputed index (see languages.py)
 
 
 # Misc
@@ -85,11 +118,11 @@ def ui_code(fn):
 
     @functools.wraps(fn)
     def _fn(ed: Editor, *args, **kwargs) -> None | bool:
-        from . import html_render
-
         try:
             return fn(ed, *args, **kwargs)
-        except (html_render.LanguageNotFound, html_render.InvalidStyle) as e:
+        except Exception as e:
+            if not isinstance(e, render_types.LanguageNotFound):
+                raise
             print("".join(traceback.format_exc()))
             showError(e.render(), parent=ed.parentWindow)
         return False
@@ -107,11 +140,11 @@ def get_deck_name(mw: AnkiQt) -> str | None:
     return None
 
 
-def get_default_lang(mw: AnkiQt) -> str:
+def get_default_lang(mw: AnkiQt, deck_name: str | None = None) -> str:
     addon_conf = mw.col.conf[config.KEY]
     lang = addon_conf["lang"]
     if addon_conf["defaultlangperdeck"]:
-        deck_name = get_deck_name(mw)
+        deck_name = deck_name or get_deck_name(mw)
         if deck_name and deck_name in addon_conf["deckdefaultlang"]:
             lang = addon_conf["deckdefaultlang"][deck_name]
     return lang
@@ -150,6 +183,10 @@ class SyntaxHighlightingOptions(QDialog):  # type: ignore
         cssclasses_ = self.addon_conf["cssclasses"]
         self.addon_conf["cssclasses"] = not cssclasses_
 
+    def switch_compact(self):
+        compact_ = self.addon_conf["compact"]
+        self.addon_conf["compact"] = not compact_
+
     def setupUi(self):
         self.addon_conf = self.mw.col.conf[config.KEY]
 
@@ -168,6 +205,11 @@ class SyntaxHighlightingOptions(QDialog):  # type: ignore
         cssclasses_checkbox.setChecked(self.addon_conf["cssclasses"])
         cssclasses_checkbox.stateChanged.connect(self.switch_cssclasses)
 
+        compact_label = QLabel("<b>Compact output</b>")
+        compact_checkbox = QCheckBox("")
+        compact_checkbox.setChecked(self.addon_conf["compact"])
+        compact_checkbox.stateChanged.connect(self.switch_compact)
+
         defaultlangperdeck_label = QLabel(
             "<b>Default to last language used per deck</b>"
         )
@@ -183,8 +225,10 @@ class SyntaxHighlightingOptions(QDialog):  # type: ignore
         grid.addWidget(center_checkbox, 1, 1)
         grid.addWidget(cssclasses_label, 2, 0)
         grid.addWidget(cssclasses_checkbox, 2, 1)
-        grid.addWidget(defaultlangperdeck_label, 3, 0)
-        grid.addWidget(defaultlangperdeck_checkbox, 3, 1)
+        grid.addWidget(compact_label, 3, 0)
+        grid.addWidget(compact_checkbox, 3, 1)
+        grid.addWidget(defaultlangperdeck_label, 4, 0)
+        grid.addWidget(defaultlangperdeck_checkbox, 4, 1)
 
         self.setLayout(grid)
 
@@ -197,20 +241,193 @@ def onOptionsCall(mw: AnkiQt) -> None:
     dialog.exec()
 
 
+class SyntaxHighlightingMetrics(QDialog):  # type: ignore
+    def __init__(self, mw):
+        super(SyntaxHighlightingMetrics, self).__init__(mw)
+        self.mw = mw
+        self.setupUi()
+
+    def refresh(self):
+        self.report.setPlainText(METRICS.report())
+        if PROFILER.active:
+            status = f"Profiling, {PROFILER.remaining} renders to go: {PROFILER.path}"
+        else:
+            status = "Saves a profile of the next renders, for bug reports"
+        self.profile_label.setText(status)
+        self.stop_button.setEnabled(PROFILER.active)
+
+    def reset(self):
+        METRICS.clear()
+        self.refresh()
+
+    def start_profile(self):
+        PROFILER.start(self.renders.value())
+        self.refresh()
+
+    def stop_profile(self):
+        # saves the renders profiled so far
+        PROFILER.stop()
+        self.refresh()
+
+    def setupUi(self):
+        self.report = QPlainTextEdit()
+        self.report.setReadOnly(True)
+        self.report.setLineWrapMode(QPlainTextEdit.LineWrapMode.NoWrap)
+        fixed = QFontDatabase.SystemFont.FixedFont
+        self.report.setFont(QFontDatabase.systemFont(fixed))
+        self.report.setMinimumSize(620, 360)
+
+        self.renders = QSpinBox()
+        self.renders.setRange(1, 1000)
+        self.renders.setValue(PROFILE_RENDERS)
+        self.renders.setSuffix(" renders")
+        profile_button = QPushButton("Profile")
+        profile_button.clicked.connect(self.start_profile)
+        self.stop_button = QPushButton("Stop")
+        self.stop_button.clicked.connect(self.stop_profile)
+        self.profile_label = QLabel()
+
+        refresh_button = QPushButton("Refresh")
+        refresh_button.clicked.connect(self.refresh)
+        reset_button = QPushButton("Reset")
+        reset_button.clicked.connect(self.reset)
+
+        profile_row = QHBoxLayout()
+        profile_row.addWidget(self.renders)
+        profile_row.addWidget(profile_button)
+        profile_row.addWidget(self.stop_button)
+        profile_row.addWidget(self.profile_label, 1)
+        buttons = QHBoxLayout()
+        buttons.addStretch(1)
+        buttons.addWidget(refresh_button)
+        buttons.addWidget(reset_button)
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.report)
+        layout.addLayout(profile_row)
+        layout.addLayout(buttons)
+        self.setLayout(layout)
+
+        self.setWindowTitle("Syntax Highlighting Metrics")
+        self.refresh()
+
+
+def onMetricsCall(mw: AnkiQt) -> None:
+    """Show the render timings (see metrics.py)"""
+    dialog = SyntaxHighlightingMetrics(mw)
+    dialog.exec()
+
+
+def on_profile_saved(path: str) -> None:
+    mw.taskman.run_on_main(
+        lambda: tooltip(f"Syntax Highlighting profile saved: {path}", parent=mw)
+    )
+
+
+def onRestyleCall(mw: AnkiQt) -> None:
+    """Re-render the highlighted code in the collection with the current options"""
+    from aqt.operations import CollectionOp
+    from . import restyle
+
+    if not askUser(
+        "Re-render all the highlighted code in the collection "
+        "using the current options?<br><br>"
+        "Each code fragment keeps the language it was highlighted with. "
+        "For the fragments highlighted by older versions of the add-on "
+        "(with no language recorded) the language is detected among the "
+        "configured ones (with auto-detection on), or it's the default "
+        "language of the deck of its note.",
+        parent=mw,
+        title="Syntax Highlighting",
+    ):
+        return
+
+    addon_conf = mw.col.conf[config.KEY]
+    style = get_style(addon_conf, language="")
+    cancel = threading.Event()
+    results = []
+    candidates = candidate_aliases(
+        [*LIMITED_LANGS, *addon_conf["deckdefaultlang"].values(), addon_conf["lang"]],
+        "",
+    )
+
+    def fallback(note, fragment):
+        # a fragment with no language recorded
+        if AUTODETECT:
+            found = get_detector().detect(fragment.source, candidates)
+            if found is not None:
+                return found.alias
+        cards = note.cards()
+        deck_name = mw.col.decks.name(cards[0].did) if cards else None
+        return languages.names().get(get_default_lang(mw, deck_name), "")
+
+    def progress(done, total):
+        def update():
+            if mw.progress.want_cancel():
+                cancel.set()
+            mw.progress.update(
+                label=f"Re-styling code notes {done}/{total}", value=done, max=total
+            )
+
+        mw.taskman.run_on_main(update)
+
+    def op(col):
+        # a single undo step for all the updated notes
+        pos = col.add_custom_undo_entry("Syntax Highlighting Re-style")
+        note_ids = col.db.list(
+            "select id from notes where flds like ?", '%<div class="highlight"%'
+        )
+        results.append(
+            restyle.restyle_notes(
+                col,
+                note_ids,
+                style,
+                addon_conf["centerfragments"],
+                fallback=fallback,
+                progress=progress,
+                cancel=cancel,
+            )
+        )
+        return col.merge_undo_entries(pos)
+
+    def success(changes):
+        result = results[0]
+        msg = f"Re-styled {result.fragments} code fragments in {result.notes} notes"
+        if result.cancelled:
+            msg += " (cancelled)"
+        log.info("%s, errors: %s", msg, result.errors)
+        if result.errors:
+            msg += f"<br>{len(result.errors)} fragments failed (unknown language)"
+        if result.skipped:
+            msg += f"<br>{result.skipped} fragments skipped (unknown language)"
+        tooltip(msg, parent=mw)
+
+    CollectionOp(parent=mw, op=op).success(success).with_progress(
+        "Re-styling code notes"
+    ).run_in_background()
+
+
 options_action = QAction("Syntax Highlighting Options ...", mw)  # type: ignore
 options_action.triggered.connect(lambda _, o=mw: onOptionsCall(o))
 mw.form.menuTools.addAction(options_action)
 
+metrics_action = QAction("Syntax Highlighting Metrics ...", mw)  # type: ignore
+metrics_action.triggered.connect(lambda _, o=mw: onMetricsCall(o))
+mw.form.menuTools.addAction(metrics_action)
+
+restyle_action = QAction("Syntax Highlighting Re-style ...", mw)  # type: ignore
+restyle_action.triggered.connect(lambda _, o=mw: onRestyleCall(o))
+mw.form.menuTools.addAction(restyle_action)
+
 
 # Highlighter initialization
 
 
 def init_highlighter(ed: Editor, *args, **kwargs):
-    # Get the last selected language (or the default language if the user
-    # has never chosen any)
-
-    previous_lang = get_default_lang(mw)
-    ed.codeHighlightLangAlias = LANGUAGES_MAP.get(previous_lang, "")
+    # None stands for the last selected language (or the default language if
+    # the user has never chosen any), resolved on first use: no need to load
+    # the language index for every editor
+    ed.codeHighlightLangAlias = None
 
 
 # Highlighter widgets
@@ -281,7 +498,7 @@ def add_code_langs_combobox(self, func, previous_lang):
     if LIMITED_LANGS:
         selection = LIMITED_LANGS
     else:
-        selection = sorted(LANGUAGES_MAP.keys(), key=str.lower)
+        selection = sorted(languages.names(), key=str.lower)
 
     for lang in selection:
         combo.addItem(lang)
@@ -297,13 +514,11 @@ QSplitter.add_code_langs_combobox = add_code_langs_combobox  # type: ignore
 
 @ui_code
 def onCodeHighlightLangSelect(ed, lang):
-    from . import html_render
-
     try:
-        alias = LANGUAGES_MAP[lang]
+        alias = languages.names()[lang]
     except KeyError:
         ed.codeHighlightLangAlias = ""
-        raise html_render.LanguageNotFound(lang)
+        raise render_types.LanguageNotFound(lang)
     set_default_lang(mw, lang)
     ed.codeHighlightLangAlias = alias
 
@@ -316,6 +531,30 @@ select_elm = (
     """style='vertical-align: top;'>{}</select>"""
 )
 
+# type-ahead picker: the suggestions come from languages.search_index
+typeahead_elm = (
+    """<input type='search' list='shLangList' value='{}' """
+    """placeholder='Language' style='vertical-align: top; width: 10em;' """
+    """oninput='pycmd("shLangSearch:" + this.value)' """
+    """onchange='pycmd("shLangPick:" + this.value)'>"""
+    """<datalist id='shLangList'></datalist>"""
+)
+
+fill_datalist_js = """(function(names) {
+    const datalist = document.getElementById("shLangList");
+    if (!datalist) return;
+    datalist.replaceChildren(...names.map((name) => {
+        const option = document.createElement("option");
+        option.value = name;
+        return option;
+    }));
+})(%s);"""
+
+set_typeahead_js = """(function(name) {
+    const input = document.querySelector("input[list=shLangList]");
+    if (input) input.value = name;
+})(%s);"""
+
 
 def onSetupButtons21(buttons, ed):
     """Add buttons to Editor for Anki 2.1.x"""
@@ -329,112 +568,574 @@ def onSetupButtons21(buttons, ed):
         keys=HOTKEY,
     )
     buttons.append(b)
+    if CODE_FIELDS:
+        b = ed.addButton(
+            icon_path,
+            "CHF",
+            highlight_fields,
+            tip="Highlight the code fields ({})".format(HOTKEY_FIELDS),
+            keys=HOTKEY_FIELDS,
+        )
+        buttons.append(b)
 
-    # HTML "combobox"
     previous_lang = get_default_lang(mw)
 
-    option_str = """<option>{}</option>"""
-    options = []
-
-    if LIMITED_LANGS:
-        selection = LIMITED_LANGS
+    if LIMITED_LANGS or LANGUAGE_PICKER == "select":
+        # HTML "combobox", the options markup is built once
+        option_str = """<option>{}</option>"""
+        options = option_str.format(html.escape(previous_lang))
+        combo = select_elm.format(options + languages.option_markup(LIMITED_LANGS))
     else:
-        selection = sorted(LANGUAGES_MAP.keys(), key=str.lower)
-
-    options.append(option_str.format(previous_lang))
-    for lang in selection:
-        options.append(option_str.format(lang))
-
-    combo = select_elm.format("".join(options))
+        # the languages list is not embedded in every editor
+        combo = typeahead_elm.format(html.escape(previous_lang))
     buttons.append(combo)
 
     return buttons
 
 
+@ui_code
+def onCodeHighlightLangSearch(ed, query):
+    names = languages.search_index().search(query, SEARCH_LIMIT)
+    ed.web.eval(fill_datalist_js % json.dumps(names))
+
+
+@ui_code
+def onCodeHighlightLangPick(ed, text):
+    index = languages.search_index()
+    lang = index.resolve(text) or next(iter(index.search(text, 1)), None)
+    if lang is None:
+        tooltip(f"Unknown language '{text}'", parent=ed.parentWindow)
+        return
+    ed.web.eval(set_typeahead_js % json.dumps(lang))
+    onCodeHighlightLangSelect(ed, lang)
+
+
 def onBridgeCmd(ed, cmd, _old):
     if not cmd.startswith("shLang"):
         return _old(ed, cmd)
-    (type, lang) = cmd.split(":")
-    onCodeHighlightLangSelect(ed, lang)
+    (type, _, value) = cmd.partition(":")
+    if type == "shLangSearch":
+        onCodeHighlightLangSearch(ed, value)
+    elif type == "shLangPick":
+        onCodeHighlightLangPick(ed, value)
+    else:
+        onCodeHighlightLangSelect(ed, value)
 
 
 # Actual code highlighting
 
 
-@ui_code
-def highlight_code(ed):
-    from . import html_render
-
-    addon_conf = mw.col.conf[config.KEY]
-
+def get_style(addon_conf, language: str):
     #  Do we want line numbers? linenos is either true or false according
     # to the user's preferences
     linenos = addon_conf["linenos"]
 
-    centerfragments = addon_conf["centerfragments"]
-
     # Do we want to use css classes or have formatting directly in HTML?
     # Using css classes takes up less space and gives the user more
     # customization options, but is less self-contained as it requires
     # setting the styling on every note type where code is used
     noclasses = not addon_conf["cssclasses"]
 
-    # NOTE: we get the selected text (a pure string)
-    selected_text = ed.web.selectedText()
-    if selected_text:
-        #  Sometimes, self.web.selectedText() contains the unicode character
-        # '\u00A0' (non-breaking space). This character messes with the
-        # formatter for highlighted code. To correct this, we replace all
-        # '\u00A0' characters with regular space characters
-        code = selected_text.replace("\u00A0", " ")
-    else:
-        clipboard = QApplication.clipboard()
-        # Get the code from the clipboard
-        code = clipboard.text()
+    # Smaller fragments (merged spans, short inline css), same rendering
+    compact = addon_conf.get("compact", False)
 
-    # Select the lexer for the correct language
-    style = html_render.Style(
+    return render_types.Style(
         # NOTE: we specify the language to highlight for
-        language=ed.codeHighlightLangAlias,
+        language=language,
         style=STYLE,
         linenos="inline" if linenos is True else linenos,
         noclasses=noclasses,
+        compact=compact,
     )
 
-    processed = html_render.render_string(code, style=style)
 
-    if centerfragments:
-        pretty_code = "".join(
-            [
-                "<center><table><tbody><tr><td>",
-                processed,
-                "</td></tr></tbody></table></center>",
-            ]
+@ui_code
+def highlight_code(ed):
+    started = time.perf_counter()
+    addon_conf = mw.col.conf[config.KEY]
+    centerfragments = addon_conf["centerfragments"]
+
+    with METRICS.timed(metrics.STAGE_READ):
+        # NOTE: we get the selected text (a pure string)
+        selected_text = ed.web.selectedText()
+        if selected_text:
+            #  Sometimes, self.web.selectedText() contains the unicode character
+            # '\u00A0' (non-breaking space). This character messes with the
+            # formatter for highlighted code. To correct this, we replace all
+            # '\u00A0' characters with regular space characters
+            code = selected_text.replace("\u00A0", " ")
+        else:
+            clipboard = QApplication.clipboard()
+            # Get the code from the clipboard
+            code = clipboard.text()
+
+    # cheap checks before any rendering
+    assessment = limits.assess(code, LIMITS)
+    log.info(
+        "highlight %d bytes, %d lines (longest %d): %s %s",
+        assessment.nbytes,
+        assessment.nlines,
+        assessment.longest,
+        assessment.tier,
+        assessment.reason,
+    )
+    if assessment.tier == limits.TIER_REFUSED:
+        showError(limits.notice(assessment, LIMITS), parent=ed.parentWindow)
+        return
+
+    alias = ed.codeHighlightLangAlias
+    default_lang = get_default_lang(mw)
+    # the languages the auto-detection picks from (names)
+    candidates = []
+    if AUTODETECT and assessment.tier == limits.TIER_FULL:
+        candidates = [
+            *LIMITED_LANGS,
+            *addon_conf["deckdefaultlang"].values(),
+            default_lang,
+        ]
+
+    # the rendering happens in a worker thread, see on_rendered
+    def render(cancel):
+        with PROFILER.profiled():
+            return render_code(cancel)
+
+    def render_code(cancel):
+        from . import server
+
+        # Select the lexer for the correct language
+        if alias is None:
+            language = languages.names().get(default_lang, "")
+        else:
+            language = alias
+
+        source = code
+        if assessment.tier != limits.TIER_FULL:
+            # too large (or minified) for the lexers
+            language = "text"
+        if assessment.tier == limits.TIER_TRUNCATED:
+            source = limits.truncate(code, LIMITS, render_types.TRUNCATED)
+        message = limits.notice(assessment, LIMITS)
+
+        result = None
+        if RENDER_SERVER and get_render_server().available:
+            try:
+                result = render_in_server(source, language, message, cancel)
+            except server.ServerUnavailable as e:
+                log.warning("render server not available, rendering here: %s", e)
+        if result is None:
+            result = render_in_process(source, language, message, cancel)
+        pretty_code, language, _ = result
+        METRICS.add_traffic(
+            language, assessment.nbytes, len(pretty_code.encode("utf-8"))
         )
-    else:
-        pretty_code = "".join(
-            ["<table><tbody><tr><td>", processed, "</td></tr></tbody></table>"]
+        return result
+
+    def render_in_server(source, language, message, cancel):
+        from . import worker
+
+        aliases = candidate_aliases(candidates, language) if candidates else []
+        style = get_style(addon_conf, language=language)
+        render_server = get_render_server()
+        start = time.perf_counter()
+        try:
+            pretty_code, language = render_server.render(
+                source,
+                style,
+                centerfragments,
+                cancel,
+                candidates=aliases,
+                budget=RENDER_TIMEOUT or None,
+            )
+        except worker.RenderTimeout as e:
+            # a runaway lexer (the server is restarted): inserted as plain text
+            log.warning("%s rendering stopped: %r", language, e)
+            language = "text"
+            style = get_style(addon_conf, language=language)
+            pretty_code, _ = render_server.render(
+                source, style, centerfragments, cancel
+            )
+            message = e.render()
+        METRICS.add(metrics.STAGE_SERVER, time.perf_counter() - start, language)
+        return pretty_code, language, message
+
+    def render_in_process(source, language, message, cancel):
+        from . import html_render, worker
+
+        # first use: loads pygments, the language index and html_render
+        startup.ensure_loaded(STYLE, log)
+        if candidates:
+            language = detect_language(code, candidates, language)
+        style = get_style(addon_conf, language=language)
+        with METRICS.timed(metrics.STAGE_LEXER, language):
+            html_render.LEXERS.lexer_class(language)
+
+        in_worker = []
+
+        def render_fragment(*args):
+            if not RENDER_TIMEOUT:
+                # an edited copy of a large block is re-rendered from the last one
+                return get_incremental().render(*args)
+            in_worker.append(True)
+            with METRICS.timed(metrics.STAGE_WORKER, language):
+                return get_render_worker().render(*args)
+
+        start = time.perf_counter()
+        with metrics.lexing() as lexing:
+            try:
+                pretty_code = get_fragment_cache().render(
+                    source, style, centerfragments, cancel, render=render_fragment
+                )
+            except worker.WorkerError as e:
+                # a runaway lexer (or a crash): inserted as plain text
+                log.warning("%s rendering stopped: %r", language, e)
+                language = "text"
+                style = get_style(addon_conf, language=language)
+                pretty_code = get_fragment_cache().render(
+                    source, style, centerfragments, cancel
+                )
+                message = e.render()
+        elapsed = time.perf_counter() - start
+        if lexing.batches:
+            METRICS.add(metrics.STAGE_LEX, lexing.elapsed, language)
+            METRICS.add(metrics.STAGE_FORMAT, elapsed - lexing.elapsed, language)
+        elif not in_worker:
+            METRICS.add(metrics.STAGE_CACHED, elapsed, language)
+        return pretty_code, language, message
+
+    note = ed.note
+
+    def done(job):
+        mw.taskman.run_on_main(lambda: on_rendered(ed, job, progress, started, note))
+
+    job = get_renderer().submit(ed, render, done)
+    if job is None:
+        tooltip("Code highlighting already in progress", parent=ed.parentWindow)
+        return
+    progress = show_progress(ed, job)
+
+
+def show_progress(ed, job, label="Highlighting code..."):
+    """a dialog cancelling job, shown if it takes more than RENDER_DELAY_MS"""
+    progress = QProgressDialog(label, "Cancel", 0, 0, ed.parentWindow)
+    progress.setWindowTitle("Syntax Highlighting")
+    progress.setMinimumDuration(RENDER_DELAY_MS)
+    progress.canceled.connect(job.cancel.set)
+    return progress
+
+
+def candidate_aliases(candidates: list[str], language: str) -> list[str]:
+    """the aliases of the candidates (names) and language, without duplicates"""
+    names = languages.names()
+    aliases = [names[name] for name in candidates if name in names]
+    if language:
+        aliases.append(language)
+    return list(dict.fromkeys(aliases))
+
+
+def detect_language(code: str, candidates: list[str], language: str) -> str:
+    """the alias of the language detected among candidates, or language"""
+    found = get_detector().detect(code, candidate_aliases(candidates, language))
+    if found is None:
+        return language
+    log.info("detected language %s (%s)", found.alias, found.method)
+    return found.alias
+
+
+def on_rendered(ed, job, progress, started=None, note=None):
+    progress.reset()
+    progress.deleteLater()
+    if getattr(ed, "web", None) is None:
+        # editor closed in the meantime
+        return
+    try:
+        pretty_code, language, message = job.result()
+    except render_types.RenderCancelled as e:
+        tooltip(e.render(), parent=ed.parentWindow)
+        return
+    except render_types.RenderError as e:
+        showError(e.render(), parent=ed.parentWindow)
+        return
+
+    def inserted(transfer):
+        METRICS.add(metrics.STAGE_EVAL, transfer.elapsed, language)
+        if started is not None:
+            METRICS.add(metrics.STAGE_TOTAL, time.perf_counter() - started, language)
+
+    def current():
+        # still the note the code was highlighted for
+        return getattr(ed, "web", None) is not None and ed.note is note
+
+    # insert the HTML in the current cursor position (in chunks if large)
+    webview.insert_html(ed.web, pretty_code, inserted, current=current)
+    if message:
+        # not highlighted (or truncated), see limits.py and worker.py
+        tooltip(message, parent=ed.parentWindow)
+
+
+@ui_code
+def highlight_fields(ed):
+    """Highlight all the code fields of the note, see fields.py"""
+    if ed.note is None:
+        return
+    # the field being edited is saved first
+    ed.call_after_note_saved(lambda: highlight_note_fields(ed))
+
+
+def highlight_note_fields(ed):
+    note = ed.note
+    if note is None:
+        return
+    names = list(note.keys())
+    # rendered from a copy, the note is updated if unchanged (on_fields_rendered)
+    snapshot = list(note.fields)
+    if not any(name in CODE_FIELDS for name in names):
+        tooltip("This note has no code fields (codeFields)", parent=ed.parentWindow)
+        return
+
+    addon_conf = mw.col.conf[config.KEY]
+    alias = ed.codeHighlightLangAlias
+    default_lang = get_default_lang(mw)
+
+    def render(cancel):
+        from . import fields
+
+        if alias is None:
+            language = languages.names().get(default_lang, "")
+        else:
+            language = alias
+        if RENDER_SERVER and get_render_server().available:
+            # the server renders (and caches) them, the pool is the fallback
+            render_many, cache = get_render_server().render_many, None
+        else:
+            startup.ensure_loaded(STYLE, log)
+            render_many, cache = None, get_fragment_cache()
+        return fields.render_fields(
+            fields.code_fields(names, snapshot, CODE_FIELDS),
+            functools.partial(get_style, addon_conf),
+            addon_conf["centerfragments"],
+            default_language=language,
+            executor=get_field_pool(),
+            render_many=render_many,
+            cache=cache,
+            size_limits=LIMITS,
+            cancel=cancel,
+        )
+
+    def done(job):
+        mw.taskman.run_on_main(
+            lambda: on_fields_rendered(ed, job, progress, note, snapshot)
         )
 
-    pretty_code = process_html(pretty_code)
+    job = get_renderer().submit(ed, render, done)
+    if job is None:
+        tooltip("Code highlighting already in progress", parent=ed.parentWindow)
+        return
+    progress = show_progress(ed, job, "Highlighting the code fields...")
 
-    # These two lines insert a piece of HTML in the current cursor position
-    ed.web.eval(
-        "document.execCommand('inserthtml', false, %s);" % json.dumps(pretty_code)
+
+def on_fields_rendered(ed, job, progress, note, snapshot):
+    from aqt.operations.note import update_note
+
+    progress.reset()
+    progress.deleteLater()
+    if getattr(ed, "web", None) is None or ed.note is not note:
+        # editor closed (or another note loaded) in the meantime
+        return
+    try:
+        results = job.result()
+    except render_types.RenderCancelled as e:
+        tooltip(e.render(), parent=ed.parentWindow)
+        return
+    if not results:
+        tooltip("The code fields are empty", parent=ed.parentWindow)
+        return
+
+    changed = 0
+    messages = []
+    for result in results:
+        name = html.escape(result.field.name)
+        index = result.field.index
+        if result.error:
+            messages.append(f"{name}: {html.escape(result.error)}")
+        elif note.fields[index] != snapshot[index]:
+            messages.append(f"{name}: edited in the meantime, not highlighted")
+        else:
+            note.fields[index] = result.html
+            changed += 1
+            if result.notice:
+                messages.append(f"{name}: {result.notice}")
+
+    if changed:
+        # all the fields at once: a single editor reload (and undo step)
+        ed.loadNoteKeepingFocus()
+        if not ed.addMode:
+            update_note(parent=ed.widget, note=note).run_in_background(initiator=ed)
+    log.info("highlighted %d code fields: %s", changed, messages)
+    tooltip(
+        "<br>".join([f"Highlighted {changed} code fields", *messages]),
+        parent=ed.parentWindow,
     )
 
 
+@functools.lru_cache(maxsize=None)
+def get_renderer():
+    from . import background
+
+    renderer = background.BackgroundRenderer()
+    addHook("unloadProfile", renderer.cancel_all)
+    return renderer
+
+
+@functools.lru_cache(maxsize=None)
+def get_field_pool():
+    import concurrent.futures
+
+    return concurrent.futures.ProcessPoolExecutor(max_workers=FIELD_WORKERS)
+
+
+def shutdown_field_pool():
+    """stops the fields pool, if started (a new one is started on next use)"""
+    if get_field_pool.cache_info().currsize:
+        get_field_pool().shutdown(wait=False)
+        get_field_pool.cache_clear()
+
+
+addHook("unloadProfile", shutdown_field_pool)
+
+
+@functools.lru_cache(maxsize=None)
+def get_render_worker():
+    from . import worker
+
+    render_worker = worker.RenderWorker(budget=RENDER_TIMEOUT)
+    addHook("unloadProfile", render_worker.close)
+    return render_worker
+
+
+# the render timings, shown from the Tools menu
+METRICS = metrics.Metrics()
+# cProfile of the next renders, on demand from the metrics dialog
+PROFILER = metrics.Profiler(consts.user_files_path, on_saved=on_profile_saved)
+
+
 def process_html(html):
     """Modify highlighter output to address some Anki idiosyncracies"""
-    # 1.) "Escape" curly bracket sequences reserved to Anki's card template
-    # system by placing an invisible html tag inbetween
-    for pattern, replacement in (
-        (r"{{", r"{<!---->{"),
-        (r"}}", r"}<!---->}"),
-        (r"::", r":<!---->:"),
-    ):
-        html = re.sub(pattern, replacement, html)
-    return html
+    from . import html_render
+
+    return html_render.process_html(html)
+
+
+@functools.lru_cache(maxsize=None)
+def get_detector():
+    from . import detect
+
+    return detect.Detector()
+
+
+@functools.lru_cache(maxsize=None)
+def get_incremental():
+    from . import incremental
+
+    return incremental.Incremental()
+
+
+def fragment_cache_options():
+    return dict(
+        maxbytes=config.local_conf.get("cacheMemoryMB", 4) * 2**20,
+        path=os.path.join(consts.user_files_path, "fragments.sqlite"),
+        maxdiskbytes=config.local_conf.get("cacheDiskMB", 32) * 2**20,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_fragment_cache():
+    from . import fragment_cache
+
+    return fragment_cache.FragmentCache(**fragment_cache_options())
+
+
+@functools.lru_cache(maxsize=None)
+def get_render_server():
+    from . import server
+
+    # the server owns the fragment cache (in server mode it's not used here)
+    render_server = server.RenderServer(
+        server.ServerOptions(**fragment_cache_options())
+    )
+    addHook("unloadProfile", render_server.close)
+    return render_server
+
+
+def build_language_index():
+    """the languages.index_builder in server mode (pygments isn't loaded here)"""
+    from . import server
+
+    try:
+        return languages.LanguageIndex.loads(get_render_server().language_index())
+    except server.ServerUnavailable as e:
+        log.warning("render server not available, building here: %s", e)
+        return languages.build_index()
+
+
+# stops the warm-up when the profile is closed
+WARM_UP_CANCEL = threading.Event()
+
+
+def warm_up(addon_conf):
+    """loads the lexers of the default and the deck languages when idle"""
+    if PRELOAD != startup.PRELOAD_IDLE and not (WARM_UP_SECONDS or RENDER_SERVER):
+        return
+    names = [addon_conf["lang"], *addon_conf["deckdefaultlang"].values()]
+    names.extend(LIMITED_LANGS)
+    WARM_UP_CANCEL.clear()
+
+    def task():
+        if RENDER_SERVER and warm_up_server(names, addon_conf):
+            return
+        startup.ensure_loaded(STYLE, log)
+        if WARM_UP_SECONDS and not WARM_UP_CANCEL.is_set():
+            startup.warm_up(
+                names,
+                functools.partial(get_style, addon_conf),
+                addon_conf["centerfragments"],
+                budget=WARM_UP_SECONDS,
+                cancel=WARM_UP_CANCEL,
+                logger=log,
+            )
+
+    def start():
+        if not WARM_UP_CANCEL.is_set():
+            mw.taskman.run_in_background(task)
+
+    QTimer.singleShot(PRELOAD_DELAY_MS, start)
+
+
+def warm_up_server(names, addon_conf) -> bool:
+    """starts (and warms up) the render server, False if not available"""
+    from . import server
+
+    render_server = get_render_server()
+    start = time.perf_counter()
+    try:
+        if WARM_UP_SECONDS:
+            future = render_server.warm_up(
+                names,
+                get_style(addon_conf, language=""),
+                addon_conf["centerfragments"],
+                budget=WARM_UP_SECONDS,
+            )
+            warmed = render_server.wait(future, WARM_UP_CANCEL)
+        else:
+            warmed = []
+        info = render_server.info()
+    except render_types.RenderCancelled:
+        return True
+    except server.ServerUnavailable as e:
+        log.warning("render server not available: %s", e)
+        return False
+    startup.record("render server", start, log)
+    log.info("render server %s, warmed up: %s", info, ", ".join(warmed) or "nothing")
+    return True
 
 
 # Hooks and monkey-patches
@@ -444,3 +1145,15 @@ addHook("setupEditorButtons", onSetupButtons21)
 Editor.onBridgeCmd = wrap(Editor.onBridgeCmd, onBridgeCmd, "around")
 
 Editor.__init__ = wrap(Editor.__init__, init_highlighter)
+
+if RENDER_SERVER:
+    languages.index_builder = build_language_index
+if PRELOAD == startup.PRELOAD_STARTUP and not RENDER_SERVER:
+    startup.ensure_loaded(STYLE, log)
+elif PRELOAD not in startup.PRELOAD_MODES:
+    log.warning("unknown preload option %r, using %r", PRELOAD, startup.PRELOAD_LAZY)
+# the "idle" preload and the lexers warm-up, once the conf is synced
+config.profile_loaded_callbacks.append(warm_up)
+addHook("unloadProfile", WARM_UP_CANCEL.set)
+
+startup.record("addon init", STARTED, log)
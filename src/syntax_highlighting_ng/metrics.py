@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+Render pipeline instrumentation
+
+highlight_code times each stage of a render into Metrics: the selection (or
+clipboard) read, the lexer lookup, lexing, formatting (with the Anki
+escaping, see html_render.process_html) and the insertion in the editor.
+For each stage and language it keeps the count, the total and the p50/p95
+(over the most recent samples), plus the bytes in and out per language. The
+report is shown from the Tools menu (Syntax Highlighting Metrics).
+
+Lexing and formatting are interleaved (the formatter pulls the tokens from
+the lexer): timed_tokens pulls them in batches to time the lexer alone, the
+formatting is the rest of the render time.
+
+Profiler captures a cProfile of the next renders into a file, to attach to
+bug reports.
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+from __future__ import annotations
+
+import collections
+import contextlib
+import dataclasses as dc
+import io
+import itertools
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Iterator
+
+log = logging.getLogger(__name__)
+
+STAGE_READ = "read"  # the selection or the clipboard
+STAGE_LEXER = "lexer"  # the lexer lookup (the module import the first time)
+STAGE_LEX = "lex"
+STAGE_FORMAT = "format"
+STAGE_WORKER = "worker"  # lexing and formatting in the render worker process
+STAGE_SERVER = "server"  # the render server round trip (see server.py)
+STAGE_CACHED = "cached"  # a cached fragment (no lexing nor formatting)
+STAGE_EVAL = "eval"  # the insertion in the editor webview (until done)
+STAGE_TOTAL = "total"  # from the button (or hotkey) press to the insertion
+STAGES = (
+    STAGE_READ,
+    STAGE_LEXER,
+    STAGE_LEX,
+    STAGE_FORMAT,
+    STAGE_WORKER,
+    STAGE_SERVER,
+    STAGE_CACHED,
+    STAGE_EVAL,
+    STAGE_TOTAL,
+)
+
+# the samples kept for the percentiles
+SAMPLES = 1000
+# the tokens pulled from the lexer at a time by timed_tokens
+TOKEN_BATCH = 512
+
+# the lexing stopwatch of the render running in this thread
+_local = threading.local()
+
+
+@dc.dataclass
+class Histogram:
+    count: int = 0
+    total: float = 0.0
+    samples: collections.deque[float] = dc.field(
+        default_factory=lambda: collections.deque(maxlen=SAMPLES)
+    )
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.samples.append(value)
+
+    def percentile(self, percent: float) -> float:
+        """the nearest rank percentile of the kept samples (0 if none)"""
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        rank = max(round(percent / 100 * len(ordered)), 1)
+        return ordered[min(rank, len(ordered)) - 1]
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+@dc.dataclass
+class Traffic:
+    renders: int = 0
+    bytes_in: int = 0  # utf-8 source
+    bytes_out: int = 0  # utf-8 html
+
+
+class Metrics:
+    """per stage and language timings (in seconds), thread safe
+
+    The timings are recorded for their language and, when that's given, for
+    all the languages ("") too.
+    """
+
+    def __init__(self) -> None:
+        self.stages: dict[tuple[str, str], Histogram] = {}
+        self.traffic: dict[str, Traffic] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float, language: str = "") -> None:
+        with self._lock:
+            for key in {(stage, ""), (stage, language)}:
+                self.stages.setdefault(key, Histogram()).add(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, stage: str, language: str = "") -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, language)
+
+    def add_traffic(self, language: str, bytes_in: int, bytes_out: int) -> None:
+        with self._lock:
+            for key in {"", language}:
+                traffic = self.traffic.setdefault(key, Traffic())
+                traffic.renders += 1
+                traffic.bytes_in += bytes_in
+                traffic.bytes_out += bytes_out
+
+    def histogram(self, stage: str, language: str = "") -> Histogram:
+        """a copy of the stage timings (empty if never recorded)"""
+        with self._lock:
+            found = self.stages.get((stage, language), Histogram())
+            return dc.replace(found, samples=collections.deque(found.samples))
+
+    def report(self) -> str:
+        """the timings and the traffic as plain text tables (all languages first)"""
+        with self._lock:
+            stages = dict(self.stages)
+            traffic = dict(self.traffic)
+        if not stages and not traffic:
+            return "No code highlighted yet."
+
+        out = io.StringIO()
+        out.write(
+            f"{'stage':<8} {'language':<16} {'count':>7} "
+            f"{'p50 ms':>9} {'p95 ms':>9} {'mean ms':>9}\n"
+        )
+        order = {stage: index for index, stage in enumerate(STAGES)}
+        for stage, language in sorted(
+            stages, key=lambda k: (order.get(k[0], len(order)), k[0], k[1])
+        ):
+            hist = stages[(stage, language)]
+            out.write(
+                f"{stage:<8} {language or '(all)':<16} {hist.count:>7} "
+                f"{hist.percentile(50) * 1000:>9.1f} "
+                f"{hist.percentile(95) * 1000:>9.1f} {hist.mean * 1000:>9.1f}\n"
+            )
+        out.write(f"\n{'language':<16} {'renders':>7} {'KB in':>10} {'KB out':>10}\n")
+        for language in sorted(traffic):
+            t = traffic[language]
+            out.write(
+                f"{language or '(all)':<16} {t.renders:>7} "
+                f"{t.bytes_in / 1024:>10.1f} {t.bytes_out / 1024:>10.1f}\n"
+            )
+        return out.getvalue()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.stages.clear()
+            self.traffic.clear()
+
+
+@dc.dataclass
+class Stopwatch:
+    elapsed: float = 0.0
+    batches: int = 0  # 0: nothing was lexed (eg. a cached fragment)
+
+
+@contextlib.contextmanager
+def lexing() -> Iterator[Stopwatch]:
+    """collects the time spent by timed_tokens (in this thread) lexing"""
+    previous = getattr(_local, "lexing", None)
+    _local.lexing = watch = Stopwatch()
+    try:
+        yield watch
+    finally:
+        _local.lexing = previous
+
+
+def timed_tokens(
+    tokens: Iterator[tuple[Any, Any]], batch: int = TOKEN_BATCH
+) -> Iterator[tuple[Any, Any]]:
+    """tokens, timed into the lexing() stopwatch if there's one"""
+    watch = getattr(_local, "lexing", None)
+    if watch is None:
+        return tokens
+    return _timed_tokens(tokens, watch, batch)
+
+
+def _timed_tokens(
+    tokens: Iterator[tuple[Any, Any]], watch: Stopwatch, batch: int
+) -> Iterator[tuple[Any, Any]]:
+    while True:
+        start = time.perf_counter()
+        chunk = list(itertools.islice(tokens, batch))
+        watch.elapsed += time.perf_counter() - start
+        watch.batches += 1
+        if not chunk:
+            return
+        yield from chunk
+
+
+class Profiler:
+    """cProfile of the next renders, saved into directory
+
+    start(renders) arms it, then the renders run within profiled() are
+    profiled (one at a time, the others are skipped) until the count is
+    reached: the stats are saved as profile-<time>.prof (for pstats or
+    snakeviz) with a text summary next to it (profile-<time>.txt).
+    """
+
+    def __init__(
+        self, directory: str, on_saved: Callable[[str], None] | None = None
+    ) -> None:
+        self.directory = directory
+        self.on_saved = on_saved
+        self.remaining = 0
+        self.path: str | None = None
+        self._profile: Any = None
+        self._busy = False
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> bool:
+        return self.remaining > 0
+
+    def start(self, renders: int) -> str:
+        """profiles the next renders, returns the file it will save"""
+        import cProfile
+
+        with self._lock:
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            self.path = os.path.join(self.directory, f"profile-{stamp}.prof")
+            self.remaining = renders
+            self._profile = cProfile.Profile()
+        log.info("profiling the next %d renders into %s", renders, self.path)
+        return self.path
+
+    @contextlib.contextmanager
+    def profiled(self) -> Iterator[None]:
+        with self._lock:
+            profile = self._profile if self.remaining and not self._busy else None
+            self._busy = self._busy or profile is not None
+        if profile is None:
+            yield
+            return
+
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self._lock:
+                self._busy = False
+                self.remaining -= 1
+                finished = self.remaining == 0
+                path = self.path
+            if finished and path is not None:
+                self._save(profile, path)
+
+    def stop(self) -> None:
+        """saves the renders profiled so far"""
+        with self._lock:
+            profile, path = self._profile, self.path
+            self.remaining = 0
+        if profile is not None and path is not None:
+            self._save(profile, path)
+
+    def _save(self, profile: Any, path: str) -> None:
+        import pstats
+
+        with self._lock:
+            if self._profile is not profile:
+                return
+            self._profile = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            profile.dump_stats(path)
+            with open(os.path.splitext(path)[0] + ".txt", "w", encoding="utf-8") as fp:
+                stats = pstats.Stats(profile, stream=fp)
+                stats.sort_stats("cumulative").print_stats(50)
+        except (OSError, TypeError) as exc:
+            # TypeError: no render was profiled (empty stats)
+            log.warning("cannot save the profile %s: %s", path, exc)
+            return
+        log.info("saved the render profile %s", path)
+        if self.on_saved is not None:
+            self.on_saved(path)
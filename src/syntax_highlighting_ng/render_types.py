@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+The rendering types: the style, the errors and the truncation marker
+
+They are importable without loading pygments (unlike html_render, which
+re-exports them), so the Anki process can drive the render server (see
+server.py) and handle its results with pygments loaded in the server only.
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+from __future__ import annotations
+
+import dataclasses as dc
+
+# the last line of a truncated input (see limits.truncate)
+TRUNCATED = "[... truncated ...]"
+
+
+@dc.dataclass(frozen=True)
+class Style:
+    linenos: str = "inline"
+    noclasses: bool = True
+    style: str = "default"
+    language: str = "Python"
+    compact: bool = False
+
+
+class RenderError(Exception):
+    def render(self) -> str:
+        raise NotImplementedError("adds .render method")
+
+
+class LanguageNotFound(RenderError):
+    def render(self) -> str:
+        return f"""
+<b>Error</b>: Selected language '{self.args[0]}' not found.<br>
+If you set a custom lang selection please make sure<br>
+you typed all list entries correctly.
+"""
+
+
+class InvalidStyle(LanguageNotFound):
+    def render(self) -> str:
+        return f"""
+<b>Error</b>: Selected style '{self.args[0]}' not found.<br>
+If you set a custom style please make sure<br>
+you typed it correctly.
+"""
+
+
+class RenderCancelled(RenderError):
+    def render(self) -> str:
+        return "Code highlighting cancelled."
+
+
+def error_message(exc: RenderError) -> str:
+    """exc as plain text (RenderError.render is html, for the editor)"""
+    if isinstance(exc, InvalidStyle):
+        return f"style {exc.args[0]!r} not found"
+    if isinstance(exc, LanguageNotFound):
+        return f"language {exc.args[0]!r} not found"
+    return exc.render()
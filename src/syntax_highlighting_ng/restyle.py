@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+Collection-wide re-style of the already highlighted code fragments
+
+The fragments generated by main.highlight_code are located in the note
+fields, their source text is recovered from the html and re-rendered with
+the current options on a process pool, and the notes are written back in
+batches (one collection update per batch).
+
+Each fragment is re-rendered in the language recorded in its data-language
+attribute (see html_render._HtmlFormatter). The fragments from before it was
+recorded get theirs from the fallback callable (eg. the detected or the deck
+default language), the ones still without a language are skipped.
+
+Only a small collection interface is used (get_note, update_notes and the
+note .fields list), so a fake collection can drive it in tests.
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+from __future__ import annotations
+
+import concurrent.futures
+import dataclasses as dc
+import html.parser
+import logging
+import re
+import threading
+from typing import Any, Callable, Iterable, Sequence
+
+from . import render_types
+
+log = logging.getLogger(__name__)
+
+FRAGMENT_RE = re.compile(
+    r"(?P<center><center>)?<table><tbody><tr><td>"
+    r"(?P<body><div class=\"highlight\"(?P<attrs>[^>]*)>.*?</div>\s*)"
+    r"</td></tr></tbody></table>(?(center)</center>)",
+    re.S,
+)
+LANGUAGE_RE = re.compile(r'\sdata-language="(?P<language>[^"]*)"')
+
+
+@dc.dataclass
+class Fragment:
+    start: int
+    end: int
+    source: str
+    centered: bool
+    language: str = ""  # the recorded alias
+
+
+@dc.dataclass
+class RestyleResult:
+    notes: int = 0
+    fragments: int = 0
+    skipped: int = 0  # no language (recorded nor from the fallback)
+    errors: list[tuple[int, str]] = dc.field(default_factory=list)
+    cancelled: bool = False
+
+
+class _SourceParser(html.parser.HTMLParser):
+    """collects the text inside <pre>, skipping the line numbers"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks: list[str] = []
+        self.inpre = False
+        self.depth = 0
+        self.skip_depth: int | None = None
+
+    @staticmethod
+    def is_lineno(attrs: list[tuple[str, str | None]]) -> bool:
+        values = dict(attrs)
+        if "linenos" in (values.get("class") or "").split():
+            return True
+        # inline styles (noclasses), see HtmlFormatter._linenos_style (the
+        # compact output has no spaces)
+        style = (values.get("style") or "").replace(" ", "")
+        return "padding-left:5px;padding-right:5px" in style
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "pre":
+            self.inpre = True
+        elif tag == "br" and self.inpre and self.skip_depth is None:
+            self.chunks.append("\n")
+        elif tag == "span" and self.inpre:
+            self.depth += 1
+            if self.skip_depth is None and self.is_lineno(attrs):
+                self.skip_depth = self.depth
+
+    def handle_endtag(self, tag):
+        if tag == "pre":
+            self.inpre = False
+        elif tag == "span" and self.inpre:
+            if self.skip_depth == self.depth:
+                self.skip_depth = None
+            self.depth -= 1
+
+    def handle_data(self, data):
+        if self.inpre and self.skip_depth is None:
+            self.chunks.append(data)
+
+
+def extract_source(body: str) -> str:
+    """recovers the source text from a rendered fragment"""
+    parser = _SourceParser()
+    parser.feed(body)
+    parser.close()
+    return "".join(parser.chunks).replace("\u00a0", " ").rstrip("\n")
+
+
+def find_fragments(field: str) -> list[Fragment]:
+    fragments = []
+    for m in FRAGMENT_RE.finditer(field):
+        found = LANGUAGE_RE.search(m.group("attrs"))
+        fragments.append(
+            Fragment(
+                m.start(),
+                m.end(),
+                extract_source(m.group("body")),
+                bool(m.group("center")),
+                html.unescape(found.group("language")) if found else "",
+            )
+        )
+    return fragments
+
+
+def _render(args: tuple[str, render_types.Style, bool]) -> str:
+    # runs in the worker processes
+    from . import html_render
+
+    source, style, centerfragments = args
+    return html_render.render_fragment(source, style, centerfragments)
+
+
+def restyle_notes(
+    col: Any,
+    note_ids: Sequence[int],
+    style: render_types.Style,
+    centerfragments: bool | None = None,
+    *,
+    fallback: Callable[[Any, Fragment], str] | None = None,
+    executor: concurrent.futures.Executor | None = None,
+    jobs: int | None = None,
+    batch_size: int = 200,
+    progress: Callable[[int, int], None] | None = None,
+    cancel: threading.Event | None = None,
+) -> RestyleResult:
+    """Re-renders all the fragments found in note_ids
+
+    Args:
+        col: the collection (get_note, update_notes)
+        note_ids: notes to process
+        style: the new style (the language is the one of each fragment)
+        centerfragments: force (or remove) the <center> wrapper, None keeps it
+        fallback: the language alias of a (note, fragment) with none recorded,
+            empty to skip it
+        executor: where to render, defaults to a pool of jobs processes
+        batch_size: notes written back with a single update_notes call
+        progress: called with (notes done, total notes) after each batch
+        cancel: stops the processing at the next batch
+    """
+    if executor is None:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as owned:
+            return restyle_notes(
+                col,
+                note_ids,
+                style,
+                centerfragments,
+                fallback=fallback,
+                executor=owned,
+                batch_size=batch_size,
+                progress=progress,
+                cancel=cancel,
+            )
+
+    result = RestyleResult()
+    for first in range(0, len(note_ids), batch_size):
+        if cancel is not None and cancel.is_set():
+            result.cancelled = True
+            break
+        batch = note_ids[first : first + batch_size]
+        _restyle_batch(col, batch, style, centerfragments, fallback, executor, result)
+        if progress:
+            progress(min(first + batch_size, len(note_ids)), len(note_ids))
+    return result
+
+
+def _restyle_batch(col, batch, style, centerfragments, fallback, executor, result):
+    notes = []
+    work: list[tuple[Any, int, Fragment, tuple[str, render_types.Style, bool]]] = []
+    for nid in batch:
+        note = col.get_note(nid)
+        found = False
+        for index, field in enumerate(note.fields):
+            for fragment in find_fragments(field):
+                if not fragment.language and fallback is not None:
+                    fragment.language = fallback(note, fragment)
+                if not fragment.language:
+                    result.skipped += 1
+                    continue
+                nstyle = dc.replace(style, language=fragment.language)
+                center = (
+                    fragment.centered if centerfragments is None else centerfragments
+                )
+                work.append((note, index, fragment, (fragment.source, nstyle, center)))
+                found = True
+        if found:
+            notes.append(note)
+
+    rendered = _map(executor, [args for *_, args in work])
+
+    # replace the fragments starting from the end of each field
+    changed = set()
+    for (note, index, fragment, _), body in reversed(list(zip(work, rendered))):
+        if isinstance(body, render_types.RenderError):
+            result.errors.append((note.id, body.args[0]))
+            continue
+        field = note.fields[index]
+        note.fields[index] = field[: fragment.start] + body + field[fragment.end :]
+        result.fragments += 1
+        changed.add(id(note))
+
+    updated = [note for note in notes if id(note) in changed]
+    if updated:
+        col.update_notes(updated)
+    result.notes += len(updated)
+
+
+def _map(executor, items: Iterable[tuple[str, render_types.Style, bool]]) -> list:
+    items = list(items)
+    try:
+        futures = [executor.submit(_render, args) for args in items]
+    except concurrent.futures.BrokenExecutor as exc:
+        log.warning("restyle pool not available, rendering in process: %s", exc)
+        futures = [None] * len(items)
+
+    results: list[str | render_types.RenderError] = []
+    for args, future in zip(items, futures):
+        try:
+            try:
+                results.append(_render(args) if future is None else future.result())
+            except concurrent.futures.BrokenExecutor:
+                results.append(_render(args))
+        except render_types.RenderError as exc:
+            results.append(exc)
+    return results
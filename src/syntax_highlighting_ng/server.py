@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+The render server: pygments in a long lived child process
+
+With the "renderServer" option the Anki process never loads pygments (nor
+the lexers, the formatters and their caches): RenderServer starts a child
+process owning them, with its own fragment cache, incremental renderer and
+language detector, and talks to it over a pipe. The Anki process reads the
+language index without pygments, the server builds it if missing or stale
+(OP_LANGUAGES, see languages.index_builder).
+
+The protocol is a list of requests per message (a batch), answered by a
+single message with the list of the responses, in order:
+
+    request   (id, op, args)     op: OP_RENDER, OP_WARM_UP, OP_INFO or OP_LANGUAGES
+    response  (id, ok, value)    value: the result, or the error (ok False)
+
+and before handling each request the server sends its id alone (a notice:
+the request is started).
+
+Many batches can be in flight (pipelining): a reader thread resolves the
+futures of the responses as they arrive.
+
+A crashed server is started again on the next request (until it crashed
+MAX_CRASHES times, then ServerUnavailable is raised and the caller renders in
+process), the requests in flight fail with ServerUnavailable. The budget of
+a render runs from its start notice (the time queued behind other requests
+doesn't count): past it the server is killed (see worker.RenderTimeout).
+Cancelling a started render kills the server too, it would keep running it.
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+from __future__ import annotations
+
+import concurrent.futures
+import dataclasses as dc
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from typing import Any, Iterable, Sequence
+
+from . import render_types, worker
+
+log = logging.getLogger(__name__)
+
+OP_RENDER = "render"  # (txt, style, centerfragments, candidates) -> (html, alias)
+OP_WARM_UP = "warm_up"  # (names, style, centerfragments, budget) -> aliases
+OP_INFO = "info"  # () -> dict
+OP_LANGUAGES = "languages"  # () -> the language index (json)
+
+# unexpected exits before giving up
+MAX_CRASHES = 3
+# how often the cancel event is checked while waiting
+POLL_INTERVAL = 0.05
+
+
+class ServerUnavailable(Exception):
+    """the server stopped (or can't start): render in process"""
+
+
+class ServerError(render_types.RenderError):
+    """an unexpected error in the server (a bug)"""
+
+    def render(self) -> str:
+        return f"<b>Error</b>: highlighting failed ({self.args[0]})."
+
+
+class _Request(concurrent.futures.Future):
+    """the future of a request, sent to process"""
+
+    def __init__(self, rid: int, process: Any):
+        super().__init__()
+        self.rid = rid
+        self.process = process
+        self.started: float | None = None  # time.monotonic() of the notice
+
+
+@dc.dataclass
+class ServerOptions:
+    # the server fragment cache, see fragment_cache.FragmentCache
+    maxbytes: int = 4 * 2**20
+    path: str | None = None  # on disk (None: in memory only)
+    maxdiskbytes: int = 32 * 2**20
+
+
+class _Handler:
+    # the server process state
+    def __init__(self, options: ServerOptions):
+        from . import detect, fragment_cache, incremental
+
+        self.cache = fragment_cache.FragmentCache(**dc.asdict(options))
+        self.incremental = incremental.Incremental()
+        self.detector = detect.Detector()
+
+    def render(self, txt, style, centerfragments, candidates):
+        if candidates:
+            found = self.detector.detect(txt, candidates)
+            if found is not None:
+                style = dc.replace(style, language=found.alias)
+        html = self.cache.render(
+            txt, style, centerfragments, render=self.incremental.render
+        )
+        return html, style.language
+
+    def warm_up(self, names, style, centerfragments, budget):
+        from . import startup
+
+        return startup.warm_up(
+            names,
+            lambda alias: dc.replace(style, language=alias),
+            centerfragments,
+            budget=budget,
+        ).warmed
+
+    def info(self):
+        from . import languages
+
+        return {
+            "pid": os.getpid(),
+            "pygments": languages.pygments_version(),
+            "cache": dc.asdict(self.cache.stats()),
+        }
+
+    def languages(self):
+        from . import languages
+
+        # read (or built) here, see languages.index_builder
+        return languages.get_index().dumps()
+
+    def handle(self, request: tuple[int, str, tuple]) -> tuple[int, bool, Any]:
+        rid, op, args = request
+        try:
+            if op == OP_RENDER:
+                return rid, True, self.render(*args)
+            if op == OP_WARM_UP:
+                return rid, True, self.warm_up(*args)
+            if op == OP_INFO:
+                return rid, True, self.info()
+            if op == OP_LANGUAGES:
+                return rid, True, self.languages()
+            raise ValueError(f"unknown op {op!r}")
+        except render_types.RenderError as exc:
+            return rid, False, exc
+        except Exception as exc:
+            log.exception("render server request %s failed", op)
+            return rid, False, ServerError(repr(exc))
+
+
+def serve(conn: Any, options: ServerOptions) -> None:
+    """the server process loop"""
+    from . import languages
+
+    # a forked server inherits the index builder asking the server
+    languages.index_builder = languages.build_index
+    handler = _Handler(options)
+    while True:
+        try:
+            batch = conn.recv()
+        except EOFError:
+            return
+        if batch is None:
+            return
+        responses = []
+        for request in batch:
+            conn.send(request[0])
+            responses.append(handler.handle(request))
+        conn.send(responses)
+
+
+class RenderServer:
+    """the client of the render server process (thread safe)"""
+
+    def __init__(
+        self,
+        options: ServerOptions | None = None,
+        context: Any = None,
+        max_crashes: int = MAX_CRASHES,
+        poll_interval: float = POLL_INTERVAL,
+    ):
+        self.options = options or ServerOptions()
+        self.context = context or multiprocessing.get_context()
+        self.max_crashes = max_crashes
+        self.poll_interval = poll_interval
+        self.started = 0  # the processes started
+        self.crashes = 0  # .. exited unexpectedly
+        self._process: Any = None
+        self._conn: Any = None
+        # request id -> request
+        self._pending: dict[int, _Request] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        return self.crashes < self.max_crashes
+
+    def submit_many(self, requests: Iterable[tuple[str, tuple]]) -> list[_Request]:
+        """sends the (op, args) requests as a single batch"""
+        with self._lock:
+            self._ensure_started()
+            batch = []
+            futures = []
+            for op, args in requests:
+                rid = next(self._ids)
+                future = _Request(rid, self._process)
+                self._pending[rid] = future
+                batch.append((rid, op, args))
+                futures.append(future)
+            try:
+                self._conn.send(batch)
+            except OSError as exc:
+                # the reader fails the futures in flight
+                for rid, _, _ in batch:
+                    self._pending.pop(rid, None)
+                raise ServerUnavailable(f"cannot send: {exc!r}") from exc
+        return futures
+
+    def submit(self, op: str, *args: Any) -> _Request:
+        return self.submit_many([(op, args)])[0]
+
+    def render(
+        self,
+        txt: str,
+        style: render_types.Style = render_types.Style(),
+        centerfragments: bool = False,
+        cancel: threading.Event | None = None,
+        *,
+        candidates: Sequence[str] = (),
+        budget: float | None = None,
+    ) -> tuple[str, str]:
+        """(html, alias): html_render.render_fragment in the server
+
+        The alias is the one detected among the candidates aliases (if any),
+        or style.language. Raises worker.RenderTimeout past budget seconds.
+        """
+        future = self.submit(OP_RENDER, txt, style, centerfragments, tuple(candidates))
+        return self.wait(future, cancel, budget)
+
+    def render_many(
+        self,
+        items: Iterable[tuple[str, render_types.Style, bool]],
+    ) -> list[_Request]:
+        """the futures of the (html, alias) for (txt, style, centerfragments)"""
+        return self.submit_many(
+            (OP_RENDER, (txt, style, centerfragments, ()))
+            for txt, style, centerfragments in items
+        )
+
+    def warm_up(
+        self,
+        names: Sequence[str],
+        style: render_types.Style,
+        centerfragments: bool = False,
+        budget: float = 2.0,
+    ) -> _Request:
+        """the future of the aliases warmed up, see startup.warm_up"""
+        return self.submit(OP_WARM_UP, list(names), style, centerfragments, budget)
+
+    def info(self) -> dict[str, Any]:
+        return self.wait(self.submit(OP_INFO))
+
+    def language_index(self) -> str:
+        """the language index json (see languages.LanguageIndex.dumps)"""
+        return self.wait(self.submit(OP_LANGUAGES))
+
+    def wait(
+        self,
+        future: _Request,
+        cancel: threading.Event | None = None,
+        budget: float | None = None,
+    ) -> Any:
+        """the result of future, the server is killed past budget seconds
+
+        (from the start of the request in the server)
+        """
+        while True:
+            try:
+                return future.result(timeout=self.poll_interval)
+            except concurrent.futures.TimeoutError:
+                pass
+            started = future.started
+            if cancel is not None and cancel.is_set():
+                if started is not None:
+                    # the server is running it, it can't be stopped otherwise
+                    self._kill("cancelled", future.process)
+                # (a queued one is dropped once done)
+                raise render_types.RenderCancelled()
+            if (
+                budget is not None
+                and started is not None
+                and time.monotonic() > started + budget
+            ):
+                self._kill(f"over budget ({budget:g}s)", future.process)
+                raise worker.RenderTimeout(budget)
+
+    def close(self) -> None:
+        """stops the process (it's started again on the next request)"""
+        with self._lock:
+            process, conn = self._process, self._conn
+            self._process = self._conn = None
+        if process is None:
+            return
+        try:
+            conn.send(None)
+        except OSError:
+            pass
+        process.join(self.poll_interval * 10)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+    def _ensure_started(self) -> None:
+        if self._process is not None:
+            return
+        if not self.available:
+            raise ServerUnavailable(f"stopped after {self.crashes} crashes")
+        conn, child = self.context.Pipe()
+        process = self.context.Process(
+            target=serve,
+            args=(child, self.options),
+            name="syntax_highlighting_ng-server",
+            daemon=True,
+        )
+        try:
+            process.start()
+        except OSError as exc:
+            self.crashes += 1
+            raise ServerUnavailable(f"cannot start: {exc!r}") from exc
+        finally:
+            child.close()
+        self._process, self._conn = process, conn
+        self.started += 1
+        threading.Thread(
+            target=self._read,
+            args=(process, conn),
+            name="syntax_highlighting_ng-server-reader",
+            daemon=True,
+        ).start()
+        log.info("render server started (pid %s)", process.pid)
+
+    def _read(self, process: Any, conn: Any) -> None:
+        # resolves the futures, until the server exits
+        while True:
+            try:
+                responses = conn.recv()
+            except (EOFError, OSError):
+                break
+            if isinstance(responses, int):
+                # the start notice
+                with self._lock:
+                    future = self._pending.get(responses)
+                if future is not None:
+                    future.started = time.monotonic()
+                continue
+            for rid, ok, value in responses:
+                with self._lock:
+                    future = self._pending.pop(rid, None)
+                if future is None:
+                    continue
+                try:
+                    if ok:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(value)
+                except concurrent.futures.InvalidStateError:
+                    # cancelled while queued
+                    pass
+
+        with self._lock:
+            crashed = self._process is process
+            if crashed:
+                # not closed (nor killed) by this side
+                self._process = self._conn = None
+                self.crashes += 1
+            pending = [
+                self._pending.pop(rid)
+                for rid, future in list(self._pending.items())
+                if future.process is process
+            ]
+        conn.close()
+        process.join()
+        if crashed:
+            log.warning(
+                "render server exited (code %s), %d requests lost",
+                process.exitcode,
+                len(pending),
+            )
+        for future in pending:
+            future.set_exception(ServerUnavailable("the server stopped"))
+
+    def _kill(self, reason: str, process: Any) -> None:
+        # only if still the current one (not already restarted)
+        with self._lock:
+            if process is None or process is not self._process:
+                return
+            self._process = self._conn = None
+        log.warning("render server killed: %s", reason)
+        process.kill()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+Deferred loading of the rendering machinery
+
+At import the add-on only registers its hooks: pygments, the language index
+and html_render are loaded by ensure_loaded on first use (or pre-warmed when
+Anki is idle, see the "preload" option). Each phase is timed and logged, so
+the startup cost can be tracked across releases.
+
+Once the profile is loaded, warm_up goes further (in background): it imports
+and instantiates the lexers for the languages the user is going to need (the
+default language and the per deck ones) and renders a tiny snippet with each,
+so the first highlight of the session doesn't pay for the lexer import, the
+regex compilation and the formatter style tables.
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+from __future__ import annotations
+
+import contextlib
+import dataclasses as dc
+import logging
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator
+
+from . import languages
+
+log = logging.getLogger(__name__)
+
+# preload modes (config.json "preload")
+PRELOAD_LAZY = "lazy"  # on first use of the editor button/hotkey
+PRELOAD_IDLE = "idle"  # in background, shortly after the profile is loaded
+PRELOAD_STARTUP = "startup"  # at import time (the old behaviour)
+PRELOAD_MODES = (PRELOAD_LAZY, PRELOAD_IDLE, PRELOAD_STARTUP)
+
+# warm_up CPU time budget (seconds)
+WARM_UP_BUDGET = 2.0
+# warm_up pause between the lexers, for the GUI thread
+WARM_UP_PAUSE = 0.01
+# rendered with each warmed up lexer
+WARM_UP_SAMPLE = "x = 1\n"
+
+# phase -> elapsed seconds
+PHASES: dict[str, float] = {}
+
+_lock = threading.Lock()
+_loaded = False
+
+
+def record(phase: str, start: float, logger: logging.Logger | None = None) -> None:
+    """records (in PHASES) and logs the time since start (a perf_counter)"""
+    PHASES[phase] = elapsed = time.perf_counter() - start
+    (logger or log).info("%s took %.1fms", phase, elapsed * 1000)
+
+
+@contextlib.contextmanager
+def timed(phase: str, logger: logging.Logger | None = None) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, start, logger)
+
+
+def is_loaded() -> bool:
+    return _loaded
+
+
+def ensure_loaded(style: str = "default", logger: logging.Logger | None = None):
+    """loads (once, thread safe) what's needed to render with style"""
+    global _loaded
+    if _loaded:
+        return
+    with _lock:
+        if _loaded:
+            return
+        with timed("import pygments", logger):
+            import pygments
+        (logger or log).info(
+            "addon syntax_highlighting_ng loaded pygments %s",
+            getattr(pygments, "__version__", "N/A"),
+        )
+        with timed("language index", logger):
+            languages.get_index()
+        with timed("import html_render", logger):
+            from . import html_render
+        with timed(f"formatter {style}", logger), contextlib.suppress(
+            html_render.InvalidStyle
+        ):
+            html_render.get_formatter(html_render.Style(style=style))
+        _loaded = True
+
+
+@dc.dataclass
+class WarmUp:
+    warmed: list[str] = dc.field(default_factory=list)  # the aliases
+    skipped: list[str] = dc.field(default_factory=list)  # the names
+    elapsed: float = 0.0
+    cpu: float = 0.0  # this thread CPU time
+    cancelled: bool = False
+
+
+def warm_up(
+    names: Iterable[str],
+    get_style: Callable[[str], Any],
+    centerfragments: bool = False,
+    budget: float = WARM_UP_BUDGET,
+    cancel: threading.Event | None = None,
+    logger: logging.Logger | None = None,
+    pause: float = WARM_UP_PAUSE,
+) -> WarmUp:
+    """loads the lexers for the language names, in order
+
+    Each lexer is instantiated in the html_render.LEXERS pool (as used for
+    rendering) and renders WARM_UP_SAMPLE with get_style(alias), building
+    the formatter too. It stops once budget seconds of CPU time are spent
+    or cancel is set: the names left (and the unknown ones) are skipped.
+    """
+    from . import html_render
+
+    cancel = cancel or threading.Event()
+    start = time.perf_counter()
+    start_cpu = time.thread_time()
+    result = WarmUp()
+    aliases = languages.names()
+    for name in dict.fromkeys(names):
+        alias = aliases.get(name)
+        if (
+            alias is None
+            or alias in result.warmed
+            or result.cancelled
+            or time.thread_time() - start_cpu >= budget
+        ):
+            result.skipped.append(name)
+            continue
+        # a pause (for the GUI thread), also waiting for cancel
+        if cancel.wait(pause):
+            result.cancelled = True
+            result.skipped.append(name)
+            continue
+        try:
+            with html_render.LEXERS.lexer(alias, stripall=True):
+                pass
+            html_render.render_fragment(
+                WARM_UP_SAMPLE, get_style(alias), centerfragments
+            )
+        except html_render.RenderError as exc:
+            (logger or log).warning("cannot warm up %s: %s", name, exc)
+            result.skipped.append(name)
+            continue
+        result.warmed.append(alias)
+
+    result.cpu = time.thread_time() - start_cpu
+    record("warm-up", start, logger)
+    result.elapsed = PHASES["warm-up"]
+    (logger or log).info(
+        "warmed up %s (%.1fms CPU), skipped: %s%s",
+        ", ".join(result.warmed) or "nothing",
+        result.cpu * 1000,
+        ", ".join(result.skipped) or "none",
+        " (cancelled)" if result.cancelled else "",
+    )
+    return result
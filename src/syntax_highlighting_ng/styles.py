@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+Precomputed tables of the pygments styles
+
+For every bundled style the token type -> inline css table (what
+HtmlFormatter computes at each instantiation) and the css classes
+stylesheet are generated ahead of time (make.py styles) into a json file
+shipped with the add-on, and loaded lazily: a style used the first time is
+a lookup and not a computation. Missing or stale (other pygments version)
+tables are ignored.
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+from __future__ import annotations
+
+import dataclasses as dc
+import functools
+import json
+import logging
+import os
+from typing import Any
+
+from . import consts, languages
+
+log = logging.getLogger(__name__)
+
+TABLES_PATH = os.path.join(consts.addon_path, "styles.json")
+
+# the stylesheet selector (the div wrapping the highlighted code)
+CSSCLASS = ".highlight"
+
+
+@dc.dataclass(frozen=True)
+class StyleTable:
+    # css class -> (inline css, token type, token type depth), the same
+    # as HtmlFormatter.class2style
+    class2style: dict[str, tuple[str, Any, int]]
+    stylesheet: str
+
+    @functools.cached_property
+    def ttype2class(self) -> dict[Any, str]:
+        from pygments.token import Token
+
+        result = {Token: ""}
+        for name, (_, ttype, _) in self.class2style.items():
+            result[ttype] = name
+        return result
+
+
+def build_tables() -> dict[str, Any]:
+    from pygments.formatters import HtmlFormatter
+    from pygments.styles import get_all_styles
+
+    styles = {}
+    for name in sorted(get_all_styles()):
+        formatter = HtmlFormatter(style=name)
+        styles[name] = {
+            "class2style": {
+                cls: [css, ".".join(ttype), depth]
+                for cls, (css, ttype, depth) in formatter.class2style.items()
+            },
+            "stylesheet": formatter.get_style_defs(CSSCLASS),
+        }
+    return {"version": languages.pygments_version(), "styles": styles}
+
+
+def write_tables(tables: dict[str, Any], path: str = TABLES_PATH) -> None:
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as fp:
+        json.dump(tables, fp, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+def read_tables(path: str = TABLES_PATH) -> dict[str, Any] | None:
+    """returns the stored tables by style name, or None if missing or stale"""
+    try:
+        with open(path, encoding="utf-8") as fp:
+            tables = json.load(fp)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as exc:
+        log.warning("cannot read style tables %s: %s", path, exc)
+        return None
+    if tables.get("version") != languages.pygments_version():
+        log.info("style tables %s are stale", path)
+        return None
+    return tables["styles"]
+
+
+@functools.lru_cache(maxsize=None)
+def get_tables() -> dict[str, Any]:
+    return read_tables() or {}
+
+
+@functools.lru_cache(maxsize=None)
+def table(name: str) -> StyleTable | None:
+    """the precomputed table for the style name (None if not available)"""
+    data = get_tables().get(name)
+    if data is None:
+        return None
+    from pygments.token import string_to_tokentype
+
+    return StyleTable(
+        class2style={
+            cls: (css, string_to_tokentype(ttype), depth)
+            for cls, (css, ttype, depth) in data["class2style"].items()
+        },
+        stylesheet=data["stylesheet"],
+    )
+
+
+def stylesheet(name: str) -> str:
+    """the css classes stylesheet for the style name"""
+    found = table(name)
+    if found is not None:
+        return found.stylesheet
+    from pygments.formatters import HtmlFormatter
+
+    return HtmlFormatter(style=name).get_style_defs(CSSCLASS)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+Unpacked vendored pygments
+
+Importing pygments straight from the shipped wheel goes through zipimport,
+that cannot cache the bytecode: every module is compiled again on each Anki
+start. The wheel is unpacked once in a versioned directory next to it (so
+the regular import machinery writes the .pyc files), make.py vendor does it
+ahead of time and precompiles all the modules.
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+from __future__ import annotations
+
+import compileall
+import logging
+import os
+import re
+import shutil
+import time
+import zipfile
+
+from .consts import addon_path
+
+log = logging.getLogger(__name__)
+
+WHEEL = os.path.join(addon_path, "libs", "pygments-2.18.0-py3-none-any.whl")
+
+# unpacked wheels and leftovers of interrupted unpacks
+UNPACKED_RE = re.compile(r".+-none-any(\.tmp\d+)?$")
+# (seconds) older temporary directories are leftovers
+TMP_MAX_AGE = 600
+
+
+def unpacked_path(wheel: str = WHEEL) -> str:
+    return wheel[: -len(".whl")]
+
+
+def unpack(wheel: str = WHEEL) -> str:
+    """unpacks wheel (once), returning the directory
+
+    The wheel is extracted in a temporary directory renamed in place at the
+    end, so a partial extraction is never used.
+    """
+    dest = unpacked_path(wheel)
+    if os.path.isdir(dest):
+        return dest
+    tmp = f"{dest}.tmp{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    with zipfile.ZipFile(wheel) as archive:
+        archive.extractall(tmp)
+    try:
+        os.rename(tmp, dest)
+    except OSError:
+        # unpacked in the meantime by another process?
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(dest):
+            raise
+    log.info("unpacked %s", wheel)
+    return dest
+
+
+def precompile(path: str) -> bool:
+    """compiles to bytecode all the modules under path"""
+    return bool(compileall.compile_dir(path, quiet=1))
+
+
+def cleanup(wheel: str = WHEEL) -> list[str]:
+    """removes the stale unpacked wheels, returning their paths"""
+    libs = os.path.dirname(wheel)
+    current = os.path.basename(unpacked_path(wheel))
+    removed = []
+    for name in os.listdir(libs):
+        path = os.path.join(libs, name)
+        if name == current or not UNPACKED_RE.match(name) or not os.path.isdir(path):
+            continue
+        if name.startswith(f"{current}.tmp") and (
+            time.time() - os.path.getmtime(path) < TMP_MAX_AGE
+        ):
+            # possibly an unpack in progress (see unpack)
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        removed.append(path)
+    return removed
+
+
+def pygments_path(wheel: str = WHEEL) -> str:
+    """the sys.path entry for the vendored pygments
+
+    This is the unpacked wheel, or the wheel itself (zipimport) when it
+    cannot be unpacked (eg. the add-on directory is not writable).
+    """
+    try:
+        path = unpack(wheel)
+    except (OSError, zipfile.BadZipFile) as exc:
+        log.warning("cannot unpack %s, importing from the zip: %s", wheel, exc)
+        return wheel
+    try:
+        for stale in cleanup(wheel):
+            log.info("removed stale %s", stale)
+    except OSError as exc:
+        log.warning("cannot cleanup %s: %s", os.path.dirname(wheel), exc)
+    return path
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+Insertion of the rendered fragments into the editor webview
+
+A fragment used to be inserted with a single eval of a json.dumps'ed
+execCommand call: for a large fragment that is one huge js source to send,
+parse and run at once, and the editor stalls. Above CHUNK_SIZE characters
+the fragment is sent in chunks instead, collected by the webview in
+window.shChunks[id] and inserted with a single execCommand at the end (so
+it's still a single undo step). Each chunk is sent from the callback of the
+previous one, so the Qt event loop keeps running in between.
+
+Each transfer has its own id: a transfer starting drops the chunks of the
+previous ones, whose remaining scripts are then ignored. The caller can
+also stop a transfer before the insertion (eg. the editor moved to another
+note), see insert_html.
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+from __future__ import annotations
+
+import dataclasses as dc
+import itertools
+import json
+import logging
+import time
+from typing import Any, Callable
+
+log = logging.getLogger(__name__)
+
+# the characters sent with each eval
+CHUNK_SIZE = 128 * 1024
+
+insert_js = "document.execCommand('inserthtml', false, %s);"
+
+# the first chunk (re)starts the collection, the last one inserts it: the
+# scripts of a stale transfer (the id is gone) do nothing
+start_chunks_js = "window.shChunks = {%d: [%s]};"
+add_chunk_js = "window.shChunks && window.shChunks[%d]?.push(%s);"
+insert_chunks_js = """(function() {
+    const chunks = window.shChunks && window.shChunks[%d];
+    if (!chunks) return;
+    delete window.shChunks;
+    document.execCommand('inserthtml', false, chunks.join(""));
+})();"""
+drop_chunks_js = "window.shChunks && delete window.shChunks[%d];"
+
+# the transfer ids
+_ids = itertools.count(1)
+
+
+@dc.dataclass
+class Transfer:
+    nbytes: int  # utf-8
+    scripts: int  # the evals
+    elapsed: float = 0.0  # from the first eval to the insertion
+    dropped: bool = False  # stopped before the insertion
+
+
+def insert_scripts(
+    html: str, chunk_size: int = CHUNK_SIZE, transfer_id: int = 0
+) -> list[str]:
+    """the js sources (to eval in order) inserting html at the cursor"""
+    if len(html) <= chunk_size:
+        return [insert_js % json.dumps(html)]
+    chunks = [html[i : i + chunk_size] for i in range(0, len(html), chunk_size)]
+    return [
+        start_chunks_js % (transfer_id, json.dumps(chunks[0])),
+        *(add_chunk_js % (transfer_id, json.dumps(chunk)) for chunk in chunks[1:]),
+        insert_chunks_js % transfer_id,
+    ]
+
+
+def insert_html(
+    web: Any,
+    html: str,
+    done: Callable[[Transfer], None] | None = None,
+    chunk_size: int = CHUNK_SIZE,
+    current: Callable[[], bool] | None = None,
+) -> Transfer:
+    """inserts html at the cursor of web (an AnkiWebView)
+
+    done(transfer) is called (on the Qt main thread) once inserted. current()
+    is checked before the insertion: when false the transfer is dropped (and
+    done is not called).
+    """
+    transfer_id = next(_ids)
+    scripts = insert_scripts(html, chunk_size, transfer_id)
+    transfer = Transfer(len(html.encode("utf-8")), len(scripts))
+    start = time.perf_counter()
+    pending = iter(enumerate(scripts, 1))
+
+    def send(_result: Any = None) -> None:
+        n, script = next(pending, (0, None))
+        if script is not None:
+            if n == len(scripts) and current is not None and not current():
+                transfer.dropped = True
+                log.debug("insertion dropped after %d evals", n - 1)
+                if n > 1:
+                    # the chunks collected so far
+                    web.eval(drop_chunks_js % transfer_id)
+                return
+            web.evalWithCallback(script, send)
+            return
+        transfer.elapsed = time.perf_counter() - start
+        log.debug(
+            "inserted %d bytes with %d evals in %.1fms",
+            transfer.nbytes,
+            transfer.scripts,
+            transfer.elapsed * 1000,
+        )
+        if done is not None:
+            done(transfer)
+
+    send()
+    return transfer
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of the Syntax Highlighting add-on for Anki.
+
+Rendering in a killable worker process, with a time budget
+
+Some regex based lexers backtrack catastrophically on malformed input: the
+render never ends and (in process) there's no way to stop it, the cancel
+event is only checked between the tokens. RenderWorker sends the renders to
+a child process instead and waits for at most budget seconds: past that (or
+when cancelled) the process is killed and RenderTimeout (or
+RenderCancelled) is raised, the caller can then insert the code as plain
+text (see main.highlight_code).
+
+The process is started on first use and reused for the next renders, so
+the spawn (and the pygments import) cost is paid once. It's not part of the
+budget: the process sends READY once pygments is imported, the clock starts
+then.
+
+Copyright: (c) 2023- A. Cavallo <https://github.com/cav71>
+License: GNU AGPLv3 <https://www.gnu.org/licenses/agpl.html>
+"""
+from __future__ import annotations
+
+import logging
+import multiprocessing
+import threading
+import time
+from typing import Any
+
+from . import render_types
+
+log = logging.getLogger(__name__)
+
+# seconds a render can take in the worker
+BUDGET = 5.0
+# how often the cancel event is checked while waiting
+POLL_INTERVAL = 0.05
+# sent by the process once started
+READY = "ready"
+
+
+class WorkerError(render_types.RenderError):
+    def render(self) -> str:
+        return (
+            "The highlighting process stopped unexpectedly, "
+            "the code is inserted as plain text."
+        )
+
+
+class RenderTimeout(WorkerError):
+    def render(self) -> str:
+        return (
+            f"Highlighting took more than {self.args[0]:g} seconds and was "
+            "stopped, the code is inserted as plain text."
+        )
+
+
+def _serve(conn: Any) -> None:
+    # the worker process loop: (txt, style, centerfragments) -> html | error
+    from . import html_render
+
+    conn.send(READY)
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        txt, style, centerfragments = request
+        try:
+            result: Any = html_render.render_fragment(txt, style, centerfragments)
+        except html_render.RenderError as exc:
+            result = exc
+        conn.send(result)
+
+
+class RenderWorker:
+    """html_render.render_fragment in a (reused) child process"""
+
+    def __init__(
+        self,
+        budget: float = BUDGET,
+        poll_interval: float = POLL_INTERVAL,
+        context: Any = None,
+    ):
+        self.budget = budget
+        self.poll_interval = poll_interval
+        self.context = context or multiprocessing.get_context()
+        self.started = 0  # the processes started
+        self.killed = 0  # .. and killed (timeouts, cancels and failures)
+        self._process: Any = None
+        self._conn: Any = None
+        self._lock = threading.Lock()
+
+    def render(
+        self,
+        txt: str,
+        style: render_types.Style = render_types.Style(),
+        centerfragments: bool = False,
+        cancel: threading.Event | None = None,
+    ) -> str:
+        """same as html_render.render_fragment, raises RenderTimeout"""
+        # one render at a time, the others wait (cancellable)
+        while not self._lock.acquire(timeout=self.poll_interval):
+            if cancel is not None and cancel.is_set():
+                raise render_types.RenderCancelled()
+        try:
+            return self._render(txt, style, centerfragments, cancel)
+        finally:
+            self._lock.release()
+
+    def _render(self, txt, style, centerfragments, cancel) -> str:
+        try:
+            if self._process is None or not self._process.is_alive():
+                self._start(cancel)
+            deadline = time.monotonic() + self.budget
+            self._conn.send((txt, style, centerfragments))
+            while not self._conn.poll(self.poll_interval):
+                if cancel is not None and cancel.is_set():
+                    self._kill("cancelled")
+                    raise render_types.RenderCancelled()
+                if time.monotonic() > deadline:
+                    self._kill(f"over budget ({self.budget:g}s)")
+                    raise RenderTimeout(self.budget)
+            result = self._conn.recv()
+        except (EOFError, OSError) as exc:
+            # the process died (or the pipe broke)
+            self._kill(f"failed: {exc!r}")
+            raise WorkerError(str(exc)) from exc
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _start(self, cancel: threading.Event | None = None) -> None:
+        self._conn, child = self.context.Pipe()
+        self._process = self.context.Process(
+            target=_serve,
+            args=(child,),
+            name="syntax_highlighting_ng-render",
+            daemon=True,
+        )
+        self._process.start()
+        child.close()
+        self.started += 1
+        # waits for the imports, EOFError if the process fails
+        while not self._conn.poll(self.poll_interval):
+            if cancel is not None and cancel.is_set():
+                self._kill("cancelled while starting")
+                raise render_types.RenderCancelled()
+        if self._conn.recv() != READY:
+            raise EOFError("unexpected start message")
+        log.debug("render worker started (pid %s)", self._process.pid)
+
+    def _kill(self, reason: str) -> None:
+        log.warning("render worker killed: %s", reason)
+        self.killed += 1
+        self._process.kill()
+        self._process.join()
+        self._conn.close()
+        self._process = self._conn = None
+
+    def close(self) -> None:
+        """stops the process (it's started again on the next render)"""
+        with self._lock:
+            if self._process is None:
+                return
+            try:
+                self._conn.send(None)
+            except OSError:
+                pass
+            self._process.join(self.poll_interval * 10)
+            if self._process.is_alive():
+                self._process.kill()
+                self._process.join()
+            self._conn.close()
+            self._process = self._conn = None
@@ -0,0 +1,122 @@
+"""imports syntax_highlighting_ng as anki does, against stub aqt/anki modules
+
+    python anki_addon.py CONF STATEMENTS
+
+CONF is the add-on local config (json, over config.json). The STATEMENTS
+run once the add-on is imported (so main too, unlike STANDALONE_ADDON=1),
+with main, mw and highlight(code, language) -> the inserted html in scope.
+"""
+from __future__ import annotations
+
+import json
+import sys
+import threading
+import types
+from pathlib import Path
+from unittest import mock
+
+conf, statements = json.loads(sys.argv[1]), sys.argv[2]
+
+anki = types.ModuleType("anki")
+anki.version = "23.10.1"  # type: ignore[attr-defined]
+anki.point_version = lambda: 231001  # type: ignore[attr-defined]
+hooks = types.ModuleType("anki.hooks")
+hooks.addHook = lambda hook, fn: None  # type: ignore[attr-defined]
+hooks.wrap = lambda old, *_: old  # type: ignore[attr-defined]
+
+qt = types.ModuleType("aqt.qt")
+qt.__all__ = [  # type: ignore[attr-defined]
+    "QAction",
+    "QApplication",
+    "QCheckBox",
+    "QComboBox",
+    "QDialog",
+    "QGridLayout",
+    "QIcon",
+    "QKeySequence",
+    "QLabel",
+    "QProgressDialog",
+    "QPushButton",
+    "QSplitter",
+    "QTimer",
+    "Qt",
+]
+for name in qt.__all__:  # type: ignore[attr-defined]
+    setattr(qt, name, mock.MagicMock(name=name))
+
+
+class Editor:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def onBridgeCmd(self, cmd):
+        pass
+
+
+mw = mock.MagicMock(name="mw")
+mw.addonManager.getConfig.return_value = dict(
+    json.loads(
+        Path(__file__)
+        .parent.parent.parent.joinpath("src/syntax_highlighting_ng/config.json")
+        .read_text()
+    ),
+    **conf,
+)
+mw.col.decks.current.return_value = {"name": "Default"}
+# the callbacks run right away (on the calling thread)
+mw.taskman.run_on_main.side_effect = lambda fn: fn()
+aqt = types.ModuleType("aqt")
+aqt.mw = mw  # type: ignore[attr-defined]
+
+sys.modules.update(
+    {
+        "anki": anki,
+        "anki.hooks": hooks,
+        "aqt": aqt,
+        "aqt.qt": qt,
+        "aqt.main": types.SimpleNamespace(AnkiQt=object),  # type: ignore[dict-item]
+        "aqt.editor": types.SimpleNamespace(Editor=Editor),  # type: ignore[dict-item]
+        "aqt.utils": mock.MagicMock(name="aqt.utils"),
+    }
+)
+
+from syntax_highlighting_ng import config, main  # noqa: E402
+
+mw.col.conf = {config.KEY: dict(config.default_conf)}
+
+
+class Web:
+    def __init__(self, code: str):
+        self.code = code
+        self.inserted: str | None = None
+        self.done = threading.Event()
+
+    def selectedText(self):
+        return self.code
+
+    def eval(self, js):
+        pass
+
+    def evalWithCallback(self, js, cb):
+        if "execCommand('inserthtml'" in js:
+            self.inserted = js
+            self.done.set()
+        cb(None)
+
+
+class StubEditor:
+    def __init__(self, code: str, language: str):
+        self.web = Web(code)
+        self.note = None
+        self.parentWindow = None
+        self.codeHighlightLangAlias = language
+
+
+def highlight(code: str, language: str) -> str | None:
+    ed = StubEditor(code, language)
+    main.highlight_code(ed)
+    ed.web.done.wait(60)
+    return ed.web.inserted
+
+
+exec(statements)
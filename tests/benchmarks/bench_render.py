@@ -0,0 +1,120 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import io
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import html_render, incremental, languages
+
+from corpus import SEEDS, SIZES, make_snippet, max_lines, repeats
+
+CASES = [
+    (language, lines) for language in SEEDS for lines in SIZES if lines <= max_lines()
+]
+
+
+def test_import_time(bench):
+    # a fresh interpreter each time, so nothing is cached in sys.modules
+    code = (
+        "import time; start = time.perf_counter(); "
+        "import syntax_highlighting_ng.html_render; "
+        "print(time.perf_counter() - start)"
+    )
+    srcdir = Path(__file__).parent.parent.parent / "src"
+    env = dict(os.environ, STANDALONE_ADDON="1", PYTHONPATH=str(srcdir))
+    timings = [
+        float(subprocess.check_output([sys.executable, "-c", code], env=env))
+        for _ in range(5)
+    ]
+    bench.record("import", min(timings))
+
+
+@pytest.mark.parametrize("language", list(SEEDS))
+def test_lexer_lookup(fake_anki21, bench, language):
+    languages.lexer_class(language)  # module import, once per process
+    bench.time(
+        f"lookup/{language}",
+        lambda: html_render.LexerRegistry().lexer_class(language),
+        repeat=100,
+    )
+
+    def acquire():
+        with html_render.LEXERS.lexer(language, stripall=True):
+            pass
+
+    bench.time(f"lookup/{language}/registry", acquire, repeat=100)
+
+
+@pytest.mark.parametrize("language, lines", CASES)
+def test_render_stages(fake_anki21, bench, language, lines):
+    src = make_snippet(language, lines)
+    style = html_render.Style(language=language)
+    name = f"{language}/{lines}"
+
+    with html_render.LEXERS.lexer(language, stripall=True) as lexer:
+        tokens = bench.time(
+            f"{name}/lexing", lambda: list(lexer.get_tokens(src)), repeats(lines)
+        )
+
+    def format():
+        formatter = html_render.get_formatter(style, anki=True)
+        out = io.StringIO()
+        formatter.format(tokens, out)
+        return out.getvalue()
+
+    html = bench.time(f"{name}/formatting", format, repeats(lines))
+    bench.time(
+        f"{name}/process_html", lambda: html_render.process_html(html), repeats(lines)
+    )
+
+    bench.record(f"{name}/bytes", len(html.encode("utf-8")), "bytes")
+    compact = html_render.render_fragment(
+        src, html_render.Style(language=language, compact=True)
+    )
+    bench.record(f"{name}/bytes/compact", len(compact.encode("utf-8")), "bytes")
+
+
+@pytest.mark.parametrize("language, lines", CASES)
+def test_highlight_code(stub_editor, bench, language, lines):
+    main, Editor = stub_editor
+    src = make_snippet(language, lines)
+    editor = Editor(src, language)
+
+    def highlight():
+        main.highlight_code(editor)
+        return editor.wait()
+
+    js = bench.time(f"{language}/{lines}/highlight_code", highlight, repeats(lines))
+    assert "document.execCommand('inserthtml'" in js
+    bench.record(f"{language}/{lines}/evals", len(editor.web.scripts), "count")
+
+
+@pytest.mark.parametrize(
+    "language, lines", [(lang, n) for lang, n in CASES if n >= 1000]
+)
+def test_incremental_edit(fake_anki21, bench, language, lines):
+    src = make_snippet(language, lines)
+    style = html_render.Style(language=language)
+    block = incremental.render_block(src, style)
+    # a typo fixed in the middle
+    rows = src.splitlines(keepends=True)
+    rows[lines // 2] = "x" + rows[lines // 2]
+    edited = "".join(rows)
+
+    found = bench.time(
+        f"{language}/{lines}/incremental",
+        lambda: incremental.render_block(edited, style, previous=block),
+        repeats(lines),
+    )
+    assert found.html == html_render.render_fragment(edited, style)
+    if found.incremental:
+        bench.record(f"{language}/{lines}/incremental/relexed", found.relexed, "lines")
@@ -0,0 +1,88 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import multiprocessing
+import os
+import time
+
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import html_render, incremental, server
+
+from corpus import SEEDS, SIZES, make_snippet, max_lines, repeats
+
+CASES = [
+    (language, lines) for language in SEEDS for lines in SIZES if lines <= max_lines()
+]
+BATCH = 50
+
+
+@pytest.fixture(scope="module")
+def render_server():
+    # no caches (nor incremental re-rendering), here and in the server: it's
+    # the same html_render.render_fragment call, plus the round trip
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(html_render, "TOKENS", html_render.TokenCache(maxchars=0))
+        monkeypatch.setattr(
+            incremental.Incremental,
+            "render",
+            lambda self, *args: html_render.render_fragment(*args),
+        )
+        render_server = server.RenderServer(
+            server.ServerOptions(maxbytes=0),
+            context=multiprocessing.get_context("fork"),
+        )
+        start = time.perf_counter()
+        render_server.info()
+        elapsed = time.perf_counter() - start
+        yield render_server, elapsed
+        render_server.close()
+
+
+def test_server_start(fake_anki21, bench, render_server):
+    render_server, elapsed = render_server
+    bench.record("server/start", round(elapsed, 6))
+    bench.time("server/roundtrip", render_server.info, repeat=100)
+
+
+@pytest.mark.parametrize("language, lines", CASES)
+def test_server_render(fake_anki21, bench, render_server, language, lines):
+    render_server, _ = render_server
+    src = make_snippet(language, lines)
+    style = html_render.Style(language=language)
+    name = f"{language}/{lines}"
+
+    html = bench.time(
+        f"{name}/in_process",
+        lambda: html_render.render_fragment(src, style),
+        repeats(lines),
+    )
+    found, _ = bench.time(
+        f"{name}/server", lambda: render_server.render(src, style), repeats(lines)
+    )
+    assert found == html
+
+
+def test_server_batch(fake_anki21, bench, render_server):
+    render_server, _ = render_server
+    items = [
+        (make_snippet(language, 1), html_render.Style(language=language), False)
+        for language in SEEDS
+    ] * (BATCH // len(SEEDS))
+
+    def one_by_one():
+        return [render_server.render(*item)[0] for item in items]
+
+    def batched():
+        return [future.result()[0] for future in render_server.render_many(items)]
+
+    expected = bench.time("server/sequential", one_by_one)
+    assert bench.time("server/batched", batched) == expected
+    bench.time(
+        "server/in_process",
+        lambda: [html_render.render_fragment(*item) for item in items],
+    )
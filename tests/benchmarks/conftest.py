@@ -0,0 +1,185 @@
+from __future__ import annotations
+import importlib
+import json
+import os
+import platform
+import queue
+import sys
+import time
+import types
+from pathlib import Path
+from typing import Any, Callable
+from unittest import mock
+
+import pytest
+
+# the benchmark modules are named bench_*.py so the plain test runs skip
+# them, use "make.py benchmark" (or pytest -o python_files="bench_*.py")
+
+
+class Bench:
+    def __init__(self):
+        self.results: dict[str, dict[str, Any]] = {}
+
+    def record(self, name: str, value: float, kind: str = "time") -> None:
+        self.results[name] = {"kind": kind, "value": value}
+
+    def time(self, name: str, fn: Callable[[], Any], repeat: int = 5) -> Any:
+        "records the best of repeat runs of fn, returns its last result"
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = fn()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        self.record(name, round(best, 6))
+        return result
+
+    def dumps(self) -> str:
+        import pygments
+
+        meta = {
+            "python": platform.python_version(),
+            "platform": sys.platform,
+            "machine": platform.machine(),
+            "pygments": getattr(pygments, "__version__", "N/A"),
+        }
+        return json.dumps(
+            {"meta": meta, "results": dict(sorted(self.results.items()))}, indent=2
+        )
+
+
+BENCH = Bench()
+
+
+@pytest.fixture(scope="session")
+def bench():
+    return BENCH
+
+
+def pytest_sessionfinish(session, exitstatus):
+    output = os.getenv("BENCHMARK_OUTPUT")
+    if output and BENCH.results:
+        Path(output).parent.mkdir(parents=True, exist_ok=True)
+        Path(output).write_text(BENCH.dumps())
+
+
+@pytest.fixture(scope="function")
+def stub_editor(fake_anki21, monkeypatch):
+    """imports syntax_highlighting_ng.main against stubbed aqt modules
+
+    Yields (main, StubEditor): main.highlight_code(StubEditor(code, alias))
+    followed by editor.wait() runs the whole path up to the webview insert.
+    """
+    import syntax_highlighting_ng
+
+    local_conf = json.loads(
+        Path(syntax_highlighting_ng.__file__).parent.joinpath("config.json").read_text()
+    )
+    # no fragment cache and no size limits, we want to time the rendering
+    local_conf.update(cacheDiskMB=0, cacheMemoryMB=0)
+    local_conf["sizeLimits"] = dict.fromkeys(local_conf["sizeLimits"], 2**30)
+
+    qt = types.ModuleType("aqt.qt")
+    qt.__all__ = [
+        "QAction",
+        "QApplication",
+        "QCheckBox",
+        "QComboBox",
+        "QDialog",
+        "QGridLayout",
+        "QIcon",
+        "QKeySequence",
+        "QLabel",
+        "QProgressDialog",
+        "QPushButton",
+        "QSplitter",
+        "Qt",
+    ]
+    for name in qt.__all__:
+        setattr(qt, name, mock.MagicMock(name=name))
+
+    class Editor:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def onBridgeCmd(self, cmd):
+            pass
+
+    modules = {
+        "aqt.qt": qt,
+        "aqt.main": types.SimpleNamespace(AnkiQt=object),
+        "aqt.editor": types.SimpleNamespace(Editor=Editor),
+        "aqt.utils": mock.MagicMock(name="aqt.utils"),
+    }
+    for name, module in modules.items():
+        monkeypatch.setitem(sys.modules, name, module)
+    monkeypatch.setattr(sys.modules["anki.hooks"], "wrap", lambda old, *_: old, False)
+
+    mw = sys.modules["aqt.mw"]
+    monkeypatch.setattr(mw, "_addon_manager", mock.MagicMock(), False)
+    mw.addonManager.getConfig.return_value = local_conf
+    monkeypatch.setattr(mw, "form", mock.MagicMock(), False)
+    monkeypatch.setattr(mw, "col", mock.MagicMock(), False)
+    monkeypatch.setattr(mw, "taskman", mock.MagicMock(), False)
+    # like anki, the callbacks run later on the "main" thread (see wait)
+    main_queue: queue.Queue[Callable[[], None]] = queue.Queue()
+    mw.taskman.run_on_main.side_effect = main_queue.put
+
+    for name in ["syntax_highlighting_ng.config", "syntax_highlighting_ng.main"]:
+        monkeypatch.delitem(sys.modules, name, False)
+    config = importlib.import_module("syntax_highlighting_ng.config")
+    main = importlib.import_module("syntax_highlighting_ng.main")
+
+    mw.col.conf = {config.KEY: dict(config.default_conf)}
+    mw.col.decks.current.return_value = {"name": "Default"}
+    main.get_fragment_cache.cache_clear()
+    # nor incremental rendering (the same snippet is rendered again)
+    main.get_incremental.cache_clear()
+    monkeypatch.setattr(main.get_incremental(), "min_lines", sys.maxsize)
+    # nor token streams cache
+    html_render = importlib.import_module("syntax_highlighting_ng.html_render")
+    monkeypatch.setattr(html_render, "TOKENS", html_render.TokenCache(maxchars=0))
+
+    class Web:
+        def __init__(self, code: str):
+            self.code = code
+            self.js: str | None = None
+            self.scripts: list[str] = []
+
+        def selectedText(self):
+            return self.code
+
+        def eval(self, js):
+            self.evalWithCallback(js, None)
+
+        def evalWithCallback(self, js, cb):
+            # like the webview, the callback runs later on the main thread
+            self.scripts.append(js)
+            if "execCommand('inserthtml'" in js:
+                self.js = js
+            if cb is not None:
+                main_queue.put(lambda: cb(None))
+
+    class StubEditor:
+        def __init__(self, code: str, language: str):
+            self.web = Web(code)
+            self.note = None
+            self.parentWindow = None
+            self.codeHighlightLangAlias = language
+
+        def wait(self, timeout: float = 600) -> str:
+            "runs the main thread callbacks until the html is inserted"
+            self.web.js = None
+            self.web.scripts = []
+            while self.web.js is None:
+                try:
+                    main_queue.get(timeout=timeout)()
+                except queue.Empty:
+                    raise TimeoutError("highlight_code didn't complete") from None
+            return self.web.js
+
+    yield main, StubEditor
+    main.get_renderer().shutdown()
+    main.get_renderer.cache_clear()
+    main.get_fragment_cache.cache_clear()
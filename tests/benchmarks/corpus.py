@@ -0,0 +1,64 @@
+"""snippets corpus for the benchmarks, by language and size"""
+
+from __future__ import annotations
+import os
+from pathlib import Path
+
+SIZES = [1, 100, 5_000, 50_000]
+
+# seed snippets, repeated up to the requested number of lines
+SEEDS = {
+    "python": Path(__file__).parent.parent.joinpath("conftest.py").read_text(),
+    "cpp": """\
+#include <map>
+#include <string>
+
+template <typename T>
+class Counter {
+  public:
+    void add(const T &key) { counts_[key] += 1; }  // count {{key}}
+    int get(const T &key) const {
+        auto it = counts_.find(key);
+        return it == counts_.end() ? 0 : it->second;
+    }
+  private:
+    std::map<T, int> counts_;
+};
+""",
+    "javascript": """\
+/* render the cards */
+export async function render(cards, { limit = 10 } = {}) {
+  const out = [];
+  for (const card of cards.slice(0, limit)) {
+    out.push(`<div class="card">${card.front}::${card.back}</div>`);
+  }
+  return out.join("\\n");
+}
+""",
+    "sql": """\
+SELECT n.id, n.flds, c.ivl
+  FROM notes AS n
+  JOIN cards AS c ON c.nid = n.id
+ WHERE n.flds LIKE '%<div class="highlight"%'
+   AND c.ivl > 21 -- mature
+ ORDER BY c.ivl DESC;
+""",
+    "text": """\
+Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod
+tempor incididunt ut labore et dolore magna aliqua {{c1::cloze}}.
+""",
+}
+
+
+def make_snippet(language: str, lines: int) -> str:
+    seed = SEEDS[language].splitlines()
+    return "\n".join(seed[i % len(seed)] for i in range(lines)) + "\n"
+
+
+def max_lines() -> int:
+    return int(os.getenv("BENCHMARK_MAX_LINES", SIZES[-1]))
+
+
+def repeats(lines: int) -> int:
+    # more runs for the small inputs, where the timer noise dominates
+    return max(1, min(20, 10_000 // lines))
@@ -0,0 +1,59 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import os
+import threading
+
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import background, html_render
+
+
+def test_submit(fake_anki21):
+    renderer = background.BackgroundRenderer()
+    release = threading.Event()
+    finished = []
+    done = threading.Event()
+
+    def render(cancel):
+        release.wait(5)
+        return html_render.render_fragment("a = 1", cancel=cancel)
+
+    def callback(job):
+        finished.append(job)
+        done.set()
+
+    job = renderer.submit("editor", render, callback)
+    assert job is not None
+    # repeated presses while the job is running are ignored
+    assert renderer.submit("editor", render, callback) is None
+    # .. but not for other editors
+    other = renderer.submit("other", lambda cancel: "other", lambda job: None)
+    assert other.future.result() == "other"
+
+    release.set()
+    assert done.wait(5)
+    assert finished == [job]
+    assert job.result() == html_render.render_fragment("a = 1")
+    assert renderer.jobs == {}
+    renderer.shutdown()
+
+
+def test_cancel(fake_anki21):
+    renderer = background.BackgroundRenderer()
+    started = threading.Event()
+
+    def render(cancel):
+        started.set()
+        cancel.wait(5)
+        return html_render.render_fragment("a = 1", cancel=cancel)
+
+    job = renderer.submit("editor", render, lambda job: None)
+    assert started.wait(5)
+    renderer.cancel_all()
+    pytest.raises(html_render.RenderCancelled, job.result)
+    renderer.shutdown()
@@ -0,0 +1,94 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import concurrent.futures
+import csv
+import io
+import os
+
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import bulk, html_render
+
+TABLE = """\
+front,code,lang
+print,"print({'a': 1}[""a""])",python
+query,"SELECT * FROM t WHERE x < 1;",SQL
+bad,{{c1::foo}} < 1,nosuchlang
+cpp,"int main() { return {{0}}; }",C++
+empty,,python
+"""
+
+
+def read_output(txt):
+    lines = txt.splitlines(keepends=True)
+    assert lines[:3] == [
+        "#separator:tab\n",
+        "#html:true\n",
+        "#columns:front\tcode\tlang\n",
+    ]
+    return list(csv.reader(lines[3:], dialect=csv.excel_tab))
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_bulk(fake_anki21, jobs):
+    out = io.StringIO()
+    style = html_render.Style(language="text")
+    result = bulk.bulk(
+        io.StringIO(TABLE), out, ["code"], style, language_column="lang", jobs=jobs
+    )
+    assert (result.rows, result.cells) == (5, 3)
+    assert result.errors == [
+        bulk.RowError(3, "code", "language 'nosuchlang' not found")
+    ]
+
+    rows = read_output(out.getvalue())
+    assert [row[0] for row in rows] == ["print", "query", "bad", "cpp", "empty"]
+    python = html_render.Style(language="python")
+    assert rows[0][1] == html_render.render_fragment("print({'a': 1}[\"a\"])", python)
+    # "C++" is a (case insensitive) alias too, recorded as given
+    cpp = html_render.Style(language="C++")
+    assert rows[3][1] == html_render.render_fragment(
+        "int main() { return {{0}}; }", cpp
+    )
+    assert "{{" not in rows[3][1]
+    # kept as text, escaped as the fragments
+    assert rows[2][1] == html_render.anki_escape("{{c1::foo}} &lt; 1")
+    assert "{{" not in rows[2][1] and "::" not in rows[2][1]
+    assert rows[4][1] == ""
+
+
+def test_highlight_rows_window(fake_anki21):
+    consumed = []
+
+    def rows():
+        for i in range(50):
+            consumed.append(i)
+            yield {"code": f"x = {i}"}
+
+    style = html_render.Style(language="python")
+    result = bulk.BulkResult()
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        found = bulk.highlight_rows(
+            rows(), ["code"], style, executor=executor, window=3, result=result
+        )
+        for i, row in enumerate(found):
+            assert f"{i}</span>" in row["code"]
+            # bounded read ahead
+            assert len(consumed) <= i + 3
+    assert (result.rows, result.cells) == (50, 50)
+
+
+def test_bulk_missing_column(fake_anki21):
+    with pytest.raises(ValueError, match="nope"):
+        bulk.bulk(io.StringIO(TABLE), io.StringIO(), ["nope"], html_render.Style())
+
+
+def test_sniff_dialect(fake_anki21):
+    assert bulk.sniff_dialect(io.StringIO("a;b\n1;2\n")).delimiter == ";"
+    assert bulk.sniff_dialect(io.StringIO(TABLE)).delimiter == ","
+    assert bulk.sniff_dialect(io.StringIO("a,b"), "x.tsv") is csv.excel_tab
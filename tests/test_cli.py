@@ -0,0 +1,82 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import io
+import json
+import os
+import sys
+
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import cli, html_render
+
+FILES = {
+    "a.py": "def f(x):\n    return {'a': x} & 1 < 2\n",
+    "b.sql": "SELECT a FROM t WHERE b = 'x';\n",
+    "sub/c.js": "const x = 1;\n",
+    "README": "not collected",
+    ".hidden/d.py": "x = 1\n",
+}
+
+
+@pytest.fixture()
+def tree(tmp_path):
+    for name, txt in FILES.items():
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(txt)
+    return tmp_path
+
+
+def test_collect(fake_anki21, tree):
+    found = [os.path.relpath(p, tree) for p in cli.collect([str(tree)])]
+    assert found == ["a.py", "b.sql", os.path.join("sub", "c.js")]
+
+    found = [os.path.relpath(p, tree) for p in cli.collect([str(tree)], ["*.py"])]
+    assert found == ["a.py"]
+
+    # explicit files are always taken
+    assert list(cli.collect([str(tree / "README")])) == [str(tree / "README")]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_main_jsonl(fake_anki21, tree, capsys, jobs):
+    assert cli.main([str(tree), "-f", "jsonl", "-j", str(jobs), "--compact"]) == 0
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [r["language"] for r in records] == ["python", "sql", "javascript"]
+
+    style = html_render.Style(language="python", compact=True)
+    assert records[0]["html"] == html_render.render_fragment(FILES["a.py"], style)
+
+
+def test_main_html(fake_anki21, tree, tmp_path):
+    output = tmp_path / "out.html"
+    path = str(tree / "a.py")
+    assert cli.main([path, "--no-linenos", "--center", "-o", str(output)]) == 0
+
+    style = html_render.Style(linenos=False, language="python")
+    expected = html_render.render_fragment(FILES["a.py"], style, True)
+    assert output.read_text() == expected + "\n"
+
+
+def test_main_stdin(fake_anki21, monkeypatch, capsys):
+    monkeypatch.setattr(sys, "stdin", io.StringIO(FILES["a.py"]))
+    assert cli.main(["-l", "python"]) == 0
+    html = capsys.readouterr().out
+    assert html.startswith("<table><tbody><tr><td>")
+    assert "&#39;a&#39;" in html and "&amp;" in html
+
+
+def test_main_errors(fake_anki21, tree, capsys):
+    assert cli.main([str(tree / "a.py"), str(tree / "missing.py")]) == 1
+    captured = capsys.readouterr()
+    assert "<!-- " in captured.out
+    assert "missing.py" in captured.err
+
+    assert cli.main(["-l", "nope", str(tree / "a.py"), "-f", "jsonl"]) == 1
+    record = json.loads(capsys.readouterr().out)
+    assert record["error"] == "language 'nope' not found"
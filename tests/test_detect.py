@@ -0,0 +1,92 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import os
+
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import detect
+
+CANDIDATES = ["python", "cpp", "javascript", "sql", "bash"]
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("#!/usr/bin/env python3\nprint(1)\n", ("python", "shebang")),
+        ("#!/bin/sh\nls\n", ("bash", "shebang")),
+        ("#!/usr/bin/node\nfoo()\n", ("javascript", "shebang")),
+        ("```cpp\nint x;\n```\n", ("cpp", "fence")),
+        ("```js\nx()\n```\n", ("javascript", "fence")),
+        (
+            "import os\n\ndef main():\n    return os.getcwd()\n",
+            ("python", "keywords"),
+        ),
+        (
+            "#include <vector>\nstd::vector<int> v;\ntemplate <class T> T f();\n",
+            ("cpp", "keywords"),
+        ),
+        ("select *\n  from notes\n where id = 1;\n", ("sql", "keywords")),
+    ],
+)
+def test_detect(fake_anki21, text, expected):
+    found = detect.detect(text, CANDIDATES)
+    assert found is not None
+    assert (found.alias, found.method) == expected
+
+
+def test_detect_candidates(fake_anki21):
+    # only the candidates are considered
+    text = "#!/usr/bin/env python\nimport os\n"
+    assert detect.detect(text, ["cpp", "sql"]) is None
+    assert detect.detect(text, []) is None
+    # aliases of the candidates are recognized
+    assert detect.detect("```py3\nx = 1\n```", ["python"]).alias == "python"
+
+
+def test_detect_analyse_text(fake_anki21, monkeypatch):
+    # no cheap signal here, the lexers have the last word
+    text = "<?php\necho 1;\n"
+    found = detect.detect(text, ["python", "php"])
+    assert found == detect.Detection("php", "analyse_text")
+
+    # an exhausted budget stops before the analyse_text calls
+    assert detect.detect(text, ["python", "php"], budget=-1) is None
+
+    # analyse_text sees a bounded sample
+    samples = []
+
+    class Lexer:
+        @staticmethod
+        def analyse_text(sample):
+            samples.append(len(sample))
+            return 0.5
+
+    monkeypatch.setattr(detect.languages, "lexer_class", lambda alias: Lexer)
+    assert detect.by_analyse_text("x" * 10**5, ["python"], 1.0) == "python"
+    assert samples == [detect.ANALYSE_SIZE]
+
+
+def test_detector_cache(fake_anki21, monkeypatch):
+    detector = detect.Detector(maxsize=2)
+    calls = []
+
+    def fake_detect(text, candidates, budget):
+        calls.append(text)
+        return detect.Detection(candidates[0], "keywords")
+
+    monkeypatch.setattr(detect, "detect", fake_detect)
+
+    assert detector.detect("a", ["python"]).alias == "python"
+    assert detector.detect("a", ["python"]).alias == "python"
+    assert detector.detect("a", ["sql"]).alias == "sql"
+    assert calls == ["a", "a"]
+    assert (detector.hits, detector.misses) == (1, 2)
+
+    detector.detect("b", ["python"])
+    detector.detect("a", ["python"])
+    assert calls == ["a", "a", "b", "a"]
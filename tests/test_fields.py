@@ -0,0 +1,158 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import concurrent.futures
+import os
+import threading
+
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import fields, fragment_cache, html_render, limits, server
+
+CODE = "def f(x):\n    return {'a': x} & 1 < 2"
+
+
+def get_style(language):
+    return html_render.Style(language=language)
+
+
+class BrokenExecutor(concurrent.futures.Executor):
+    def submit(self, fn, *args, **kwargs):
+        raise concurrent.futures.BrokenExecutor("gone")
+
+
+class StuckExecutor(concurrent.futures.Executor):
+    "a pool busy on a runaway render"
+
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        self.futures.append(concurrent.futures.Future())
+        return self.futures[-1]
+
+
+@pytest.mark.parametrize(
+    "field, text",
+    [
+        ("a = 1", "a = 1"),
+        ("<div>a &lt; 1</div><div>b&nbsp;= 2<br></div>", "a < 1\nb = 2"),
+        ("if x:<br>&nbsp; &nbsp; y()", "if x:\n    y()"),
+        ("<p>x</p><p></p><p>y</p>", "x\ny"),
+    ],
+)
+def test_field_text(field, text):
+    assert fields.field_text(field) == text
+
+
+def test_field_text_highlighted(fake_anki21):
+    style = html_render.Style(linenos="inline")
+    rendered = html_render.render_fragment(CODE, style, True)
+    # re-rendered from the source, not the line numbers
+    assert fields.field_text("<b>x</b>" + rendered) == CODE
+
+
+def test_code_fields():
+    names = ["Front", "Code", "Back", "Output"]
+    found = fields.code_fields(
+        names, ["q", "a = 1", "b", " <br> "], {"Code": "Python", "Output": ""}
+    )
+    assert found == [fields.CodeField(1, "Code", "Python", "a = 1", "a = 1")]
+
+
+def test_render_fields(fake_anki21):
+    found = fields.code_fields(
+        ["A", "B", "C"],
+        [CODE, "x = 1", "int x;"],
+        {"A": "python", "B": "", "C": "nosuchlanguage"},
+    )
+    cache = fragment_cache.FragmentCache()
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        results = fields.render_fields(
+            found, get_style, default_language="python", executor=executor, cache=cache
+        )
+    assert [result.field.name for result in results] == ["A", "B", "C"]
+    assert results[0].html == html_render.render_fragment(CODE, get_style("python"))
+    assert results[1].html == html_render.render_fragment("x = 1", get_style("python"))
+    assert results[2].html is None
+    assert results[2].error == "language 'nosuchlanguage' not found"
+    key = fragment_cache.make_key(CODE, get_style("python"), False)
+    assert cache.get(key) == results[0].html
+
+    # from the cache, in process if the pool is broken (or not given)
+    for executor, hits in [(BrokenExecutor(), 2), (None, 2)]:
+        stats = cache.stats()
+        again = fields.render_fields(
+            found, get_style, default_language="python", executor=executor, cache=cache
+        )
+        assert again == results
+        assert cache.stats().hits - stats.hits == hits
+
+
+def test_render_fields_server(fake_anki21):
+    found = fields.code_fields(
+        ["A", "B", "C"],
+        [CODE, "x = 1", "int x;"],
+        {"A": "python", "B": "python", "C": "nosuchlanguage"},
+    )
+
+    def render_many(items):
+        # A from the server, B lost in a crash (rendered here)
+        futures = [concurrent.futures.Future() for _ in items]
+        futures[0].set_result(("<html>", "python"))
+        futures[1].set_exception(server.ServerUnavailable("the server stopped"))
+        futures[2].set_exception(html_render.LanguageNotFound("nosuchlanguage"))
+        return futures
+
+    results = fields.render_fields(found, get_style, render_many=render_many)
+    assert results[0].html == "<html>"
+    assert results[1].html == html_render.render_fragment("x = 1", get_style("python"))
+    assert results[2].error == "language 'nosuchlanguage' not found"
+
+    def unavailable(items):
+        raise server.ServerUnavailable("stopped after 3 crashes")
+
+    # the pool then
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        again = fields.render_fields(
+            found, get_style, executor=executor, render_many=unavailable
+        )
+    assert again[0].html == html_render.render_fragment(CODE, get_style("python"))
+    assert again[1:] == results[1:]
+
+
+def test_render_fields_limits(fake_anki21):
+    size_limits = limits.Limits(highlight_lines=2, plain_lines=3, refuse_bytes=100)
+    sources = ["a = 1", "a\nb\nc", "a\nb\nc\nd\ne", "x" * 200]
+    found = [fields.CodeField(i, str(i), "python", s, s) for i, s in enumerate(sources)]
+    results = fields.render_fields(found, get_style, size_limits=size_limits)
+    assert [bool(result.notice) for result in results] == [False, True, True, False]
+    assert results[1].html == html_render.render_fragment(sources[1], get_style("text"))
+    assert html_render.TRUNCATED in results[2].html
+    assert results[3].html is None
+    assert "too large to insert" in results[3].error
+
+
+def test_render_fields_cancel(fake_anki21):
+    cancel = threading.Event()
+    cancel.set()
+    found = [fields.CodeField(0, "A", "python", CODE, CODE)]
+    with pytest.raises(html_render.RenderCancelled):
+        fields.render_fields(found, get_style, cancel=cancel)
+
+
+def test_render_fields_cancel_waiting(fake_anki21):
+    # cancelled while the pool renders
+    cancel = threading.Event()
+    executor = StuckExecutor()
+    found = [fields.CodeField(0, "A", "python", CODE, CODE)]
+    threading.Timer(0.1, cancel.set).start()
+    with pytest.raises(html_render.RenderCancelled):
+        fields.render_fields(
+            found, get_style, executor=executor, cancel=cancel, poll_interval=0.01
+        )
+    assert executor.futures[0].cancelled()
@@ -0,0 +1,74 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import os
+
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import fragment_cache, html_render
+
+
+def test_key(fake_anki21):
+    style = html_render.Style()
+    key = fragment_cache.make_key("a = 1", style, False)
+    assert key == fragment_cache.make_key("a = 1", html_render.Style(), False)
+    assert key != fragment_cache.make_key("a = 2", style, False)
+    assert key != fragment_cache.make_key("a = 1", style, True)
+    assert key != fragment_cache.make_key(
+        "a = 1", html_render.Style(linenos=False), False
+    )
+
+
+def test_render_memory(fake_anki21):
+    cache = fragment_cache.FragmentCache()
+    text = "x = {'a': {'b': 1}}"
+
+    found = cache.render(text)
+    assert found == html_render.render_fragment(text)
+    assert cache.render(text) == found
+
+    stats = cache.stats()
+    assert (stats.hits, stats.misses) == (1, 1)
+    assert stats.hit_rate == 0.5
+    assert stats.bytes_saved == len(found.encode("utf-8"))
+
+
+def test_memory_eviction(fake_anki21):
+    cache = fragment_cache.FragmentCache(maxbytes=100)
+    cache.put("a", "x" * 60)
+    cache.put("b", "y" * 30)
+    cache.put("c", "z" * 30)
+    assert cache.get("a") is None
+    assert cache.get("b") == "y" * 30
+    assert cache.stats().memory_bytes == 60
+
+
+def test_disk_store(fake_anki21, tmp_path):
+    path = str(tmp_path / "user_files" / "fragments.sqlite")
+    text = "print('hello')"
+
+    cache = fragment_cache.FragmentCache(path=path)
+    found = cache.render(text)
+    cache.disk.close()
+
+    # a new session reads it back from disk
+    cache = fragment_cache.FragmentCache(path=path)
+    assert cache.render(text) == found
+    stats = cache.stats()
+    assert (stats.hits, stats.disk_hits, stats.misses) == (1, 1, 0)
+    assert stats.disk_bytes == len(found.encode("utf-8"))
+
+
+def test_disk_eviction(fake_anki21, tmp_path):
+    store = fragment_cache.DiskStore(str(tmp_path / "fragments.sqlite"), 100)
+    store.put("a", "x" * 60, 60)
+    store.put("b", "y" * 30, 30)
+    store.get("a")
+    store.put("c", "z" * 30, 30)
+    assert store.get("b") is None
+    assert store.get("a") == "x" * 60
+    assert store.size() == 90
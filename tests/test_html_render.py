@@ -1,7 +1,14 @@
 # NOTE: see comment in syntax_highlighting_ng/__init__.py
+import dataclasses as dc
+import gc
+import io
 import os
+import threading
+import weakref
 from pathlib import Path
 
+import pygments
+import pygments.lexers
 import pytest
 from bs4 import BeautifulSoup
 
@@ -56,3 +63,261 @@ def test_render_conftest(fake_anki21, assets):
     rendered = html_render.render_string(src.read_text())
     found = BeautifulSoup(rendered).prettify()
     assert found == assets.read_text("conftest.html", fallback=found)
+
+
+def test_lexer_registry(fake_anki21):
+    registry = html_render.LexerRegistry(maxsize=2)
+
+    with registry.lexer("python", stripall=True) as first:
+        # a lexer in use is never handed out twice
+        with registry.lexer("Python", stripall=True) as second:
+            assert first is not second
+    assert registry.stats() == {"hits": 0, "misses": 2, "size": 2}
+
+    with registry.lexer("python", stripall=True) as third:
+        assert third in (first, second)
+    assert registry.stats() == {"hits": 1, "misses": 2, "size": 2}
+
+    # different options, different pool entry: evicts the oldest instance
+    with registry.lexer("python") as fourth:
+        assert fourth not in (first, second)
+    assert registry.stats() == {"hits": 1, "misses": 3, "size": 2}
+
+    pytest.raises(html_render.LanguageNotFound, registry.lexer_class, "xxx")
+
+
+def test_token_stream(fake_anki21):
+    src = (Path(__file__).parent / "conftest.py").read_text()
+    tokens = list(pygments.lexers.get_lexer_by_name("python").get_tokens(src))
+    stream = html_render.TokenStream.from_tokens(tokens)
+    assert list(stream) == tokens
+    assert len(stream) == len(tokens)
+    assert stream.text == "".join(value for _, value in tokens)
+    # a fraction of the tokens as tuples
+    assert stream.nbytes < len(src) * 3
+    assert list(html_render.TokenStream.from_tokens([])) == []
+
+
+def test_token_cache(fake_anki21):
+    cache = html_render.TokenCache(maxbytes=3000, maxchars=1000)
+    lexed = []
+
+    def lex(txt):
+        lexed.append(txt)
+        return pygments.lexers.get_lexer_by_name("python").get_tokens(txt)
+
+    src = "a = 1\n" * 20
+    tokens = list(cache.tokens(src, "python", lex))
+    assert list(cache.tokens(src, "Python", lex)) == tokens
+    assert lexed == [src]
+    assert cache.stats() == {
+        "hits": 1,
+        "misses": 1,
+        "size": cache.get(src, "python").nbytes,
+        "streams": 1,
+    }
+    # per language
+    list(cache.tokens(src, "text", lex))
+    assert lexed == [src, src]
+
+    # not cached until all the tokens are consumed
+    partial = "b = 2\n" * 20
+    next(cache.tokens(partial, "python", lex))
+    assert cache.get(partial, "python") is None
+    # nor if too long
+    list(cache.tokens("c = 3\n" * 200, "python", lex))
+    assert cache.stats()["streams"] == 2
+
+    # the least recently used are evicted
+    for n in range(10):
+        list(cache.tokens(f"d = {n}\n" * 20, "python", lex))
+        assert cache.size <= cache.maxbytes
+    assert cache.get(src, "python") is None
+
+    cache.clear()
+    assert cache.stats() == {"hits": 0, "misses": 0, "size": 0, "streams": 0}
+
+
+def with_language(html, language):
+    "html with the highlight div tagged with language, as in a fragment"
+    end = html.index(">", html.index("<div"))
+    return f'{html[:end]} data-language="{language}"{html[end:]}'
+
+
+def test_token_cache_render(fake_anki21):
+    src = (Path(__file__).parent / "conftest.py").read_text()
+    style = html_render.Style(language="python")
+    html_render.TOKENS.clear()
+    html_render.render_fragment(src, style)
+    assert html_render.TOKENS.stats()["misses"] == 1
+
+    # the options only change the formatting, the tokens are re-used
+    for options in [{"style": "monokai"}, {"linenos": False}, {"noclasses": False}]:
+        restyled = dc.replace(style, **options)
+        expected = pygments.highlight(
+            src,
+            pygments.lexers.get_lexer_by_name("python", stripall=True),
+            html_render.get_formatter(restyled, anki=True, centerfragments=True),
+        )
+        expected = with_language(expected, "python")
+        assert html_render.render_fragment(src, restyled, True) == expected
+        cancel = threading.Event()
+        assert html_render.render_fragment(src, restyled, True, cancel) == expected
+    assert html_render.TOKENS.stats()["misses"] == 1
+    assert html_render.TOKENS.stats()["hits"] == 6
+
+
+@pytest.mark.parametrize("language", ["python", "c", "javascript"])
+@pytest.mark.parametrize("linenos", ["inline", False])
+def test_render_iter(fake_anki21, language, linenos):
+    src = (Path(__file__).parent / "conftest.py").read_text() * 5
+    style = html_render.Style(language=language, linenos=linenos)
+
+    expected = html_render.render_string(src, style)
+    assert "".join(html_render.render_iter(src, style, chunk_size=64)) == expected
+    chunks = list(html_render.render_iter(io.StringIO(src), style, chunk_size=64))
+    assert len(chunks) > 1
+    assert "".join(chunks) == expected
+
+
+def test_render_fragment_iter(fake_anki21):
+    src = "x = {{'a': {{1}}}}; y = f'{x}:::{{{x}}}'\n" * 50
+    for chunk_size in (1, 7, 64):
+        found = html_render.render_fragment_iter(
+            io.StringIO(src), centerfragments=True, chunk_size=chunk_size
+        )
+        assert "".join(found) == html_render.render_fragment(src, centerfragments=True)
+
+
+def test_render_iter_truncated(fake_anki21):
+    src = "".join(f"line{i}\n" for i in range(100))
+
+    found = "".join(html_render.render_iter(src, max_lines=10))
+    assert "line9" in found
+    assert "line10" not in found
+    assert html_render.TRUNCATED in found
+
+    found = "".join(html_render.render_iter(src, max_bytes=20))
+    assert "line2" in found  # 3 lines of 6 bytes
+    assert "line3" not in found
+    assert html_render.TRUNCATED in found
+
+    assert html_render.TRUNCATED not in "".join(
+        html_render.render_iter(src, max_lines=100)
+    )
+
+
+def test_render_iter_streaming(fake_anki21):
+    class Source(io.TextIOBase):
+        # ~500KB of python code, never held in memory as a whole
+        def __init__(self):
+            self.lines = 0
+
+        def readline(self, size=-1):
+            self.lines += 1
+            if self.lines > 10_000:
+                return ""
+            return f"value_{self.lines} = {{'a': [1, 2, 3]}}  # a comment\n"
+
+    source = Source()
+    chunks = html_render.render_iter(source)
+    assert "value_1 " in next(chunks)
+    assert source.lines < 5_000
+    assert sum(len(chunk) for chunk in chunks) > 2 * 2**20
+    assert source.lines == 10_001
+
+
+@pytest.mark.parametrize("centerfragments", [False, True])
+@pytest.mark.parametrize("language", ["python", "cpp", "text"])
+def test_render_fragment_escapes(fake_anki21, language, centerfragments):
+    src = "std::map<int, int> a{{1, 2}};\n{{c1::cloze}} }}} :::\n"
+    style = html_render.Style(language=language)
+
+    # same as the regex passes over the full html
+    wrapped = with_language(html_render.render_string(src, style), language)
+    wrapped = f"<table><tbody><tr><td>{wrapped}</td></tr></tbody></table>"
+    if centerfragments:
+        wrapped = f"<center>{wrapped}</center>"
+    expected = html_render.process_html(wrapped)
+    found = html_render.render_fragment(src, style, centerfragments)
+    assert found == expected
+    for sequence in ("{{", "}}", "::"):
+        assert sequence not in found
+
+
+def test_render_fragment_attributes(fake_anki21):
+    # the escaping applies only to the code, never to the tags
+    formatter = html_render.get_formatter(
+        html_render.Style(), anki=True, cssstyles="x::y"
+    )
+    found = pygments.highlight("a::b", pygments.lexers.TextLexer(), formatter)
+    assert 'style="background: #f8f8f8; x::y"' in found
+    assert "a:<!---->:b" in found
+
+
+def effective_styles(html):
+    """(char, inline css) for each character in the code"""
+
+    def normalize(css):
+        noops = {"color:inherit", "background-color:transparent"}
+        items = html_render.compact_css(css).split(";")
+        return [item for item in items if item and item not in noops]
+
+    result = []
+    for text in BeautifulSoup(html, "html.parser").pre.find_all(string=True):
+        items = []
+        for parent in reversed(list(text.parents)):
+            if parent.name == "span" and parent.get("style"):
+                items.extend(normalize(parent["style"]))
+        for char in text:
+            found = items
+            if char.isspace():
+                # colors and font attributes are invisible on blanks
+                found = [
+                    item
+                    for item in items
+                    if not item.startswith(("color:", "font-weight:", "font-style:"))
+                ]
+            result.append((char, found))
+    return result
+
+
+@pytest.mark.parametrize("linenos", ["inline", False])
+@pytest.mark.parametrize("name", ["default", "monokai", "friendly"])
+def test_render_fragment_compact(fake_anki21, name, linenos):
+    src = Path(__file__).parent.joinpath("conftest.py").read_text()
+    style = html_render.Style(style=name, linenos=linenos)
+    compact = html_render.Style(style=name, linenos=linenos, compact=True)
+
+    expected = html_render.render_fragment(src, style)
+    found = html_render.render_fragment(src, compact)
+    assert effective_styles(found) == effective_styles(expected)
+    assert found.count("<span") < expected.count("<span")
+
+    report = html_render.size_report(src, style)
+    assert report.original == len(expected.encode("utf-8"))
+    assert report.compact == len(found.encode("utf-8"))
+    assert report.saved > 0
+    assert 0 < report.ratio < 1
+
+
+def test_compact_formatter_released(fake_anki21):
+    # the formatters are not kept alive by a cache on their methods
+    formatter = html_render._HtmlFormatter(style="monokai", compact=True)
+    tokens = pygments.lex("x = 1  # one\n", pygments.lexers.PythonLexer())
+    assert "".join(formatter.iter_unencoded(tokens))
+    ref = weakref.ref(formatter)
+    del formatter
+    # the bounded _translate_parts caches (as in pygments) aside
+    html_render._HtmlFormatter._translate_parts.cache_clear()
+    html_render.HtmlFormatter._translate_parts.cache_clear()
+    gc.collect()
+    assert ref() is None
+
+
+def test_compact_css(fake_anki21):
+    css = "color: #008800; font-weight: bold; background-color: #f0f0f0;"
+    assert (
+        html_render.compact_css(css)
+        == "color:#080;font-weight:bold;background-color:#f0f0f0"
+    )
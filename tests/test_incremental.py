@@ -0,0 +1,111 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import os
+import threading
+
+import pygments.lexers
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import html_render, incremental
+
+LINES = [
+    "def f(x):",
+    '    """the {{docstring}}',
+    "    spanning lines",
+    '    """',
+    "    return {'a': x} & 1 < 2  # ::",
+    "",
+] * 50
+SOURCE = "\n".join(LINES)
+
+
+def edit(index, *replacement):
+    return "\n".join([*LINES[:index], *replacement, *LINES[index + 1 :]])
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("linenos", ["inline", "table", False])
+def test_render_block(fake_anki21, linenos, compact):
+    style = html_render.Style(language="python", linenos=linenos, compact=compact)
+    block = incremental.render_block(SOURCE, style, True)
+    assert block.incremental
+    assert block.html == html_render.render_fragment(SOURCE, style, True)
+    assert len(block.lines) == len(block.states) == len(block.html_lines)
+    # inside the docstring
+    assert block.states[:5] == [("root",), ("root",), None, None, ("root",)]
+
+
+@pytest.mark.parametrize(
+    "edited, relexed",
+    [
+        # a typo fixed: from the docstring start (line 97, the last known
+        # state before the previous line) up to the changed line
+        (edit(100, "    return {'b': x} & 1 < 2  # ::"), 4),
+        # lines added and removed
+        (edit(100, "    x = 1", "    y = 2"), 5),
+        (edit(100), 3),
+        # an unterminated docstring: lexed up to the end
+        (edit(99, "    spanning"), None),
+    ],
+    ids=["typo", "added", "removed", "unterminated"],
+)
+def test_render_block_edit(fake_anki21, edited, relexed):
+    style = html_render.Style(language="python")
+    previous = incremental.render_block(SOURCE, style)
+    block = incremental.render_block(edited, style, previous=previous)
+    expected = incremental.render_block(edited, style)
+    assert block.html == html_render.render_fragment(edited, style)
+    assert block.states == expected.states
+    assert block.html_lines == expected.html_lines
+    if relexed is not None:
+        assert block.relexed == relexed
+    else:
+        assert block.relexed > len(LINES) - 100
+
+
+def test_render_block_not_resumable(fake_anki21):
+    # CppLexer overrides get_tokens_unprocessed
+    style = html_render.Style(language="cpp")
+    block = incremental.render_block("int x;\n", style)
+    assert not block.incremental
+    assert block.html == html_render.render_fragment("int x;\n", style)
+
+
+def test_incremental(fake_anki21):
+    style = html_render.Style(language="python")
+    renderer = incremental.Incremental(maxsize=2, min_lines=10)
+    html_render.TOKENS.clear()
+    assert renderer.render(SOURCE, style) == html_render.render_fragment(SOURCE, style)
+    lines = len(renderer.blocks[0].lines)
+    assert renderer.relexed == lines
+
+    edited = edit(100, "    return 1")
+    renderer.render("\n".join(["x = 1"] * 20), style)
+    html = renderer.render(edited, style)
+    assert html == html_render.render_fragment(edited, style)
+    # rendered from the first block (the most similar), which is replaced
+    assert renderer.relexed == lines + 20 + 4
+    assert len(renderer.blocks) == 2
+
+    # another style: re-formatted from the cached tokens
+    style = html_render.Style(language="python", compact=True)
+    assert renderer.render(edited, style) == html_render.render_fragment(edited, style)
+    assert renderer.relexed == lines + 20 + 4
+    # .. or rendered in full
+    html_render.TOKENS.clear()
+    renderer.render(edited, style)
+    assert renderer.relexed == 2 * lines + 20 + 4
+    # the tokens are cached for the next style change
+    assert list(html_render.TOKENS.get(edited, "python")) == list(
+        pygments.lexers.get_lexer_by_name("python", stripall=True).get_tokens(edited)
+    )
+
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(html_render.RenderCancelled):
+        renderer.render(SOURCE * 2, style, cancel=cancel)
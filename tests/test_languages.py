@@ -0,0 +1,119 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import os
+
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import languages
+
+
+def test_index_matches_pygments(fake_anki21):
+    from pygments.lexers import get_all_lexers
+
+    index = languages.build_index()
+    expected = {lex[0]: lex[1][0] for lex in get_all_lexers() if lex[1]}
+    assert index.names == expected
+    assert index.aliases["py"].classname == "PythonLexer"
+
+
+def test_index_roundtrip(fake_anki21, tmp_path):
+    path = str(tmp_path / "languages.json")
+    assert languages.read_index(path) is None
+
+    index = languages.load_index(path)
+    assert os.path.exists(path)
+
+    loaded = languages.read_index(path)
+    assert loaded is not None
+    assert loaded.lexers == index.lexers
+    assert loaded.names == index.names
+
+
+def test_index_stale(fake_anki21, tmp_path):
+    path = str(tmp_path / "languages.json")
+    index = languages.build_index(plugins=False)
+    index.version = "0.0.0"
+    languages.write_index(index, path)
+
+    assert languages.read_index(path) is None
+    assert languages.load_index(path).version == languages.pygments_version()
+    assert languages.read_index(path) is not None
+
+
+def test_lexer_class(fake_anki21):
+    from pygments.lexers.python import PythonLexer
+
+    assert languages.lexer_class("Python") is PythonLexer
+    assert languages.lexer_class("xxx") is None
+
+
+def test_option_markup(fake_anki21, monkeypatch):
+    markup = languages.option_markup()
+    assert markup.count("<option>") == len(languages.names())
+    assert markup.startswith("<option>ABAP</option>")
+    assert languages.option_markup() is markup
+
+    limited = languages.option_markup(["Python", "C++", "<x>"])
+    assert limited == (
+        "<option>Python</option><option>C++</option><option>&lt;x&gt;</option>"
+    )
+
+    # a new pygments version rebuilds the markup
+    index = languages.LanguageIndex("0.0.0", languages.get_index().lexers[:2])
+    monkeypatch.setattr(languages, "get_index", lambda: index)
+    assert languages.option_markup().count("<option>") == 2
+
+
+@pytest.mark.parametrize(
+    "query, expected",
+    [
+        ("python", "Python"),
+        ("PYTH", "Python"),
+        ("py3", "Python"),
+        ("pyw", "Python"),
+        ("c++", "C++"),
+        ("js", "JavaScript"),
+        ("jvscrpt", "JavaScript"),
+        ("rust", "Rust"),
+    ],
+)
+def test_search(fake_anki21, query, expected):
+    found = languages.search_index().search(query, 5)
+    assert found[0] == expected
+    assert len(found) <= 5
+
+
+def test_search_resolve(fake_anki21):
+    index = languages.search_index()
+    assert index.search("") == []
+    assert index.search("zzzzzzzz") == []
+    assert index.resolve(" python ") == "Python"
+    assert index.resolve("cpp") == "C++"
+    assert index.resolve("pyth") is None
+
+
+@pytest.mark.parametrize(
+    "filename, expected",
+    [
+        ("a.py", "python"),
+        ("x.C", "cpp"),
+        ("x.c", "c"),
+        ("Makefile", "make"),
+        ("q.html.j2", "html+django"),
+        ("README", None),
+    ],
+)
+def test_for_filename(fake_anki21, filename, expected):
+    found = languages.build_index(plugins=False).for_filename(filename)
+    assert (found[0] if found else None) == expected
+
+
+def test_for_filename_plain_first(fake_anki21):
+    found = languages.build_index(plugins=False).for_filename("x.sql")
+    assert "sql" in found
+    assert found.index("sql") < found.index("sql+jinja")
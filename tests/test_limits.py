@@ -0,0 +1,69 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import os
+
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import limits
+
+LIMITS = limits.Limits(
+    highlight_bytes=100,
+    highlight_lines=5,
+    plain_bytes=200,
+    plain_lines=10,
+    refuse_bytes=1000,
+    minified_line=40,
+)
+
+
+@pytest.mark.parametrize(
+    "code, tier, reason",
+    [
+        ("x = 1\n" * 5, limits.TIER_FULL, ""),
+        ("x = 1\n" * 6, limits.TIER_PLAIN, "lines"),
+        ("x = 1;" * 10, limits.TIER_PLAIN, "minified"),
+        (("x = 1 # " + "a" * 30 + "\n") * 4, limits.TIER_PLAIN, "bytes"),
+        ("x\n" * 11, limits.TIER_TRUNCATED, "lines"),
+        ("x = 1;" * 50, limits.TIER_TRUNCATED, "bytes"),
+        ("x" * 1001, limits.TIER_REFUSED, "bytes"),
+        # utf-8 bytes, not characters
+        ("è" * 501, limits.TIER_REFUSED, "bytes"),
+    ],
+)
+def test_assess(fake_anki21, code, tier, reason):
+    found = limits.assess(code, LIMITS)
+    assert (found.tier, found.reason) == (tier, reason)
+    assert found.nlines == len(code.splitlines())
+
+
+def test_truncate(fake_anki21):
+    code = "".join(f"line {i}\n" for i in range(100))
+    assert limits.truncate(code, LIMITS, "END") == code[: code.index("line 10")] + "END"
+
+    # whole lines within the bytes limit
+    code = "".join(f"a longer line number {i}\n" for i in range(10))
+    found = limits.truncate(code, LIMITS)
+    assert len(found.encode()) <= LIMITS.plain_bytes
+    assert found.endswith("\n") and code.startswith(found)
+
+    # a single line is cut
+    found = limits.truncate("x" * 500, LIMITS, "END")
+    assert found == "x" * 200 + "\nEND"
+
+
+def test_from_conf(fake_anki21):
+    found = limits.Limits.from_conf({"highlightKB": 1, "plainLines": 3})
+    assert found.highlight_bytes == 1024
+    assert found.plain_lines == 3
+    assert found.refuse_bytes == limits.Limits().refuse_bytes
+
+
+def test_notice(fake_anki21):
+    assert limits.notice(limits.assess("x", LIMITS), LIMITS) == ""
+    assert "minified" in limits.notice(limits.assess("x;" * 30, LIMITS), LIMITS)
+    assert "first" in limits.notice(limits.assess("x\n" * 11, LIMITS), LIMITS)
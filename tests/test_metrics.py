@@ -0,0 +1,134 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import os
+import threading
+
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import html_render, incremental, metrics
+
+
+def test_histogram():
+    hist = metrics.Histogram()
+    assert hist.percentile(50) == 0.0
+    for value in range(1, 101):
+        hist.add(value / 1000)
+    assert hist.count == 100
+    assert hist.percentile(50) == 0.05
+    assert hist.percentile(95) == 0.095
+    assert hist.percentile(100) == 0.1
+    assert hist.mean == pytest.approx(0.0505)
+
+    # the percentiles are over the most recent samples only
+    for _ in range(metrics.SAMPLES):
+        hist.add(1.0)
+    assert hist.count == 100 + metrics.SAMPLES
+    assert hist.percentile(50) == 1.0
+
+
+def test_metrics():
+    m = metrics.Metrics()
+    assert m.report() == "No code highlighted yet."
+
+    with m.timed(metrics.STAGE_READ):
+        pass
+    m.add(metrics.STAGE_LEX, 0.002, "python")
+    m.add(metrics.STAGE_LEX, 0.004, "sql")
+    m.add_traffic("python", 100, 1000)
+    m.add_traffic("sql", 50, 400)
+
+    assert m.histogram(metrics.STAGE_READ).count == 1
+    # recorded for the language and for all the languages
+    assert m.histogram(metrics.STAGE_LEX, "python").count == 1
+    assert m.histogram(metrics.STAGE_LEX).count == 2
+    assert m.histogram(metrics.STAGE_LEX).total == pytest.approx(0.006)
+    assert m.histogram(metrics.STAGE_EVAL).count == 0
+    assert m.traffic[""] == metrics.Traffic(2, 150, 1400)
+    assert m.traffic["sql"] == metrics.Traffic(1, 50, 400)
+
+    lines = m.report().splitlines()
+    assert lines[0].split()[:4] == ["stage", "language", "count", "p50"]
+    # the stages in pipeline order, all the languages first
+    assert [line.split()[:3] for line in lines[1:5]] == [
+        ["read", "(all)", "1"],
+        ["lex", "(all)", "2"],
+        ["lex", "python", "1"],
+        ["lex", "sql", "1"],
+    ]
+    assert lines[7].split() == ["(all)", "2", "0.1", "1.4"]
+
+    m.clear()
+    assert m.report() == "No code highlighted yet."
+
+
+def test_timed_tokens():
+    tokens = [("a", 1)] * 1000
+    # not measured: the same tokens back
+    unmeasured = iter(tokens)
+    assert metrics.timed_tokens(unmeasured) is unmeasured
+
+    with metrics.lexing() as watch:
+        assert list(metrics.timed_tokens(iter(tokens), batch=300)) == tokens
+    assert watch.batches == 5  # the last one is empty
+    assert watch.elapsed > 0
+    assert metrics.timed_tokens(unmeasured) is unmeasured
+
+
+@pytest.mark.parametrize("lines", [10, 300])
+def test_lexing(fake_anki21, lines):
+    txt = "\n".join(f"x{n} = {n}  # {n}" for n in range(lines))
+    style = html_render.Style(language="python")
+    renderer = incremental.Incremental()
+    with metrics.lexing() as watch:
+        html = renderer.render(txt, style, cancel=threading.Event())
+    assert watch.batches > 0
+    assert html == html_render.render_fragment(txt, style)
+
+    # the threads don't share the stopwatch
+    with metrics.lexing() as watch:
+        thread = threading.Thread(target=html_render.render_fragment, args=(txt,))
+        thread.start()
+        thread.join()
+    assert watch.batches == 0
+
+
+def test_profiler(tmp_path):
+    saved = []
+    profiler = metrics.Profiler(str(tmp_path / "user_files"), on_saved=saved.append)
+    with profiler.profiled():
+        # not armed
+        pass
+    assert not profiler.active
+
+    path = profiler.start(2)
+    assert profiler.active
+    with profiler.profiled():
+        html_render.render_fragment("a = 1", html_render.Style(language="python"))
+    assert saved == []
+    # one at a time, the inner one doesn't count
+    with profiler.profiled(), profiler.profiled():
+        pass
+    assert not profiler.active
+    assert saved == [path]
+    assert os.path.getsize(path) > 0
+    summary = (tmp_path / "user_files" / os.path.basename(path)).with_suffix(".txt")
+    assert "render_fragment" in summary.read_text()
+
+
+def test_profiler_stop(tmp_path):
+    saved = []
+    profiler = metrics.Profiler(str(tmp_path), on_saved=saved.append)
+    path = profiler.start(10)
+    with profiler.profiled():
+        html_render.render_fragment("a = 1")
+    profiler.stop()
+    assert not profiler.active
+    assert saved == [path]
+    # nothing left to save
+    profiler.stop()
+    assert saved == [path]
@@ -0,0 +1,142 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import concurrent.futures
+import dataclasses as dc
+import os
+import threading
+
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import html_render, restyle
+
+CODE = "def f(x):\n    return {'a': x} & 1 < 2"
+
+
+@dc.dataclass
+class FakeNote:
+    id: int
+    fields: list
+
+
+class FakeCollection:
+    # the subset of anki.collection.Collection used by restyle
+    def __init__(self, notes):
+        self.notes = {note.id: note for note in notes}
+        self.updates = []
+
+    def get_note(self, nid):
+        note = self.notes[nid]
+        return FakeNote(note.id, list(note.fields))
+
+    def update_notes(self, notes):
+        self.updates.append([note.id for note in notes])
+        for note in notes:
+            self.notes[note.id] = note
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("noclasses", [True, False])
+@pytest.mark.parametrize("linenos", ["inline", False])
+def test_extract_source(fake_anki21, noclasses, linenos, compact):
+    style = html_render.Style(noclasses=noclasses, linenos=linenos, compact=compact)
+    fragments = restyle.find_fragments(
+        "<b>before</b>" + html_render.render_fragment(CODE, style, True) + "after"
+    )
+    assert len(fragments) == 1
+    assert fragments[0].source == CODE
+    assert fragments[0].centered
+    assert fragments[0].language == "Python"
+
+
+def test_restyle_notes(fake_anki21):
+    old = html_render.Style()
+    new = html_render.Style(noclasses=False, linenos=False)
+    col = FakeCollection(
+        [
+            FakeNote(1, ["plain", "x" + html_render.render_fragment(CODE, old) + "y"]),
+            FakeNote(2, ["no code"]),
+            FakeNote(3, [html_render.render_fragment(CODE, old, True) * 2]),
+        ]
+    )
+    progress = []
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        result = restyle.restyle_notes(
+            col,
+            [1, 2, 3],
+            new,
+            executor=executor,
+            batch_size=2,
+            progress=lambda done, total: progress.append((done, total)),
+        )
+
+    assert (result.notes, result.fragments, result.errors) == (2, 3, [])
+    assert progress == [(2, 3), (3, 3)]
+    assert col.updates == [[1], [3]]
+
+    expected = html_render.render_fragment(CODE, new)
+    assert col.notes[1].fields == ["plain", "x" + expected + "y"]
+    assert col.notes[2].fields == ["no code"]
+    assert col.notes[3].fields == [
+        html_render.render_fragment(CODE, new, True) * 2
+    ]
+
+
+def test_restyle_cancel(fake_anki21):
+    col = FakeCollection([FakeNote(1, [html_render.render_fragment(CODE)])])
+    cancel = threading.Event()
+    cancel.set()
+    result = restyle.restyle_notes(
+        col, [1], html_render.Style(), executor=None, jobs=1, cancel=cancel
+    )
+    assert result.cancelled
+    assert col.updates == []
+
+
+def test_restyle_errors(fake_anki21):
+    fragment = html_render.render_fragment(CODE)
+    unknown = fragment.replace('data-language="Python"', 'data-language="xxx"')
+    # highlighted before the language was recorded
+    untagged = fragment.replace(' data-language="Python"', "")
+    col = FakeCollection([FakeNote(1, [unknown, untagged])])
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        result = restyle.restyle_notes(
+            col, [1], html_render.Style(style="monokai"), executor=executor
+        )
+    assert result.errors == [(1, "xxx")]
+    assert result.skipped == 1
+    assert col.updates == []
+
+
+def test_restyle_process_pool(fake_anki21):
+    col = FakeCollection([FakeNote(1, [html_render.render_fragment(CODE)])])
+    new = html_render.Style(style="monokai")
+    result = restyle.restyle_notes(col, [1], new, jobs=2)
+    assert result.fragments == 1
+    assert col.notes[1].fields == [html_render.render_fragment(CODE, new)]
+
+
+def test_restyle_pre_series(fake_anki21, assets):
+    # a fragment from the versions not recording the language
+    fragment = assets.lookup("pre-series.html").read_text()
+    assert restyle.find_fragments(fragment)[0].language == ""
+    col = FakeCollection([FakeNote(1, [fragment]), FakeNote(2, [fragment])])
+    new = html_render.Style(style="monokai")
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        result = restyle.restyle_notes(
+            col,
+            [1, 2],
+            new,
+            fallback=lambda note, fragment: "python" if note.id == 1 else "",
+            executor=executor,
+        )
+    assert (result.notes, result.fragments, result.skipped) == (1, 1, 1)
+    assert col.notes[1].fields == [
+        html_render.render_fragment(CODE, dc.replace(new, language="python"))
+    ]
+    assert col.notes[2].fields == [fragment]
@@ -0,0 +1,154 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import html_render, incremental, server, worker
+
+CODE = "def f(x):\n    return {'a': x} & 1 < 2"
+
+# the servers inherit the monkeypatched modules
+fork = pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="needs fork"
+)
+
+
+@pytest.fixture
+def render_server():
+    render_server = server.RenderServer(context=multiprocessing.get_context("fork"))
+    yield render_server
+    render_server.close()
+
+
+def test_no_pygments(assets):
+    # the add-on in server mode (imported as anki does) doesn't load pygments:
+    # the code and the code fields are rendered in the server
+    code = """
+from syntax_highlighting_ng import fields, languages
+assert "data-language" in highlight("x = 1", "python")
+found = fields.code_fields(["Code"], ["y = 2"], {"Code": "Python"})
+[result] = fields.render_fields(
+    found,
+    lambda alias: main.get_style(dict(config.default_conf), alias),
+    render_many=main.get_render_server().render_many,
+)
+assert "data-language" in result.html, result
+assert "<option>Python</option>" in languages.option_markup()
+main.get_render_server().close()
+print(sorted(m for m in sys.modules if m.startswith("pygments")))
+"""
+    srcdir = Path(__file__).parent.parent / "src"
+    env = dict(os.environ, PYTHONPATH=str(srcdir))
+    env.pop("STANDALONE_ADDON")
+    out = subprocess.check_output(
+        [sys.executable, assets.lookup("anki_addon.py"), '{"renderServer": true}', code],
+        env=env,
+        text=True,
+    )
+    assert out.strip() == "[]"
+
+
+@fork
+def test_render_server(fake_anki21, render_server):
+    style = html_render.Style(language="python", linenos=False)
+    assert render_server.render(CODE, style, True) == (
+        html_render.render_fragment(CODE, style, True),
+        "python",
+    )
+    # the language detected among the candidates
+    _, alias = render_server.render(
+        "#!/bin/bash\necho 1", style, candidates=["python", "bash"]
+    )
+    assert alias == "bash"
+    with pytest.raises(html_render.LanguageNotFound):
+        render_server.render(CODE, html_render.Style(language="nosuchlanguage"))
+
+    info = render_server.info()
+    assert info["pid"] != os.getpid()
+    assert info["cache"]["misses"] == 3
+    assert (render_server.started, render_server.crashes) == (1, 0)
+
+
+@fork
+def test_render_many(fake_anki21, render_server):
+    items = [
+        (f"x = {i}", html_render.Style(language="python"), False) for i in range(20)
+    ]
+    # two batches in flight
+    futures = render_server.render_many(items[:10])
+    futures.extend(render_server.render_many(items[10:]))
+    assert [future.result()[0] for future in futures] == [
+        html_render.render_fragment(*item) for item in items
+    ]
+
+
+@fork
+def test_render_server_crash(fake_anki21, render_server):
+    render_server.max_crashes = 2
+    for crashes in [1, 2]:
+        os.kill(render_server.info()["pid"], signal.SIGKILL)
+        while render_server.crashes < crashes:
+            time.sleep(0.01)
+    # started again after the first crash, not after the second one
+    assert render_server.started == 2
+    assert not render_server.available
+    with pytest.raises(server.ServerUnavailable):
+        render_server.render(CODE)
+
+
+@fork
+def test_render_server_timeout(fake_anki21, render_server, monkeypatch):
+    monkeypatch.setattr(incremental.Incremental, "render", lambda *args: time.sleep(60))
+    start = time.monotonic()
+    with pytest.raises(worker.RenderTimeout):
+        render_server.render(CODE, budget=0.5)
+    assert time.monotonic() - start < 10
+
+    cancel = threading.Event()
+    threading.Timer(0.1, cancel.set).start()
+    with pytest.raises(html_render.RenderCancelled):
+        render_server.render(CODE, cancel=cancel)
+
+    # killed (not a crash) and started again
+    monkeypatch.undo()
+    assert render_server.render(CODE)[0] == html_render.render_fragment(CODE)
+    assert (render_server.started, render_server.crashes) == (3, 0)
+
+
+@fork
+def test_render_server_queued(fake_anki21, render_server, monkeypatch):
+    render = incremental.Incremental.render
+
+    def slow_render(*args, **kwargs):
+        time.sleep(0.4)
+        return render(*args, **kwargs)
+
+    monkeypatch.setattr(incremental.Incremental, "render", slow_render)
+    render_server.info()  # started
+
+    # the budget runs from the start of the request, not while queued
+    render_server.submit(server.OP_RENDER, CODE, html_render.Style(), False, ())
+    html, _ = render_server.render("x = 1", budget=0.6)
+    assert html == html_render.render_fragment("x = 1")
+
+    # a queued request cancelled: the server goes on
+    first = render_server.submit(server.OP_RENDER, CODE, html_render.Style(), False, ())
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(html_render.RenderCancelled):
+        render_server.render("x = 2", cancel=cancel)
+    assert first.result()[0] == html_render.render_fragment(CODE)
+    assert render_server.started == 1
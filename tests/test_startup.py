@@ -0,0 +1,103 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import logging
+import os
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import startup
+
+
+def test_timed(fake_anki21, caplog):
+    with caplog.at_level(logging.INFO), startup.timed("a phase"):
+        pass
+    assert startup.PHASES["a phase"] >= 0
+    assert "a phase took" in caplog.text
+
+
+def test_import_is_lazy(fake_anki21, assets):
+    # a fresh interpreter (so nothing is already in sys.modules) importing
+    # the add-on as anki does, main included
+    code = (
+        "assert 'syntax_highlighting_ng.main' in sys.modules; "
+        "print(sorted(m for m in sys.modules if m.startswith("
+        "('pygments', 'syntax_highlighting_ng.html_render'))))"
+    )
+    srcdir = Path(__file__).parent.parent / "src"
+    env = dict(os.environ, PYTHONPATH=str(srcdir))
+    env.pop("STANDALONE_ADDON")
+    out = subprocess.check_output(
+        [sys.executable, assets.lookup("anki_addon.py"), "{}", code],
+        env=env,
+        text=True,
+    )
+    assert out.strip() == "[]"
+
+
+def test_ensure_loaded(fake_anki21, monkeypatch):
+    monkeypatch.setattr(startup, "_loaded", False)
+    threads = [
+        threading.Thread(target=startup.ensure_loaded, args=("monokai",))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert startup.is_loaded()
+    assert "syntax_highlighting_ng.html_render" in sys.modules
+    for phase in ["import pygments", "language index", "import html_render"]:
+        assert phase in startup.PHASES
+    assert "formatter monokai" in startup.PHASES
+
+
+def test_warm_up(fake_anki21):
+    from syntax_highlighting_ng import html_render
+
+    html_render.LEXERS.clear()
+    styles = []
+
+    def get_style(alias):
+        styles.append(alias)
+        return html_render.Style(language=alias, style="monokai")
+
+    names = ["Python", "SQL", "No such language", "Python"]
+    result = startup.warm_up(names, get_style, pause=0)
+    assert result.warmed == ["python", "sql"]
+    assert result.skipped == ["No such language"]
+    assert styles == ["python", "sql"]
+    assert not result.cancelled
+    assert result.elapsed == startup.PHASES["warm-up"]
+
+    # the renders get the warmed up lexers
+    hits = html_render.LEXERS.stats()["hits"]
+    html_render.render_fragment("SELECT 1", html_render.Style(language="sql"))
+    assert html_render.LEXERS.stats()["hits"] == hits + 1
+
+
+def test_warm_up_stops(fake_anki21):
+    from syntax_highlighting_ng import html_render
+
+    def get_style(alias):
+        return html_render.Style(language=alias)
+
+    names = ["Python", "SQL"]
+    result = startup.warm_up(names, get_style, budget=0)
+    assert result.warmed == []
+    assert result.skipped == names
+
+    cancel = threading.Event()
+    cancel.set()
+    result = startup.warm_up(names, get_style, cancel=cancel)
+    assert result.cancelled
+    assert result.skipped == names
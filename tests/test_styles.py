@@ -0,0 +1,76 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import os
+
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import html_render, styles
+
+
+@pytest.fixture(scope="function")
+def tables(tmp_path, monkeypatch):
+    "precomputed tables for the installed pygments"
+    path = str(tmp_path / "styles.json")
+    styles.write_tables(styles.build_tables(), path)
+    monkeypatch.setattr(styles, "TABLES_PATH", path)
+    monkeypatch.setattr(styles, "get_tables", lambda: styles.read_tables(path))
+    styles.table.cache_clear()
+    html_render._get_formatter.cache_clear()
+    yield path
+    styles.table.cache_clear()
+    html_render._get_formatter.cache_clear()
+
+
+def test_tables_roundtrip(fake_anki21, tables):
+    from pygments.formatters import HtmlFormatter
+
+    for name in ["default", "monokai", "friendly"]:
+        table = styles.table(name)
+        expected = HtmlFormatter(style=name)
+        assert table.class2style == expected.class2style
+        assert table.ttype2class == expected.ttype2class
+        assert styles.stylesheet(name) == expected.get_style_defs(".highlight")
+    assert styles.table("xxx") is None
+
+
+def test_tables_stale(fake_anki21, tmp_path):
+    path = str(tmp_path / "styles.json")
+    assert styles.read_tables(path) is None
+    styles.write_tables({"version": "0.0.0", "styles": {}}, path)
+    assert styles.read_tables(path) is None
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("noclasses", [True, False])
+def test_render_with_tables(fake_anki21, tables, noclasses, compact):
+    src = "def f(x):\n    return {'a': x}  # comment\n"
+    style = html_render.Style(style="monokai", noclasses=noclasses, compact=compact)
+
+    found = html_render.render_fragment(src, style)
+    assert html_render.get_formatter(style).table is not None
+
+    html_render._get_formatter.cache_clear()
+    styles.table.cache_clear()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(styles, "get_tables", lambda: {})
+        assert html_render.get_formatter(style).table is None
+        assert html_render.render_fragment(src, style) == found
+
+
+def test_formatter_cache(fake_anki21):
+    style = html_render.Style(language="python")
+    formatter = html_render.get_formatter(style)
+    # the language doesn't matter
+    assert html_render.get_formatter(html_render.Style(language="cpp")) is formatter
+    assert html_render.get_formatter(style, anki=True) is not formatter
+    assert html_render.get_formatter(style, anki=True) is html_render.get_formatter(
+        style, anki=True
+    )
+    assert html_render.get_formatter(html_render.Style(linenos=False)) is not formatter
+    with pytest.raises(html_render.InvalidStyle):
+        html_render.get_formatter(html_render.Style(style="xxx"))
@@ -0,0 +1,82 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import os
+import sys
+import zipfile
+
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import vendor
+
+
+@pytest.fixture(scope="function")
+def wheel(tmp_path):
+    path = tmp_path / "libs" / "vendored_pkg-1.0-py3-none-any.whl"
+    path.parent.mkdir()
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("vendored_pkg/__init__.py", "VALUE = 42\n")
+        archive.writestr("vendored_pkg/sub.py", "X = 1\n")
+    return str(path)
+
+
+def test_unpack(fake_anki21, wheel, monkeypatch):
+    path = vendor.pygments_path(wheel)
+    assert path == wheel[: -len(".whl")]
+    assert os.path.isfile(os.path.join(path, "vendored_pkg", "sub.py"))
+    assert sorted(os.listdir(os.path.dirname(wheel))) == sorted(
+        [os.path.basename(wheel), os.path.basename(path)]
+    )
+
+    # unpacked once
+    assert vendor.unpack(wheel) == path
+    assert vendor.precompile(path)
+    assert os.listdir(os.path.join(path, "vendored_pkg", "__pycache__"))
+
+    monkeypatch.syspath_prepend(path)
+    monkeypatch.delitem(sys.modules, "vendored_pkg", False)
+    import vendored_pkg
+
+    assert vendored_pkg.VALUE == 42
+    assert vendored_pkg.__file__.startswith(path)
+
+
+def test_cleanup(fake_anki21, wheel, monkeypatch):
+    libs = os.path.dirname(wheel)
+    stale = [
+        os.path.join(libs, "vendored_pkg-0.9-py3-none-any"),
+        os.path.join(libs, "vendored_pkg-0.9-py3-none-any.tmp123"),
+        os.path.join(libs, "vendored_pkg-1.0-py3-none-any.tmp456"),
+    ]
+    for path in stale:
+        os.makedirs(path)
+    os.makedirs(os.path.join(libs, "unrelated"))
+
+    path = vendor.pygments_path(wheel)
+    # the recent temporary directory can be an unpack in progress
+    assert sorted(os.listdir(libs)) == sorted(
+        [
+            "unrelated",
+            "vendored_pkg-1.0-py3-none-any",
+            "vendored_pkg-1.0-py3-none-any.tmp456",
+            "vendored_pkg-1.0-py3-none-any.whl",
+        ]
+    )
+
+    monkeypatch.setattr(vendor, "TMP_MAX_AGE", -1)
+    assert vendor.cleanup(wheel) == [stale[2]]
+    assert os.path.isdir(path)
+
+
+def test_zip_fallback(fake_anki21, wheel, monkeypatch):
+    def rename(src, dst):
+        raise PermissionError(f"cannot rename {src}")
+
+    monkeypatch.setattr(os, "rename", rename)
+    assert vendor.pygments_path(wheel) == wheel
+    # no leftovers
+    assert os.listdir(os.path.dirname(wheel)) == [os.path.basename(wheel)]
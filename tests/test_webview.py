@@ -0,0 +1,102 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import json
+import os
+
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import webview
+
+
+class Web:
+    "an AnkiWebView running the evals later, in order"
+
+    def __init__(self):
+        self.scripts = []
+        self.callbacks = []
+
+    def eval(self, js):
+        self.scripts.append(js)
+
+    def evalWithCallback(self, js, cb):
+        self.scripts.append(js)
+        self.callbacks.append(cb)
+
+    def run(self):
+        while self.callbacks:
+            self.callbacks.pop(0)(None)
+
+
+def test_insert_scripts():
+    html = '<div class="highlight">a = "</script>"</div>'
+    assert webview.insert_scripts(html) == [
+        "document.execCommand('inserthtml', false, %s);" % json.dumps(html)
+    ]
+
+    scripts = webview.insert_scripts(html, chunk_size=10, transfer_id=7)
+    assert len(scripts) == 5 + 1
+    assert scripts[0] == "window.shChunks = {7: [%s]};" % json.dumps(html[:10])
+    assert scripts[1] == (
+        "window.shChunks && window.shChunks[7]?.push(%s);" % json.dumps(html[10:20])
+    )
+    assert scripts[-1] == webview.insert_chunks_js % 7
+    # the fragment is inserted once, at the end
+    assert ["inserthtml" in js for js in scripts].count(True) == 1
+    assert "inserthtml" in scripts[-1]
+
+
+@pytest.mark.parametrize("size, scripts", [(100, 1), (1000, 11)])
+def test_insert_html(size, scripts):
+    html = "é" * size
+    web = Web()
+    done = []
+    transfer = webview.insert_html(web, html, done.append, chunk_size=100)
+    # one eval at a time, the next one from the callback
+    assert len(web.scripts) == 1
+    assert done == []
+
+    web.run()
+    assert len(web.scripts) == scripts
+    assert done == [transfer]
+    assert transfer.nbytes == 2 * size
+    assert transfer.scripts == scripts
+    assert transfer.elapsed > 0
+    if scripts > 1:
+        first, *rest, _ = web.scripts
+        chunks = [
+            first[first.index("[") + 1 : -3],
+            *(js[js.index("push(") + 5 : -2] for js in rest),
+        ]
+        assert "".join(map(json.loads, chunks)) == html
+
+
+def test_insert_html_ids():
+    web = Web()
+    webview.insert_html(web, "a" * 20, chunk_size=10)
+    webview.insert_html(web, "b" * 20, chunk_size=10)
+    # each transfer collects its own chunks
+    first, second = web.scripts
+    assert first.startswith("window.shChunks = {")
+    assert first.split("{")[1] != second.split("{")[1]
+
+
+@pytest.mark.parametrize("size", [5, 50])
+def test_insert_html_dropped(size):
+    # the editor moved to another note (during the render or the transfer)
+    web = Web()
+    done = []
+    transfer = webview.insert_html(
+        web, "a" * size, done.append, chunk_size=10, current=lambda: False
+    )
+    web.run()
+    assert transfer.dropped
+    assert done == []
+    assert not any("inserthtml" in js for js in web.scripts)
+    if size > 10:
+        # the chunks collected so far are discarded
+        assert web.scripts[-1].startswith("window.shChunks && delete")
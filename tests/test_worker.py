@@ -0,0 +1,106 @@
+# NOTE: see comment in syntax_highlighting_ng/__init__.py
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+if os.getenv("STANDALONE_ADDON") != "1":
+    raise pytest.skip(
+        f"to run {__name__} must have STANDALONE_ADDON=1 in the environment",
+        allow_module_level=True,
+    )
+
+from syntax_highlighting_ng import html_render, worker
+
+CODE = "def f(x):\n    return {'a': x} & 1 < 2"
+
+# the workers inherit the monkeypatched html_render
+fork = pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="needs fork"
+)
+
+
+@pytest.fixture
+def render_worker():
+    render_worker = worker.RenderWorker(
+        budget=0.5, context=multiprocessing.get_context("fork")
+    )
+    yield render_worker
+    render_worker.close()
+
+
+@fork
+def test_render_worker(fake_anki21, render_worker):
+    style = html_render.Style(linenos=False)
+    assert render_worker.render(CODE, style, True) == html_render.render_fragment(
+        CODE, style, True
+    )
+    assert render_worker.render("x = 1") == html_render.render_fragment("x = 1")
+    with pytest.raises(html_render.LanguageNotFound):
+        render_worker.render(CODE, html_render.Style(language="nosuchlanguage"))
+    # a single process for all the renders
+    assert (render_worker.started, render_worker.killed) == (1, 0)
+
+    render_worker.close()
+    assert render_worker.render("x = 1") == html_render.render_fragment("x = 1")
+    assert render_worker.started == 2
+
+
+@fork
+def test_render_worker_timeout(fake_anki21, render_worker, monkeypatch):
+    monkeypatch.setattr(html_render, "render_fragment", lambda *args: time.sleep(60))
+    start = time.monotonic()
+    with pytest.raises(worker.RenderTimeout) as exc:
+        render_worker.render(CODE)
+    assert time.monotonic() - start < 10
+    assert "0.5 seconds" in exc.value.render()
+    assert render_worker.killed == 1
+
+    cancel = threading.Event()
+    threading.Timer(0.1, cancel.set).start()
+    with pytest.raises(html_render.RenderCancelled):
+        render_worker.render(CODE, cancel=cancel)
+    assert render_worker.killed == 2
+
+    # a new process for the next render
+    monkeypatch.undo()
+    assert render_worker.render(CODE) == html_render.render_fragment(CODE)
+    assert render_worker.started == 3
+
+
+@fork
+def test_render_worker_crash(fake_anki21, render_worker, monkeypatch):
+    monkeypatch.setattr(html_render, "render_fragment", lambda *args: os._exit(1))
+    with pytest.raises(worker.WorkerError) as exc:
+        render_worker.render(CODE)
+    assert not isinstance(exc.value, worker.RenderTimeout)
+    assert render_worker.killed == 1
+
+
+
+@fork
+def test_render_worker_slow_start(fake_anki21, render_worker, monkeypatch):
+    # the process start (and the imports) is not part of the budget
+    serve = worker._serve
+
+    def slow_serve(conn):
+        time.sleep(1)
+        serve(conn)
+
+    monkeypatch.setattr(worker, "_serve", slow_serve)
+    assert render_worker.render(CODE) == html_render.render_fragment(CODE)
+    assert (render_worker.started, render_worker.killed) == (1, 0)
+
+
+def test_render_worker_spawn(fake_anki21):
+    render_worker = worker.RenderWorker(context=multiprocessing.get_context("spawn"))
+    try:
+        # (a fresh interpreter, the pygments found may differ from this one)
+        found = render_worker.render(CODE)
+        assert found.startswith("<table>")
+        assert 'data-language="Python"' in found
+        assert (render_worker.started, render_worker.killed) == (1, 0)
+    finally:
+        render_worker.close()